@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+
+#
+# Measures answer latency (fetch next card, consume it, promote it) on a single, large box.
+#
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# pylint:disable=wrong-import-position
+from deck import Deck
+from flashcard import FlashCard
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer latency benchmark")
+    parser.add_argument("-n", "--cards", type=int, default=500000, help="Number of cards in box 0")
+    parser.add_argument("-a", "--answers", type=int, default=1000, help="Number of answers to time")
+    args = parser.parse_args()
+
+    deck = Deck(time_fun=lambda: 1000)
+    for i in range(args.cards):
+        deck.insert_card(FlashCard("q%d" % i, "a%d" % i), 0)
+
+    start = time.perf_counter()
+    deck.get_next_card()
+    print("first card: %.1f ms" % ((time.perf_counter() - start) * 1e3))
+
+    start = time.perf_counter()
+    for _ in range(args.answers):
+        card = deck.get_next_card()
+        deck.consume_current_card()
+        deck.right(card)
+    elapsed = time.perf_counter() - start
+    print("%d cards, %d answers: %.1f us/answer" % (args.cards, args.answers, elapsed / args.answers * 1e6))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+#
+# Generates synthetic deckfiles for benchmarking: card count, box distribution, timestamp spread
+# and comment density are configurable. Output is reproducible for a given seed and time.
+#
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# pylint:disable=wrong-import-position
+from deck import Deck, SECS_PER_DAY
+
+# pylint:disable=too-many-arguments,too-many-positional-arguments
+def generate(f, cards, box_weights=None, spread_days=120, comment_ratio=0.05, now=None, seed=0):
+    """ Writes cards card specs to text file f. box_weights holds a relative weight per box (default:
+        uniform), timestamps lie up to spread_days before now, comment_ratio is the share of comment
+        or empty lines among all lines.
+    """
+    rng = random.Random(seed)
+    box_weights = box_weights or [1] * len(Deck.default_expiries)
+    now = now if now is not None else int(time.time())
+    boxes = rng.choices(range(len(box_weights)), weights=box_weights, k=cards)
+    spread = int(spread_days * SECS_PER_DAY)
+    for i, box in enumerate(boxes):
+        while rng.random() < comment_ratio:
+            f.write("%s comment before card %d\n" % (Deck.comment_leader, i) if rng.random() < 0.8 else "\n")
+        f.write("front side %d : back side %d with some more words # %d @ %d\n" % (i, i, box, now - rng.randint(0, spread)))
+
+def parse_weights(text):
+    return [float(weight) for weight in text.split(",")]
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthetic deckfile generator")
+    parser.add_argument("deckfile", help="Deckfile to write")
+    parser.add_argument("-n", "--cards", type=int, default=100000, help="Number of cards")
+    parser.add_argument("-w", "--box-weights", type=parse_weights, default=None, metavar="W0,W1,...",
+                        help="Relative number of cards per box (default: uniform)")
+    parser.add_argument("-d", "--spread-days", type=float, default=120, help="Timestamps lie up to this many days back")
+    parser.add_argument("-c", "--comment-ratio", type=float, default=0.05, help="Share of comment and empty lines")
+    parser.add_argument("-s", "--seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+
+    with open(args.deckfile, "w", encoding=Deck.deckfile_encoding) as f:
+        generate(f, args.cards, args.box_weights, args.spread_days, args.comment_ratio, seed=args.seed)
+
+if __name__ == "__main__":
+    main()
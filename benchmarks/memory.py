@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+#
+# Measures memory held by a loaded deck: eager, lazy and due cards only.
+#
+
+import argparse
+import os
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# pylint:disable=wrong-import-position
+from deck import Deck
+
+def measure(deckfile, cards, mode):
+    # Modules imported on first use (eg. NumPy) don't grow with the deck, keep them out of bytes/card.
+    Deck(filename=deckfile, time_fun=lambda: 1600000000).load_from_file(lazy=mode == "lazy", due_only=mode == "due")
+    tracemalloc.start()
+    deck = Deck(filename=deckfile, time_fun=lambda: 1600000000)
+    deck.load_from_file(lazy=mode == "lazy", due_only=mode == "due")
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("%-5s %8.1f MB (peak %.1f MB), %4d bytes/card" % (mode, current / 1e6, peak / 1e6, current // cards))
+    return deck
+
+def main():
+    parser = argparse.ArgumentParser(description="Deck memory benchmark")
+    parser.add_argument("-n", "--cards", type=int, default=1000000, help="Number of cards")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        deckfile = os.path.join(tmp_dir, "deck")
+        with open(deckfile, "w", encoding=Deck.deckfile_encoding) as f:
+            for i in range(args.cards):
+                # Answered some time within the last 60 days.
+                timestamp = 1600000000 - i * 7919 % (60 * 24 * 60 * 60)
+                f.write("front side %d : back side %d # %d @ %d\n" % (i, i, i % 6, timestamp))
+        for mode in ("eager", "lazy", "due"):
+            measure(deckfile, args.cards, mode)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+#
+# Measures save_to_file time depending on the number of answered cards, incremental vs. full rewrite.
+#
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# pylint:disable=wrong-import-position
+from deck import Deck
+
+def timed_save(deckfile, answers, incremental):
+    deck = Deck(filename=deckfile, time_fun=lambda: 1600000000)
+    deck.load_from_file()
+    for _ in range(answers):
+        card = deck.get_next_card(consume=True)
+        deck.right(card)
+    if not incremental:
+        # Pretend the deckfile has changed, which forces serializing all cards.
+        deck.loaded_signature = None
+    start = time.perf_counter()
+    deck.save_to_file()
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Deck save benchmark")
+    parser.add_argument("-n", "--cards", type=int, default=500000, help="Number of cards")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        deckfile = os.path.join(tmp_dir, "deck")
+        for answers in (10, 1000, 100000):
+            with open(deckfile, "w", encoding=Deck.deckfile_encoding) as f:
+                for i in range(args.cards):
+                    f.write("front side %d : back side %d # 0 @ %d\n" % (i, i, 1550000000 + i))
+            full = timed_save(deckfile, answers, incremental=False)
+            incremental = timed_save(deckfile, answers, incremental=True)
+            print("%d cards, %6d answered: full %.3fs, incremental %.3fs" % (args.cards, answers, full, incremental))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+#
+# Measures flashme startup for the notifier-style invocations (--expired, --info, --silent-start)
+# and for studying (up to the first question, then quitting), based on "python -X importtime".
+# Fails if the median import time exceeds the budget, or if NumPy gets imported for a deck that small.
+#
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+FLASHME = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "flashme.py")
+
+def top_level_imports(stderr):
+    """ Returns {module: cumulative microseconds} of top-level imports in -X importtime output. """
+    imports = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Nested imports are indented.
+        if name.startswith("  ") or cumulative.strip() == "cumulative":
+            continue
+        imports[name.strip()] = int(cumulative)
+    return imports
+
+def run(args, env, answers=""):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime"] + args, env=env, check=False, input=answers,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    return time.perf_counter() - start, top_level_imports(result.stderr)
+
+def main():  # pylint:disable=too-many-locals
+    parser = argparse.ArgumentParser(description="flashme startup benchmark")
+    parser.add_argument("-n", "--cards", type=int, default=1000, help="Number of cards")
+    parser.add_argument("-r", "--runs", type=int, default=20, help="Number of runs per invocation")
+    parser.add_argument("-b", "--budget", type=float, default=40, help="Import time budget in ms (median)")
+    parser.add_argument("--study-budget", type=float, default=150, help="Import time budget in ms for studying (median)")
+    args = parser.parse_args()
+
+    # Measure with compiled bytecode, like any installed flashme (the first run writes it).
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    # Modules the interpreter imports by itself don't count.
+    _, interpreter_imports = run(["-c", "pass"], env)
+    over_budget = False
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        deckfile = os.path.join(tmp_dir, "deck")
+        due_deckfile = os.path.join(tmp_dir, "due")
+        # Nothing expired, so --silent-start exits right away. Everything expired in the deck to study.
+        now = int(time.time())
+        for filename, timestamp in ((deckfile, now), (due_deckfile, 0)):
+            with open(filename, "w", encoding="utf-8") as f:
+                for i in range(args.cards):
+                    f.write("front side %d : back side %d # %d @ %d\n" % (i, i, 1 + i % 5, timestamp))
+        env["XDG_CACHE_HOME"] = os.path.join(tmp_dir, "cache")
+        # Studying quits at the first question.
+        for option, invocation, answers, budget in (
+                ("--expired", [FLASHME, "--expired", deckfile], "", args.budget),
+                ("--info", [FLASHME, "--info", deckfile], "", args.budget),
+                ("--silent-start", [FLASHME, "--silent-start", deckfile], "", args.budget),
+                ("study", [FLASHME, due_deckfile], "Q\n", args.study_budget)):
+            # Fill summary cache first, like any earlier run would have.
+            run(invocation, env, answers)
+            wall_times, import_times, slowest = [], [], {}
+            for _ in range(args.runs):
+                wall_time, imports = run(invocation, env, answers)
+                own_imports = {name: us for name, us in imports.items() if name not in interpreter_imports}
+                wall_times.append(wall_time)
+                import_times.append(sum(own_imports.values()) / 1000)
+                for name, us in own_imports.items():
+                    slowest[name] = max(slowest.get(name, 0), us)
+            import_time = statistics.median(import_times)
+            top = sorted(slowest.items(), key=lambda item: -item[1])[:3]
+            print("%-15s wall %6.1fms, imports %5.1fms (budget %.0fms)  slowest: %s" % (
+                option, statistics.median(wall_times) * 1000, import_time, budget,
+                ", ".join("%s %.1fms" % (name, us / 1000) for name, us in top)))
+            if "numpy" in slowest:
+                print("%-15s imports NumPy" % option)
+            over_budget = over_budget or import_time > budget or "numpy" in slowest
+    sys.exit(1 if over_budget else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+#
+# Benchmarks the deck hot paths (load, next card, cram, statistics, answers, save) on a synthetic
+# deckfile, see deckgen.py. Prints a table, optionally writes the results as JSON, and compares
+# them against a baseline (an earlier JSON result), failing on regressions. make bench compares with
+# benchmarks/baseline.json; refresh it with --json benchmarks/baseline.json after deliberate changes.
+#
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# pylint:disable=wrong-import-position,duplicate-code
+import deckgen
+from deck import Deck
+
+# Answers per timed save.
+SAVE_ANSWERS = 1000
+
+# pylint:disable=too-few-public-methods
+class Clock:
+    """ Deck time, advanced explicitly, so that runs are reproducible. """
+
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+def load_deck(deckfile, clock, lazy=False, due_only=False):
+    deck = Deck(filename=deckfile, time_fun=clock)
+    deck.load_from_file(lazy=lazy, due_only=due_only)
+    return deck
+
+# Each benchmark returns (elapsed seconds, number of operations).
+
+def bench_load(files, clock, _):
+    start = time.perf_counter()
+    load_deck(files["text"], clock)
+    return time.perf_counter() - start, 1
+
+def bench_load_lazy(files, clock, _):
+    start = time.perf_counter()
+    load_deck(files["text"], clock, lazy=True)
+    return time.perf_counter() - start, 1
+
+def bench_load_due_only(files, clock, _):
+    start = time.perf_counter()
+    load_deck(files["text"], clock, due_only=True)
+    return time.perf_counter() - start, 1
+
+def bench_load_compiled(files, clock, _):
+    start = time.perf_counter()
+    load_deck(files["compiled"], clock)
+    return time.perf_counter() - start, 1
+
+def bench_get_next_card(files, clock, operations):
+    deck = load_deck(files["text"], clock)
+    elapsed = 0
+    for done in range(operations):
+        start = time.perf_counter()
+        card = deck.get_next_card()
+        elapsed += time.perf_counter() - start
+        if card is None:
+            # Out of expired cards.
+            return elapsed, done + 1
+        deck.consume_current_card()
+    return elapsed, operations
+
+def bench_get_next_card_cram_mode(files, clock, operations):
+    deck = load_deck(files["text"], clock)
+    # First call sets up the sampler.
+    deck.get_next_card_cram_mode(cram=-1)
+    start = time.perf_counter()
+    for _ in range(operations):
+        deck.get_next_card_cram_mode(cram=-1)
+    return time.perf_counter() - start, operations
+
+def bench_query(query, files, clock, operations):
+    deck = load_deck(files["text"], clock)
+    elapsed = 0
+    for _ in range(operations):
+        # Let cards expire between queries.
+        clock.now += 60
+        start = time.perf_counter()
+        query(deck)
+        elapsed += time.perf_counter() - start
+    return elapsed, operations
+
+def bench_get_statistics(files, clock, operations):
+    return bench_query(Deck.get_statistics, files, clock, operations)
+
+def bench_next_expiry(files, clock, operations):
+    return bench_query(Deck.next_expiry, files, clock, operations)
+
+def bench_answer(correct, files, clock, operations):
+    deck = load_deck(files["text"], clock)
+    answer = deck.right if correct else deck.wrong
+    elapsed = 0
+    for done in range(operations):
+        card = deck.get_next_card(consume=True)
+        if card is None:
+            return elapsed, max(done, 1)
+        start = time.perf_counter()
+        answer(card)
+        elapsed += time.perf_counter() - start
+    return elapsed, operations
+
+def bench_right(files, clock, operations):
+    return bench_answer(True, files, clock, operations)
+
+def bench_wrong(files, clock, operations):
+    return bench_answer(False, files, clock, operations)
+
+def bench_save(incremental, files, clock, _):
+    # Saving changes the deckfile, so work on a copy.
+    shutil.copyfile(files["text"], files["work"])
+    deck = load_deck(files["work"], clock)
+    for _ in range(SAVE_ANSWERS):
+        card = deck.get_next_card(consume=True)
+        if card is None:
+            break
+        deck.right(card)
+    if not incremental:
+        # Pretend the deckfile has changed, which forces serializing all cards.
+        deck.loaded_signature = None
+    start = time.perf_counter()
+    deck.save_to_file()
+    return time.perf_counter() - start, 1
+
+def bench_save_to_file(files, clock, operations):
+    return bench_save(True, files, clock, operations)
+
+def bench_save_to_file_full(files, clock, operations):
+    return bench_save(False, files, clock, operations)
+
+BENCHMARKS = [
+    ("load_from_file", bench_load),
+    ("load_from_file_lazy", bench_load_lazy),
+    ("load_from_file_due_only", bench_load_due_only),
+    ("load_from_file_compiled", bench_load_compiled),
+    ("get_next_card", bench_get_next_card),
+    ("get_next_card_cram_mode", bench_get_next_card_cram_mode),
+    ("get_statistics", bench_get_statistics),
+    ("next_expiry", bench_next_expiry),
+    ("right", bench_right),
+    ("wrong", bench_wrong),
+    ("save_to_file", bench_save_to_file),
+    ("save_to_file_full", bench_save_to_file_full),
+]
+
+def run_benchmarks(args, tmp_dir):
+    now = 1600000000
+    files = {name: os.path.join(tmp_dir, name) for name in ("text", "compiled", "work")}
+    with open(files["text"], "w", encoding=Deck.deckfile_encoding) as f:
+        deckgen.generate(f, args.cards, args.box_weights, args.spread_days, args.comment_ratio, now, args.seed)
+    shutil.copyfile(files["text"], files["compiled"])
+    load_deck(files["compiled"], Clock(now)).compile()
+    results = {}
+    for name, benchmark in BENCHMARKS:
+        if args.only and name not in args.only:
+            continue
+        # Warm-up run (lazy imports, page cache) doesn't count.
+        benchmark(files, Clock(now), args.operations)
+        per_operation = []
+        for _ in range(args.repeat):
+            elapsed, operations = benchmark(files, Clock(now), args.operations)
+            per_operation.append(elapsed / operations)
+        results[name] = {"median": statistics.median(per_operation), "min": min(per_operation)}
+        print("%-24s %12.3f us (min %.3f us)" % (name, results[name]["median"] * 1e6, results[name]["min"] * 1e6))
+    return results
+
+def compare(results, baseline, tolerance):
+    """ Prints how results compare with baseline results, returns names of regressed benchmarks. """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result["median"] / baseline[name]["median"] if baseline[name]["median"] else 1
+        regressed = ratio > 1 + tolerance / 100
+        print("%-24s %6.2fx baseline%s" % (name, ratio, "  REGRESSION" if regressed else ""))
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Deck hot path benchmarks")
+    parser.add_argument("-n", "--cards", type=int, default=100000, help="Number of cards")
+    parser.add_argument("-w", "--box-weights", type=deckgen.parse_weights, default=None, metavar="W0,W1,...",
+                        help="Relative number of cards per box (default: uniform)")
+    parser.add_argument("-d", "--spread-days", type=float, default=120, help="Timestamps lie up to this many days back")
+    parser.add_argument("-c", "--comment-ratio", type=float, default=0.05, help="Share of comment and empty lines")
+    parser.add_argument("-s", "--seed", type=int, default=0, help="Random seed of the deck generator")
+    parser.add_argument("-o", "--operations", type=int, default=1000, help="Operations per run (for per-operation benchmarks)")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="Runs per benchmark")
+    parser.add_argument("-k", "--only", nargs="+", default=None, metavar="NAME", help="Run these benchmarks only")
+    parser.add_argument("-j", "--json", type=str, default=None, metavar="FILE", help="Write results as JSON (- for stdout)")
+    parser.add_argument("-b", "--baseline", type=str, default=None, metavar="FILE", help="Compare with results of an earlier run")
+    parser.add_argument("-t", "--tolerance", type=float, default=25, help="Slowdown (percent of baseline) considered a regression")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        results = run_benchmarks(args, tmp_dir)
+    parameters = {key: getattr(args, key) for key in ("cards", "box_weights", "spread_days", "comment_ratio", "seed", "operations")}
+    output = {
+        "parameters": parameters,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    if args.json == "-":
+        print(json.dumps(output, indent=2))
+    elif args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(output, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("parameters") != parameters:
+            print("Warning: baseline was measured with different parameters: %s" % baseline.get("parameters"))
+        if compare(results, baseline["results"], args.tolerance):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
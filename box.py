@@ -0,0 +1,45 @@
+import itertools
+
+class Box:
+    """ Ordered view of the flashcards in one box of a deck.
+        Cards of all boxes live in a single list indexed by sequence number, next to an array
+        that holds the box of every sequence number (negative if it doesn't belong to any box).
+        Sequence numbers grow with every insertion, so any card can be removed in O(1) without
+        shifting the remaining cards, and iterating a box yields its cards in insertion order.
+    """
+
+    def __init__(self, index, cards, seq_boxes):
+        self.index = index
+        # seq -> card, None if there is no card with that sequence number (anymore)
+        self.cards = cards
+        self.seq_boxes = seq_boxes
+        self.count = 0
+
+    def add(self, seq, card):
+        """ Puts card into the box; the sequence number must be allocated already. """
+        self.cards[seq] = card
+        self.seq_boxes[seq] = self.index
+        self.count += 1
+
+    def remove(self, seq):
+        card = self.cards[seq]
+        self.cards[seq] = None
+        self.count -= 1
+        return card
+
+    def get(self, seq):
+        return self.cards[seq] if self.seq_boxes[seq] == self.index else None
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        index = self.index
+        return (card for card, box in zip(self.cards, self.seq_boxes) if box == index and card is not None)
+
+    def __getitem__(self, position):
+        if position < 0:
+            position += self.count
+        if not 0 <= position < self.count:
+            raise IndexError("Box position out of range")
+        return next(itertools.islice(self, position, None))
@@ -0,0 +1,90 @@
+import hashlib
+import os
+import os.path
+from array import array
+
+from deck import Deck
+from expiry import ExpirySummary
+
+class SummaryCache:
+    """ On-disk cache of deck expiry summaries, one file per deckfile.
+        An entry is valid as long as the deckfile's inode, size and mtime haven't changed.
+        File format (int64 values): header length, header (version, deckfile signature, box count,
+        expiries, cards per box, due times per box), followed by the sorted due times of all boxes.
+        The format is plain binary so that reading it needs no JSON parser: startup time matters.
+    """
+
+    version = 2
+    xdg_cache_home_env_string = "XDG_CACHE_HOME"
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir if cache_dir else SummaryCache.default_dir()
+
+    @staticmethod
+    def default_dir():
+        cache_home = os.environ.get(SummaryCache.xdg_cache_home_env_string) or \
+            os.path.join(os.path.expanduser("~"), ".cache")
+        return os.path.join(cache_home, "flashme")
+
+    def entry_path(self, deck):
+        # Due times depend on the scheduler, so every scheduler gets entries of its own.
+        key = hashlib.sha1((deck.scheduler.name + ":" + os.path.realpath(deck.filename)).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, key)
+
+    def summary(self, deck):
+        """ Returns expiry summary of deck's file, from cache if possible, otherwise by scanning it. """
+        signature = Deck.file_signature(deck.filename)
+        summary = self.load(deck, signature)
+        if summary is None:
+            summary = deck.scan_file().summary()
+            self.store(deck, signature, summary)
+        return summary
+
+    def load(self, deck, signature):
+        try:
+            with open(self.entry_path(deck), "rb") as f:
+                header_length = SummaryCache.read_ints(f, 1)
+                header = SummaryCache.read_ints(f, header_length[0]) if header_length else None
+                header = header.tolist() if header else []
+                box_count = len(deck.expiries)
+                if header[:5] != [SummaryCache.version] + list(signature) + [box_count] \
+                        or header[5:5 + box_count] != list(deck.expiries) or len(header) != 5 + 3 * box_count:
+                    return None
+                dues = []
+                for count in header[5 + 2 * box_count:]:
+                    box_dues = SummaryCache.read_ints(f, count)
+                    if box_dues is None:
+                        return None
+                    dues.append(box_dues)
+            return ExpirySummary(header[5 + box_count:5 + 2 * box_count], dues)
+        except (OSError, ValueError, TypeError):
+            return None
+
+    @staticmethod
+    def read_ints(f, count):
+        """ Reads count int64 values, returns None if the file ends prematurely. """
+        values = array("q")
+        values.frombytes(f.read(count * values.itemsize))
+        return values if len(values) == count else None
+
+    def store(self, deck, signature, summary):
+        import tempfile  # pylint:disable=import-outside-toplevel
+        header = array("q", [SummaryCache.version] + list(signature) + [len(deck.expiries)] + list(deck.expiries)
+                       + list(summary.totals) + [len(dues) for dues in summary.dues])
+        # Write to a temp file first, so concurrent readers never see partial entries.
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    array("q", [len(header)]).tofile(f)
+                    header.tofile(f)
+                    for dues in summary.dues:
+                        dues.tofile(f)
+                os.replace(tmp_path, self.entry_path(deck))
+            except OSError:
+                os.unlink(tmp_path)
+                raise
+        except OSError:
+            # Caching is best effort.
+            pass
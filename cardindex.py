@@ -0,0 +1,57 @@
+class CardIndex:
+    """ Hash index of cards by front and by back text, for O(1) lookup and duplicate detection.
+        To save memory, a table entry is a single card, or a list of cards once a text is shared.
+        Cards are identified by object identity; changing a card's front or back after it has
+        been indexed isn't tracked.
+    """
+
+    def __init__(self):
+        self.fronts = {}
+        self.backs = {}
+
+    @staticmethod
+    def put(table, key, card):
+        entry = table.get(key)
+        if entry is None:
+            table[key] = card
+        elif isinstance(entry, list):
+            if not any(indexed is card for indexed in entry):
+                entry.append(card)
+        elif entry is not card:
+            table[key] = [entry, card]
+
+    @staticmethod
+    def get(table, key):
+        entry = table.get(key)
+        if entry is None:
+            return []
+        return list(entry) if isinstance(entry, list) else [entry]
+
+    def add(self, card):
+        CardIndex.put(self.fronts, card.front, card)
+        CardIndex.put(self.backs, card.back, card)
+
+    def add_all(self, cards):
+        """ Like add for many cards, but faster, as texts are mostly unique. """
+        fronts, backs, put = self.fronts, self.backs, CardIndex.put
+        for card in cards:
+            front, back = card.front, card.back
+            if fronts.setdefault(front, card) is not card:
+                put(fronts, front, card)
+            if backs.setdefault(back, card) is not card:
+                put(backs, back, card)
+
+    def find(self, front, back=None):
+        """ Returns cards with given front (and back, if given). """
+        cards = CardIndex.get(self.fronts, front)
+        return cards if back is None else [card for card in cards if card.back == back]
+
+    def find_by_back(self, back):
+        return CardIndex.get(self.backs, back)
+
+    def duplicates(self):
+        """ Returns lists of cards that share their front, in order of first appearance. """
+        return [list(entry) for entry in self.fronts.values() if isinstance(entry, list)]
+
+    def __len__(self):
+        return sum(len(entry) if isinstance(entry, list) else 1 for entry in self.fronts.values())
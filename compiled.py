@@ -0,0 +1,146 @@
+import mmap
+import os
+import os.path
+import stat
+import struct
+from array import array
+
+# pylint:disable=too-many-instance-attributes
+class CompiledDeck:
+    """ Binary sidecar of a deckfile, for fast loading of huge decks. The text deckfile stays the
+        source of truth; the sidecar is only used while its recorded deckfile signature matches.
+        Layout (little endian): header, timestamps (int64 per line), deckfile line offsets
+        (int64 per line, plus end of file), text offsets (int64 per front/back, plus end),
+        boxes (int8 per line, -1 for comments and empty lines), string table (UTF-8).
+        All fields are read straight from a memory-mapped file.
+    """
+
+    suffix = ".fmc"
+    magic = b"FMC1"
+    # magic, inode, size, mtime, line count
+    header = struct.Struct("<4s4xqqqq")
+    encoding = "utf-8"
+
+    def __init__(self, mapping):
+        self.mapping = mapping
+        _, ino, size, mtime_ns, line_count = CompiledDeck.header.unpack_from(mapping)
+        self.signature = [ino, size, mtime_ns]
+        self.line_count = line_count
+        view = memoryview(mapping)
+        pos = CompiledDeck.header.size
+        self.timestamps = view[pos:pos + 8 * line_count].cast("q")
+        pos += 8 * line_count
+        self.line_offsets = view[pos:pos + 8 * (line_count + 1)].cast("q")
+        pos += 8 * (line_count + 1)
+        self.text_offsets = view[pos:pos + 8 * (2 * line_count + 1)].cast("q")
+        pos += 8 * (2 * line_count + 1)
+        self.boxes = view[pos:pos + line_count].cast("b")
+        pos += line_count
+        self.strings = view[pos:]
+
+    @staticmethod
+    def path(deckfile):
+        return os.path.realpath(deckfile) + CompiledDeck.suffix
+
+    @classmethod
+    def open(cls, deckfile, signature):
+        """ Maps sidecar of deckfile, returns None if there's none matching the deckfile signature. """
+        try:
+            with open(CompiledDeck.path(deckfile), "rb") as f:
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        if len(mapping) < CompiledDeck.header.size or mapping[:4] != CompiledDeck.magic:
+            mapping.close()
+            return None
+        compiled = cls(mapping)
+        if compiled.signature != list(signature):
+            compiled.close()
+            return None
+        return compiled
+
+    def close(self):
+        # Views must be released before the mapping can be closed.
+        for view in (self.timestamps, self.line_offsets, self.text_offsets, self.boxes, self.strings):
+            view.release()
+        self.mapping.close()
+
+    def text(self, line):
+        """ Returns (front, back) of a deckfile line; front holds the whole line for comments. """
+        start, middle, end = self.text_offsets[2 * line:2 * line + 3]
+        return (str(self.strings[start:middle], CompiledDeck.encoding),
+                str(self.strings[middle:end], CompiledDeck.encoding))
+
+    @staticmethod
+    def patch(deckfile, old_signature, signature, records, line_offsets):
+        """ Updates boxes and timestamps of the sidecar of deckfile in place, after answers have been saved.
+            records holds (line, box, timestamp) per changed line, line_offsets all new line offsets;
+            texts must be unchanged. Only a sidecar that matched the deckfile as it was before (old_signature)
+            gets updated, any other one stays stale. Returns True if the sidecar has been updated.
+        """
+        try:
+            with open(CompiledDeck.path(deckfile), "r+b") as f:
+                header = f.read(CompiledDeck.header.size)
+                if len(header) < CompiledDeck.header.size or header[:4] != CompiledDeck.magic:
+                    return False
+                fields = CompiledDeck.header.unpack(header)
+                line_count = fields[4]
+                if list(fields[1:4]) != list(old_signature) or len(line_offsets) != line_count + 1:
+                    return False
+                # A crash halfway leaves a sidecar that matches no deckfile, rather than a wrong one.
+                CompiledDeck.write_header(f, [0, 0, 0], line_count)
+                timestamps_pos = CompiledDeck.header.size
+                line_offsets_pos = timestamps_pos + 8 * line_count
+                boxes_pos = line_offsets_pos + 8 * (line_count + 1) + 8 * (2 * line_count + 1)
+                for line, box, timestamp in records:
+                    f.seek(timestamps_pos + 8 * line)
+                    f.write(array("q", [timestamp]).tobytes())
+                    f.seek(boxes_pos + line)
+                    f.write(array("b", [box]).tobytes())
+                f.seek(line_offsets_pos)
+                array("q", line_offsets).tofile(f)
+                f.flush()
+                os.fsync(f.fileno())
+                CompiledDeck.write_header(f, signature, line_count)
+        except OSError:
+            return False
+        return True
+
+    @staticmethod
+    def write_header(f, signature, line_count):
+        f.seek(0)
+        f.write(CompiledDeck.header.pack(CompiledDeck.magic, *signature, line_count))
+        f.flush()
+        os.fsync(f.fileno())
+
+    @staticmethod
+    def write(deckfile, signature, lines, line_offsets):  # pylint:disable=too-many-locals
+        """ Writes sidecar for deckfile. lines holds (box, timestamp, front, back) per deckfile line. """
+        import tempfile  # pylint:disable=import-outside-toplevel
+        timestamps = array("q")
+        text_offsets = array("q", [0])
+        boxes = array("b")
+        strings = bytearray()
+        for box, timestamp, front, back in lines:
+            boxes.append(box)
+            timestamps.append(timestamp)
+            for text in (front, back):
+                strings += text.encode(CompiledDeck.encoding)
+                text_offsets.append(len(strings))
+        assert len(line_offsets) == len(boxes) + 1
+        path = CompiledDeck.path(deckfile)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(CompiledDeck.header.pack(CompiledDeck.magic, *signature, len(boxes)))
+                timestamps.tofile(f)
+                array("q", line_offsets).tofile(f)
+                text_offsets.tofile(f)
+                boxes.tofile(f)
+                f.write(strings)
+            # Sidecar holds the deckfile's contents, so it gets the deckfile's permissions (not mkstemp's 0600).
+            os.chmod(tmp_path, stat.S_IMODE(os.stat(deckfile).st_mode))
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
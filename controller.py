@@ -17,7 +17,7 @@ class Controller:
     def handle(self, inp, card):
         retval = (None, None)
         if inp == Controller.input_quit:
-            self.deck.save_to_file()
+            self.deck.persist()
             retval = (inp, None)
         elif inp == Controller.input_info:
             retval = (inp, self.deck.get_statistics)
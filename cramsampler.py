@@ -0,0 +1,100 @@
+import random
+
+class CramSampler:
+    """ Draws cram cards at random, one card at a time, without shuffling whole boxes.
+        Cards are identified by their sequence number, which stays the same as long as a card
+        remains in its box. Every box keeps its sequence numbers in a pool that is split into
+        an unseen part (front) and a seen part (back). Drawing picks a random unseen card and
+        swaps it to the boundary (incremental Fisher-Yates), so each draw is O(1) and every card
+        comes up once per round. Cards entering a box join the seen part, cards leaving a box
+        are swapped out of the pool, both in O(1).
+        Without weights, a box is chosen with probability proportional to its unseen cards, which
+        is the same as drawing from a single shuffled list of all cards. With weights, a box is
+        chosen with probability proportional to weight times its size, and each box starts its
+        next round on its own.
+    """
+
+    def __init__(self, box_count, seq_cards, seq_boxes, weights=None, cards=None):
+        """ Takes cards and their boxes by sequence number (see Deck); sequence numbers without a card
+            are skipped. If cards (a set) is given, only those cards are drawn.
+        """
+        assert weights is None or len(weights) == box_count
+        self.weights = weights
+        self.pools = [[] for _ in range(box_count)]
+        for seq, (card, box) in enumerate(zip(seq_cards, seq_boxes)):
+            if card is not None and (cards is None or card in cards):
+                self.pools[box].append(seq)
+        self.unseen = [len(pool) for pool in self.pools]
+        # seq -> position in its pool
+        self.positions = {}
+        for pool in self.pools:
+            self.positions.update((seq, position) for position, seq in enumerate(pool))
+
+    def add(self, box_index, seq):
+        pool = self.pools[box_index]
+        self.positions[seq] = len(pool)
+        pool.append(seq)
+
+    def remove(self, box_index, seq):
+        pool = self.pools[box_index]
+        position = self.positions.pop(seq, None)
+        # Not a card to be drawn.
+        if position is None:
+            return
+        unseen = self.unseen[box_index]
+        if position < unseen:
+            # Fill gap with last unseen card, then gap at end of unseen part with last card.
+            unseen -= 1
+            self.unseen[box_index] = unseen
+            if position != unseen:
+                self.move(pool, unseen, position)
+                position = unseen
+        last = pool.pop()
+        if position < len(pool):
+            pool[position] = last
+            self.positions[last] = position
+
+    def move(self, pool, source, target):
+        seq = pool[source]
+        pool[target] = seq
+        self.positions[seq] = target
+
+    def choose_box(self):
+        """ Returns index of box to draw next card from, None if there are no cards to draw. """
+        if self.weights is None:
+            # All cards seen: start new round.
+            if not any(self.unseen):
+                self.unseen = [len(pool) for pool in self.pools]
+            shares = self.unseen
+        else:
+            shares = [weight * len(pool) if weight > 0 else 0 for weight, pool in zip(self.weights, self.pools)]
+        total = sum(shares)
+        if not total:
+            return None
+        point = random.random() * total
+        chosen = None
+        for box_index, share in enumerate(shares):
+            if share:
+                chosen = box_index
+                point -= share
+                if point < 0:
+                    break
+        return chosen
+
+    def draw(self):
+        """ Returns (box index, seq) of a random card that hasn't come up in this round yet. """
+        box_index = self.choose_box()
+        if box_index is None:
+            return None
+        pool = self.pools[box_index]
+        unseen = self.unseen[box_index]
+        if not unseen:
+            unseen = len(pool)
+        position = random.randrange(unseen)
+        unseen -= 1
+        seq = pool[position]
+        self.move(pool, unseen, position)
+        pool[unseen] = seq
+        self.positions[seq] = unseen
+        self.unseen[box_index] = unseen
+        return box_index, seq
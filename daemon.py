@@ -0,0 +1,101 @@
+import os
+import socket
+
+from daemonclient import DaemonClient
+from deck import Deck
+from journal import Journal
+from scheduler import LeitnerScheduler
+
+class Daemon:
+    """ Keeps decks loaded and answers queries about them over a Unix domain socket,
+        see DaemonClient for the protocol. Decks are loaded on their first query. On every
+        query, the daemon polls the mtimes of deckfile and journal, and reloads the deck
+        if either has changed, so answers are always the same as direct loading would give.
+    """
+
+    def __init__(self, socket_path=None, scheduler=None):
+        self.socket_path = socket_path or DaemonClient.default_socket_path()
+        # Scheduler of all decks.
+        self.scheduler = scheduler or LeitnerScheduler(Deck.default_expiries)
+        # deckfile -> (signatures at load time, deck)
+        self.decks = {}
+        self.server = None
+
+    @staticmethod
+    def signatures(deckfile):
+        journal_path = Journal.path_of(deckfile)
+        journal_signature = Deck.file_signature(journal_path) if os.path.exists(journal_path) else None
+        return Deck.file_signature(deckfile), journal_signature
+
+    def deck(self, deckfile):
+        """ Returns up-to-date deck of given deckfile. """
+        signatures = Daemon.signatures(deckfile)
+        entry = self.decks.get(deckfile)
+        if entry is None or entry[0] != signatures:
+            deck = Deck(filename=deckfile, scheduler=self.scheduler)
+            deck.load_from_file(lazy=True)
+            entry = self.decks[deckfile] = (signatures, deck)
+        return entry[1]
+
+    def answer(self, request):
+        command, _, deckfile = request.partition(" ")
+        try:
+            if command == DaemonClient.command_ping:
+                return "ok"
+            if command == DaemonClient.command_statistics:
+                return "ok " + " ".join("%d %d" % (total, expired) for total, expired in self.deck(deckfile).get_statistics())
+            if command == DaemonClient.command_next_expiry:
+                next_expiry = self.deck(deckfile).next_expiry()
+                return "ok " + (str(next_expiry) if next_expiry is not None else "none")
+        except (OSError, ValueError, Deck.DeckfileNotFoundError, Deck.CardSpecError) as ex:
+            # Don't keep a deck that couldn't be (re)loaded.
+            self.decks.pop(deckfile, None)
+            return "error " + " ".join(str(ex).split())
+        return "error Unknown command: " + command
+
+    def handle(self, connection):
+        connection.settimeout(DaemonClient.timeout)
+        try:
+            with connection.makefile("rw", encoding="utf-8", newline="\n") as stream:
+                for request in stream:
+                    stream.write(self.answer(request.rstrip("\n")) + "\n")
+                    stream.flush()
+        except (OSError, UnicodeDecodeError):
+            # Eg. client stuck or gone, just drop the connection.
+            pass
+
+    def listen(self):
+        # Other daemon running? Otherwise, the socket file is a leftover.
+        client = DaemonClient.connect(self.socket_path)
+        if client is not None:
+            client.close()
+            raise OSError("Daemon already running on " + self.socket_path)
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077)
+        try:
+            self.server.bind(self.socket_path)
+        finally:
+            os.umask(old_umask)
+        self.server.listen()
+
+    def accept(self):
+        """ Waits for a client and answers its queries. """
+        connection, _ = self.server.accept()
+        with connection:
+            self.handle(connection)
+
+    def close(self):
+        self.server.close()
+        self.server = None
+        os.unlink(self.socket_path)
+
+    def serve(self):
+        """ Answers queries until terminated. """
+        self.listen()
+        try:
+            while True:
+                self.accept()
+        finally:
+            self.close()
@@ -0,0 +1,75 @@
+import os
+import socket
+
+class DaemonClient:
+    """ Talks to a running flashme daemon (see Daemon) over its Unix domain socket.
+        Protocol: one request per line, "<command> <deckfile>", answered by one line,
+        "ok <result>" or "error <message>". A connection may carry any number of requests.
+    """
+
+    class QueryError(Exception):
+        pass
+
+    command_ping = "ping"
+    command_statistics = "stats"
+    command_next_expiry = "next"
+    xdg_runtime_dir_env_string = "XDG_RUNTIME_DIR"
+    # Seconds to wait for the daemon before giving up.
+    timeout = 5
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.stream = connection.makefile("rw", encoding="utf-8", newline="\n")
+
+    @staticmethod
+    def default_socket_path():
+        runtime_dir = os.environ.get(DaemonClient.xdg_runtime_dir_env_string)
+        if runtime_dir:
+            return os.path.join(runtime_dir, "flashme.sock")
+        return os.path.join(os.environ.get("TMPDIR", "/tmp"), "flashme-%d.sock" % os.getuid())
+
+    @classmethod
+    def connect(cls, socket_path=None):
+        """ Returns client connected to the daemon, None if no daemon is running. """
+        if not hasattr(socket, "AF_UNIX"):
+            return None
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(DaemonClient.timeout)
+        try:
+            connection.connect(socket_path or DaemonClient.default_socket_path())
+        except OSError:
+            connection.close()
+            return None
+        return cls(connection)
+
+    def close(self):
+        self.stream.close()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def query(self, command, deckfile=""):
+        try:
+            self.stream.write("%s %s\n" % (command, deckfile))
+            self.stream.flush()
+            response = self.stream.readline()
+        except OSError as ose:
+            raise DaemonClient.QueryError("Daemon not responding: " + str(ose)) from ose
+        status, _, result = response.rstrip("\n").partition(" ")
+        if status != "ok":
+            raise DaemonClient.QueryError(result if status == "error" else "Daemon closed connection")
+        return result
+
+    def statistics(self, deckfile):
+        """ Returns [total, expired] per box, like Deck.get_statistics. """
+        numbers = [int(number) for number in self.query(DaemonClient.command_statistics, deckfile).split()]
+        return [numbers[i:i + 2] for i in range(0, len(numbers), 2)]
+
+    def next_expiry(self, deckfile):
+        """ Returns seconds until next card expires, like Deck.next_expiry. """
+        result = self.query(DaemonClient.command_next_expiry, deckfile)
+        return int(result) if result != "none" else None
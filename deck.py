@@ -1,14 +1,27 @@
 import time
 import sys
-import random
+from array import array
+import contextlib
+import gc
+import itertools
 import os
 import os.path
+import stat
+import threading
 
-from flashcard import FlashCard
+from flashcard import FlashCard, LazyFlashCard
+from box import Box
+from cardindex import CardIndex
+from cramsampler import CramSampler
+from compiled import CompiledDeck
+from decklock import DeckLock
+from deckmerge import DeckMerge
+from deferredcards import DeferredCards
+from dueindex import DueIndex
+from journal import Journal
+from scheduler import LeitnerScheduler, SECS_PER_DAY
 
-SECS_PER_DAY = 60 * 60 * 24
-
-# pylint:disable=too-many-instance-attributes
+# pylint:disable=too-many-instance-attributes,too-many-public-methods
 class Deck:
     """ Represents a deck of flashcards, distributed over boxes.
         Implements the main flashcard business logic, eg. card promotion, demotion, expiry.
@@ -20,159 +33,933 @@ class Deck:
     class DeckfileNotFoundError(Exception):
         pass
 
+    class DeckfileChangedError(OSError):
+        pass
+
     default_expiries_days = [0, 2, 10, 30, 90, -1]
     default_expiries = [(SECS_PER_DAY) * expiry_days for expiry_days in default_expiries_days]
     flashme_dir_env_string = "FLASHME_DIR"
     comment_leader = "#"
+    deckfile_encoding = "utf-8"
+    # Bytes of deckfile lines to decode at once, see read_lines.
+    read_chunk_size = 1024 * 1024
+    # Journal entries after which the journal gets compacted into the deckfile.
+    journal_threshold = 1000
 
     def __init__(self, expiries=default_expiries, filename=None, **kwargs):
-        self.box_count = len(expiries)
+        # Given scheduler takes precedence over expiries.
+        self.scheduler = kwargs['scheduler'] if 'scheduler' in kwargs else LeitnerScheduler(expiries)
+        self.box_count = self.scheduler.box_count
         self.max_box_num = self.box_count - 1
-        self.expiries = expiries
+        self.expiries = self.scheduler.expiries
         self.filename = None
         self.modified = False
-        self.cram_list = []
+        # Cards whose deckfile line needs to be re-serialized upon saving.
+        self.dirty_cards = set()
+        # Deckfile signature at load time, see file_signature.
+        self.loaded_signature = None
+        # Byte offsets of deckfile lines, plus end of file.
+        self.line_offsets = array("q")
+        # Memory-mapped binary sidecar, if deck was loaded from one.
+        self.compiled = None
+        # Guards deckfile and line offsets, which a background save replaces while lazy cards get read.
+        self.file_lock = threading.Lock()
+        # Set while a background save is in progress, see start_save.
+        self.saving = False
+        self.cram_sampler = None
+        self.cram_key = None
+        # Built on first use, see index_cards and search.
+        self.card_index = None
+        self.search_index = None
+        # Built on first forecast, then kept up to date.
+        self.due_histogram = None
+        # Records of cards that haven't been loaded yet, see load_due_only.
+        self.deferred = None
+        # If set, cram mode only draws these cards.
+        self.cram_cards = None
 
         self.time_fun = kwargs['time_fun'] if 'time_fun' in kwargs else lambda: int(time.time())
+        # In journal mode, answers are appended to a journal file instead of rewriting the deckfile.
+        self.journal_enabled = kwargs['journal'] if 'journal' in kwargs else False
+        # Journal of the deckfile, see Journal. Answers journaled earlier get replayed in any mode.
+        self.journal = None
 
         assert len(self.expiries) == self.box_count
-        self.boxes = [[] for _ in range(self.box_count)]
+        # Per-card bookkeeping as struct of arrays, indexed by sequence number. Boxes are views of the
+        # cards by box, see Box; sequence numbers not belonging to any box (eg. of comments) have box -1.
+        self.seq_cards = []
+        self.seq_boxes = array("b")
+        self.seq_dues = array("q")
+        self.seq_states = array("b")
+        self.boxes = [Box(box_index, self.seq_cards, self.seq_boxes) for box_index in range(self.box_count)]
+        self.due_indexes = [DueIndex(self.seq_dues, self.seq_states) for _ in range(self.box_count)]
+        # Listener of all cards in the deck. Bound once, as every access creates a new bound method object.
+        self.card_listener = self.card_changed
         self.current_box_index = 0
-        self.current_card_index = None
+        self.current_card_seq = None
         self.deckfile_lines = []
 
         if filename:
             self.filename = Deck.locate_file(filename)
             if not self.filename:
                 raise Deck.DeckfileNotFoundError("Flashcard file does not exist or is not accessible")
+            self.journal = Journal(self.filename)
 
     def load_from_specs(self, card_specs):
-        for line in card_specs:
-            card_spec = line.rstrip()
-            # Handle empty lines and comments.
-            if not card_spec or card_spec.startswith(Deck.comment_leader):
-                self.deckfile_lines.append(card_spec)
-            else:
-                card = FlashCard.from_card_spec(card_spec)
-                if card:
-                    if 0 <= card.box <= self.max_box_num:
-                        self.boxes[card.box].append(card)
-                    else:
+        self.load_lines(card_specs)
+
+    def load_lazily(self, card_specs):
+        """ Like load_from_specs, but creates LazyFlashCards that only remember their deckfile line. """
+        self.load_lines(card_specs, self.read_card_text)
+
+    def load_lines(self, card_specs, read_text=None):  # pylint:disable=too-many-locals
+        """ Loads cards (lazy ones reading their text via read_text, if given) and comments. Every line takes
+            a sequence number, so a loaded card's sequence number is its line number (the same int object,
+            unless the deck wasn't empty). Cards go into their boxes and due indexes in bulk, see
+            index_loaded_cards.
+        """
+        first_seq = len(self.seq_boxes)
+        # Line number minus sequence number.
+        line_shift = len(self.deckfile_lines) - first_seq
+        timestamps = array("q")
+        # Hot loop: attribute lookups hoisted.
+        append_line, append_card = self.deckfile_lines.append, self.seq_cards.append
+        append_box, append_timestamp = self.seq_boxes.append, timestamps.append
+        comment_leader, max_box_num, listener = Deck.comment_leader, self.max_box_num, self.card_listener
+        scan_card_spec, from_text = FlashCard.scan_card_spec, FlashCard.from_text
+        try:
+            with Deck.gc_paused():
+                for seq, card_spec in enumerate(card_specs, first_seq):
+                    card_spec = card_spec.rstrip()
+                    # Handle empty lines and comments.
+                    if not card_spec or card_spec.startswith(comment_leader):
+                        append_line(card_spec)
+                        append_card(None)
+                        append_box(-1)
+                        append_timestamp(0)
+                        continue
+                    fields = scan_card_spec(card_spec)
+                    if not fields:
+                        raise Deck.CardSpecError("Malformed card spec: " + card_spec)
+                    text, split, box, timestamp = fields
+                    if not 0 <= box <= max_box_num:
                         raise Deck.CardSpecError("Box number out of range: " + card_spec)
-                    self.deckfile_lines.append(card)
-                else:
+                    line = seq + line_shift if line_shift else seq
+                    if read_text:
+                        card = LazyFlashCard(read_text, line, box, timestamp, seq, listener)
+                    else:
+                        card = from_text(text, split, box, timestamp, seq, line, listener)
+                    append_line(card)
+                    append_card(card)
+                    append_box(box)
+                    append_timestamp(timestamp)
+        finally:
+            self.index_loaded_cards(first_seq, timestamps)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def gc_paused():
+        """ Pauses garbage collection, eg. while creating many cards at once. Collections triggered by
+            that would traverse all cards created so far over and over, without finding any garbage.
+        """
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            yield
+        finally:
+            if enabled:
+                gc.enable()
+
+    def load_due_only(self, card_specs):  # pylint:disable=too-many-locals
+        """ Like load_from_specs, but only cards that are due now become cards. Other cards are just
+            recorded (see DeferredCards) and comments are skipped; their deckfile_lines entries stay None
+            until they're needed, see load_deferred_lines. Every card gets its sequence number right
+            away, so cards loaded later still take their place in box order. Saving patches changed
+            lines in place, so lines that haven't been loaded are copied verbatim.
+        """
+        deferred = DeferredCards(self.box_count)
+        expired_seqs = [array("I") for _ in range(self.box_count)]
+        now = self.time_fun()
+        due = self.scheduler.due
+        first_seq = len(self.seq_boxes)
+        line_shift = len(self.deckfile_lines) - first_seq
+        deckfile_lines, seq_cards, seq_boxes, seq_dues = self.deckfile_lines, self.seq_cards, self.seq_boxes, self.seq_dues
+        try:
+            with Deck.gc_paused():
+                for line in card_specs:
+                    card_spec = line.rstrip()
+                    seq = len(seq_cards)
+                    line = seq + line_shift if line_shift else seq
+                    card = None
+                    if not card_spec or card_spec.startswith(Deck.comment_leader):
+                        box = -1
+                    else:
+                        fields = FlashCard.scan_card_spec(card_spec)
+                        if not fields:
+                            raise Deck.CardSpecError("Malformed card spec: " + card_spec)
+                        box = fields[2]
+                        if not 0 <= box <= self.max_box_num:
+                            raise Deck.CardSpecError("Box number out of range: " + card_spec)
+                        card_due = due(box, fields[3])
+                        if card_due is None or card_due > now:
+                            deferred.add(line, seq, box, card_due)
+                        else:
+                            card = FlashCard.from_text(*fields, seq, line, self.card_listener)
+                            expired_seqs[box].append(seq)
+                    # Sequence numbers of deferred cards are reserved: the cards aren't in their boxes
+                    # (nor due indexes) until loaded.
+                    deckfile_lines.append(card)
+                    seq_cards.append(card)
+                    seq_boxes.append(box)
+                    seq_dues.append(card_due if card is not None else DueIndex.removed)
+        finally:
+            self.seq_states.frombytes(bytes(len(seq_boxes) - len(self.seq_states)))
+            for box, due_index, seqs in zip(self.boxes, self.due_indexes, expired_seqs):
+                for seq in seqs:
+                    self.seq_states[seq] = DueIndex.state_expired
+                box.count += len(seqs)
+                due_index.add_bulk(now, seqs, array("I"))
+            deferred.sort()
+            self.deferred = deferred
+            self.card_index = None
+            self.search_index = None
+            self.due_histogram = None
+            self.cram_sampler = None
+
+    def load_due_cards(self, now):
+        """ Loads deferred cards that have come due since the deck was loaded. Does nothing if the
+            deckfile has been changed by someone else; get_next_card adopts the change first.
+        """
+        if self.deferred is not None:
+            due = self.deferred.first_due()
+            if due is not None and due <= now and not self.deckfile_changed():
+                self.load_deferred_lines(self.deferred.take_due(now))
+
+    def load_deferred(self):
+        """ Loads all deferred cards and comments, eg. before all cards are needed. """
+        if self.deferred is None:
+            return
+        if self.deckfile_changed():
+            # Merging loads the deckfile as it is now, all of it.
+            self.adopt_changes()
+            return
+        seqs = dict(self.deferred.take_all())
+        self.deferred = None
+        self.load_deferred_lines([(line, seqs.get(line)) for line, deckfile_line in enumerate(self.deckfile_lines)
+                                  if deckfile_line is None])
+
+    def load_deferred_lines(self, records):
+        """ Reads deckfile lines that haven't been loaded yet, given as (line, reserved sequence number)
+            for cards and (line, None) for comments. The deckfile must be unchanged since loading.
+        """
+        with self.file_lock, open(self.filename, "rb") as f:
+            for line, seq in sorted(records):
+                f.seek(self.line_offsets[line])
+                card_spec = f.readline().decode(Deck.deckfile_encoding).rstrip()
+                if seq is None:
+                    self.deckfile_lines[line] = card_spec
+                    continue
+                card = FlashCard.from_card_spec(card_spec)
+                card.line = line
+                self.deckfile_lines[line] = card
+                # Not dirty, and already counted by the due histogram.
+                self.place_card(card.box, card, seq)
+                self.due_indexes[card.box].add(seq, self.card_due(card))
+
+    def read_lines(self, f):
+        """ Decodes lines of deckfile f, recording the byte offset of every line (plus end of file).
+            Lines come without their line break.
+        """
+        self.line_offsets = array("q")
+        return itertools.chain.from_iterable(self.read_chunks(f))
+
+    def read_chunks(self, f):
+        """ Yields lists of lines of deckfile f, see read_lines. Reading and decoding a chunk of lines at a
+            time is much faster than one line at a time.
+        """
+        end = 0
+        while True:
+            raw_lines = f.readlines(Deck.read_chunk_size)
+            if not raw_lines:
+                break
+            self.line_offsets.extend(itertools.accumulate(map(len, raw_lines), initial=end))
+            # Start of the next chunk.
+            end = self.line_offsets.pop()
+            lines = b"".join(raw_lines).decode(Deck.deckfile_encoding).split("\n")
+            if not lines[-1]:
+                # Last line ends with a line break.
+                lines.pop()
+            yield lines
+        self.line_offsets.append(end)
+
+    def index_loaded_cards(self, first_seq, timestamps):
+        """ Counts freshly loaded cards (sequence numbers from first_seq on, their cards and boxes set
+            already) into their boxes and due indexes, evaluating expiry of all of them in one vectorized
+            pass. timestamps holds a timestamp per sequence number.
+        """
+        # Indexes get rebuilt (including the loaded cards) when needed next time.
+        self.card_index = None
+        self.search_index = None
+        self.due_histogram = None
+        self.cram_sampler = None
+        boxes = self.seq_boxes[first_seq:]
+        scan = self.scheduler.scan(boxes, timestamps)
+        now = self.time_fun()
+        self.seq_dues.extend(scan.due_array())
+        # Expired or (still) pending since loading, see DueIndex.
+        self.seq_states.extend(scan.expired_flags(now))
+        for box, due_index, total, (expired_seqs, pending_seqs) in zip(self.boxes, self.due_indexes, scan.totals(),
+                                                                        scan.box_entries(now, first_seq)):
+            box.count += total
+            due_index.add_bulk(now, expired_seqs, pending_seqs)
+
+    def scan_file(self):
+        """ Reads only boxes and timestamps from the deckfile, without creating any cards. """
+        boxes = array("b")
+        timestamps = array("q")
+        with open(self.filename, "r", encoding=Deck.deckfile_encoding) as f:
+            for line in f:
+                card_spec = line.rstrip()
+                if not card_spec or card_spec.startswith(Deck.comment_leader):
+                    continue
+                fields = FlashCard.parse_card_spec(card_spec)
+                if not fields:
                     raise Deck.CardSpecError("Malformed card spec: " + card_spec)
+                if not 0 <= fields[2] <= self.max_box_num:
+                    raise Deck.CardSpecError("Box number out of range: " + card_spec)
+                boxes.append(fields[2])
+                timestamps.append(fields[3])
+        return self.scheduler.scan(boxes, timestamps)
+
+    def read_card_text(self, line):
+        """ Returns (front, back) of the card in the given deckfile line. Raises DeckfileChangedError
+            if the deckfile has been changed by someone else, as line offsets are stale then; see
+            adopt_changes.
+        """
+        with self.file_lock, open(self.filename, "rb") as f:
+            if self.loaded_signature != Deck.file_signature(self.filename):
+                raise Deck.DeckfileChangedError("Deckfile has been changed by someone else")
+            f.seek(self.line_offsets[line])
+            card_spec = f.readline().decode(Deck.deckfile_encoding).rstrip()
+        fields = FlashCard.parse_card_spec(card_spec)
+        if not fields:
+            raise ValueError("Deckfile changed, malformed card spec in line %d" % (line + 1))
+        return fields[0], fields[1]
 
     def insert_card(self, card, box=-1):
         box = box if box != -1 else card.box
         if box < self.box_count:
+            self.remove_from_box(card)
             card.box = box
-            self.boxes[box].append(card)
+            self.add_to_box(box, card)
+            if self.card_index is not None:
+                self.card_index.add(card)
+            if self.search_index is not None:
+                self.search_index.add(card)
+
+    def index_cards(self):
+        """ Returns CardIndex of all cards, building it on first use. """
+        if self.card_index is None:
+            # Loading the remaining cards may merge changes to the deckfile, which drops the index.
+            card_index = CardIndex()
+            card_index.add_all(self.all_cards())
+            self.card_index = card_index
+        return self.card_index
+
+    def all_cards(self):
+        """ Yields all cards with their texts in memory: loaded cards in deckfile order, then inserted cards. """
+        self.materialize_cards()
+        for line in self.deckfile_lines:
+            if isinstance(line, FlashCard):
+                yield line
+        for card in self.seq_cards:
+            if card is not None and card.line is None:
+                yield card
+
+    def find_cards(self, front, back=None):
+        """ Returns cards with given front (and back, if given), in deckfile order. """
+        return self.index_cards().find(front, back)
+
+    def find_duplicates(self):
+        """ Returns lists of cards sharing the same front. """
+        return self.index_cards().duplicates()
+
+    def search(self, query):
+        """ Returns cards containing all words of query (see SearchIndex), in deckfile order. """
+        if self.search_index is None:
+            # Search is rare, so is the need for regular expressions.
+            from searchindex import SearchIndex  # pylint:disable=import-outside-toplevel
+            search_index = SearchIndex()
+            for card in self.all_cards():
+                search_index.add(card)
+            self.search_index = search_index
+        return self.search_index.search(query)
+
+    def restrict_cram(self, cards):
+        """ Restricts cram mode to the given cards (eg. search results), None lifts the restriction. """
+        self.cram_cards = set(cards) if cards is not None else None
+        self.cram_sampler = None
+
+    def add_to_box(self, box_index, card):
+        self.place_card(box_index, card)
+        due = self.card_due(card)
+        self.due_indexes[box_index].add(card.seq, due)
+        if self.due_histogram is not None:
+            self.due_histogram.add(due)
+        self.dirty_cards.add(card)
+
+    def place_card(self, box_index, card, seq=None):
+        """ Puts card into box, without updating the box's due index. The card gets a new sequence number
+            unless one has been reserved for it (see load_due_only).
+        """
+        if seq is None:
+            seq = len(self.seq_boxes)
+            self.reserve_seq(box_index)
+        self.boxes[box_index].add(seq, card)
+        card.seq = seq
+        card.listener = self.card_listener
+        if self.cram_sampler is not None and (self.cram_cards is None or card in self.cram_cards):
+            self.cram_sampler.add(box_index, seq)
+
+    def reserve_seq(self, box_index, due=DueIndex.removed, state=DueIndex.state_other):
+        """ Allocates the next sequence number, without any card yet. """
+        self.seq_cards.append(None)
+        self.seq_boxes.append(box_index)
+        self.seq_dues.append(due)
+        self.seq_states.append(state)
+
+    def remove_from_box(self, card):
+        """ Removes card from its box. Does nothing if card isn't in any box. """
+        seq = card.seq
+        if seq is not None:
+            box_index = self.seq_boxes[seq]
+            if self.due_histogram is not None:
+                self.due_histogram.remove(self.indexed_due(seq))
+            self.boxes[box_index].remove(seq)
+            self.due_indexes[box_index].remove(seq)
+            if self.cram_sampler is not None:
+                self.cram_sampler.remove(box_index, seq)
+            card.seq = None
+            card.listener = None
+
+    def card_changed(self, card):
+        self.dirty_cards.add(card)
+        due = self.card_due(card)
+        if self.due_histogram is not None:
+            self.due_histogram.remove(self.indexed_due(card.seq))
+            self.due_histogram.add(due)
+        self.due_indexes[self.seq_boxes[card.seq]].update(card.seq, due)
+
+    def indexed_due(self, seq):
+        """ Returns due time a card has been indexed with, None if it never expires. """
+        due = self.seq_dues[seq]
+        return due if due != DueIndex.never else None
+
+    def card_due(self, card):
+        """ Returns point in time when card expires, None if it never expires. """
+        return self.scheduler.due(card.box, card.timestamp)
 
     def restart(self):
         self.current_box_index = 0
 
     def card_expired(self, card, **kwargs):
         time_fun = kwargs['time_fun'] if 'time_fun' in kwargs else self.time_fun
-        return time_fun() - card.timestamp >= self.expiries[card.box] \
-            if card.box < self.max_box_num else False
+        due = self.card_due(card)
+        return due is not None and time_fun() >= due
 
     def get_next_card(self, consume=False):
+        # Texts of lazy cards must come from the deckfile they were loaded from.
+        self.adopt_changes()
+        now = self.time_fun()
+        self.load_due_cards(now)
         starting_box = self.current_box_index
         while True:
-            for current_card_index, card in enumerate(self.boxes[self.current_box_index]):
-                if self.card_expired(card):
-                    self.current_card_index = current_card_index
-                    if consume:
-                        self.consume_current_card()
-                    return card
+            seq = self.due_indexes[self.current_box_index].first_expired(now)
+            if seq is not None:
+                self.current_card_seq = seq
+                card = self.boxes[self.current_box_index].get(seq)
+                if consume:
+                    self.consume_current_card()
+                return card
             self.current_box_index = (self.current_box_index + 1) % self.box_count
             if self.current_box_index == starting_box:
                 break
         # No current card
-        self.current_card_index = None
+        self.current_card_seq = None
         return None
 
-    def get_next_card_cram_mode(self, cram=None, consume=False):
+    def peek_next_card(self):
+        """ Returns card that get_next_card will most likely return once the current card has been
+            answered, without changing anything. Useful for prefetching.
+        """
+        now = self.time_fun()
+        self.load_due_cards(now)
+        for offset in range(self.box_count):
+            box_index = (self.current_box_index + offset) % self.box_count
+            seq = self.due_indexes[box_index].peek_expired(now, self.current_card_seq)
+            if seq is not None:
+                return self.boxes[box_index].get(seq)
+        return None
+
+    def get_next_card_cram_mode(self, cram=None, consume=False, weights=None):
+        """ Returns random card from box cram (-1: all boxes). For cram == -1, weights optionally
+            holds a relative weight per box, to cram some boxes more often than others.
+        """
         assert cram is not None
-        card = None
-        self.current_card_index = None
-
-        # If cram list is empty (or has become empty), create a fresh random
-        # cram list.
-        if not self.cram_list:
-            # Note! In cram mode we even present cards from the last box.
-            if cram == -1:
-                for box_index in range(self.box_count):
-                    if self.boxes[box_index]:
-                        for card_index in range(0, len(self.boxes[box_index])):
-                            self.cram_list.append((box_index, card_index))
-            else:
-                for card_index in range(0, len(self.boxes[cram])):
-                    self.cram_list.append((cram, card_index))
-            random.shuffle(self.cram_list)
-
-        if self.cram_list:
-            self.current_box_index, self.current_card_index = self.cram_list.pop()
-            card = self.boxes[self.current_box_index][self.current_card_index]
-            if consume:
-                self.consume_current_card()
+        # Texts of lazy cards must come from the deckfile they were loaded from; merging drops the sampler.
+        self.adopt_changes()
+        self.current_card_seq = None
+        if self.cram_sampler is None or self.cram_key != (cram, weights if cram == -1 else None):
+            self.start_cram(cram, weights)
+        entry = self.cram_sampler.draw()
+        if entry is None:
+            return None
+        self.current_box_index, self.current_card_seq = entry
+        card = self.boxes[self.current_box_index].get(self.current_card_seq)
+        if consume:
+            self.consume_current_card()
         return card
 
+    def start_cram(self, cram, weights=None):
+        self.load_deferred()
+        # Note! In cram mode we even present cards from the last box.
+        if cram != -1:
+            weights = [1 if box_index == cram else 0 for box_index in range(self.box_count)]
+        self.cram_sampler = CramSampler(self.box_count, self.seq_cards, self.seq_boxes,
+                                        list(weights) if weights is not None else None, self.cram_cards)
+        self.cram_key = (cram, weights if cram == -1 else None)
+
     def consume_current_card(self):
-        if not self.current_card_index is None:
-            self.boxes[self.current_box_index].pop(self.current_card_index)
-        self.current_card_index = None
+        if not self.current_card_seq is None:
+            card = self.boxes[self.current_box_index].get(self.current_card_seq)
+            if card is not None:
+                self.remove_from_box(card)
+        self.current_card_seq = None
 
     def wrong(self, card):
-        card.box = 0
-        card.timestamp = self.time_fun()
-        self.boxes[0].append(card)
-        self.modified = True
+        self.review(card, False)
+        self.log_review(card)
 
     def right(self, card):
-        if card.box < self.box_count - 1:
-            card.box += 1
-        card.timestamp = self.time_fun()
-        self.boxes[card.box].append(card)
+        self.review(card, True)
+        self.log_review(card)
+
+    def review(self, card, correct, timestamp=None):
+        """ Moves card to the box the scheduler picks for the answer, without journaling. """
+        if isinstance(card, LazyFlashCard) and not card.materialized():
+            # Unsaved answers are matched by text when merging concurrent changes, see merge_changes.
+            card.materialize()
+        self.remove_from_box(card)
+        card.box = self.scheduler.next_box(card.box, correct)
+        card.timestamp = timestamp if timestamp is not None else self.time_fun()
+        self.add_to_box(card.box, card)
         self.modified = True
 
+    def apply_reviews(self, reviews):
+        """ Applies many answers in one go, eg. imported from another tool. reviews yields
+            (front, correct, timestamp) tuples, timestamp may be None for now. Cards are found by
+            their front. Nothing gets journaled, as a batch is meant to be followed by a single save.
+            Returns number of applied reviews and list of fronts that don't match any card.
+        """
+        index = self.index_cards()
+        applied = 0
+        unknown = []
+        for front, correct, timestamp in reviews:
+            cards = index.find(front)
+            if not cards:
+                unknown.append(front)
+            else:
+                self.review(cards[0], correct, timestamp)
+                applied += 1
+        return applied, unknown
+
     def get_statistics(self):
-        stats = []
-        for box in self.boxes:
-            expired_total = 0
-            for card in box:
-                expired_total += 1 if self.card_expired(card) else 0
-            stats.append([len(box), expired_total])
-        return stats
+        now = self.time_fun()
+        self.load_due_cards(now)
+        statistics = [[len(box), due_index.count_expired(now)] for box, due_index in zip(self.boxes, self.due_indexes)]
+        if self.deferred is not None:
+            # Deferred cards that have come due are still deferred if the deckfile has been changed since
+            # loading (see load_due_cards), they're expired all the same.
+            for box_statistics, count, due_count in zip(statistics, self.deferred.box_counts,
+                                                        self.deferred.box_due_counts(now)):
+                box_statistics[0] += count
+                box_statistics[1] += due_count
+        return statistics
 
     def next_expiry(self):
         now = self.time_fun()
+        self.load_due_cards(now)
         min_expiry = sys.maxsize
+        if self.deferred is not None and self.deferred.first_due() is not None:
+            min_expiry = max(self.deferred.first_due() - now, 0)
         # Exclude last box.
-        for box_index, box in enumerate(self.boxes[0:-1]):
-            for card in box:
-                expiry = card.timestamp + self.expiries[box_index] - now
-                if expiry < 0:
-                    expiry = 0
-                min_expiry = min(min_expiry, expiry)
+        for due_index in self.due_indexes[0:-1]:
+            due = due_index.next_due(now)
+            if due is not None:
+                min_expiry = min(min_expiry, max(due - now, 0))
         return min_expiry if min_expiry < sys.maxsize else None
 
-    def load_from_file(self):
-        with open(self.filename, "r") as f:
-            card_specs = f.readlines()
-        self.load_from_specs(card_specs)
+    def forecast(self, periods, period):
+        """ Returns number of cards coming due in each of the next periods periods of period seconds;
+            the first period also counts expired cards.
+        """
+        if self.due_histogram is None:
+            from duehistogram import DueHistogram  # pylint:disable=import-outside-toplevel
+            self.due_histogram = DueHistogram()
+            self.due_histogram.add_all(self.seq_dues)
+            if self.deferred is not None:
+                self.due_histogram.add_all(self.deferred.pending_dues())
+        return self.due_histogram.forecast(self.time_fun(), periods, period)
+
+    def load_from_file(self, lazy=False, due_only=False):
+        """ Streams the deckfile line by line. If lazy is set, card texts stay on disk until needed.
+            If due_only is set, only cards due now get loaded, see load_due_only. The binary sidecar, if
+            any, takes precedence over both.
+        """
+        self.loaded_signature = Deck.file_signature(self.filename)
+        compiled = CompiledDeck.open(self.filename, self.loaded_signature) if not self.deckfile_lines else None
+        if not (compiled and self.load_compiled(compiled)):
+            with open(self.filename, "rb") as f:
+                # Journaled answers may refer to any card, so they need all cards loaded.
+                if due_only and not self.deckfile_lines and not os.path.exists(self.journal_path()):
+                    self.load_due_only(self.read_lines(f))
+                elif lazy:
+                    self.load_lazily(self.read_lines(f))
+                else:
+                    self.load_from_specs(self.read_lines(f))
+        # Even outside journal mode, answers journaled earlier must not get lost.
+        self.replay_journal()
+
+    def load_compiled(self, compiled):
+        """ Loads deck from its up-to-date binary sidecar. All cards are lazy, texts stay in the mapping. """
+        if max(compiled.boxes, default=-1) > self.max_box_num:
+            compiled.close()
+            return False
+        self.compiled = compiled
+        first_seq = len(self.seq_boxes)
+        read_text = compiled.text
+        deckfile_lines, seq_cards = self.deckfile_lines, self.seq_cards
+        listener = self.card_listener
+        # Same as load_lazily, with boxes and timestamps straight from the sidecar.
+        try:
+            for line, (box, timestamp) in enumerate(zip(compiled.boxes, compiled.timestamps)):
+                if box < 0:
+                    deckfile_lines.append(read_text(line)[0])
+                    seq_cards.append(None)
+                else:
+                    seq = len(seq_cards)
+                    if seq == line:
+                        line = seq
+                    card = LazyFlashCard(read_text, line, box, timestamp, seq, listener)
+                    deckfile_lines.append(card)
+                    seq_cards.append(card)
+        finally:
+            line_count = len(seq_cards) - first_seq
+            self.seq_boxes.frombytes(compiled.boxes[:line_count])
+            self.index_loaded_cards(first_seq, compiled.timestamps[:line_count])
+        self.line_offsets = array("q", compiled.line_offsets)
+        return True
+
+    def compile(self):
+        """ Writes binary sidecar of the deckfile, see CompiledDeck. """
+        # Sidecar must match the deckfile, so save pending changes first.
+        self.save_to_file()
+        self.materialize_cards()
+        lines = ((line.box, line.timestamp, line.front, line.back) if isinstance(line, FlashCard) else (-1, 0, line, "")
+                 for line in self.deckfile_lines)
+        CompiledDeck.write(self.filename, self.loaded_signature, lines, self.line_offsets)
+
+    def persist(self):
+        """ Makes answers persistent at the end of a session. """
+        if self.journal_enabled and self.journal is not None:
+            # Answers are in the journal already, only compact if it has grown too big.
+            if self.journal_entries >= Deck.journal_threshold:
+                self.save_to_file()
+            self.journal.close()
+        else:
+            self.save_to_file()
+
+    def journal_path(self):
+        return self.journal.path()
+
+    @property
+    def journal_entries(self):
+        """ Number of answers in the journal that aren't in the deckfile yet. """
+        return self.journal.entries if self.journal is not None else 0
+
+    def log_review(self, card):
+        """ Appends new box and timestamp of a card to the journal, compacting the journal if necessary. """
+        if not (self.journal_enabled and self.journal is not None and card.line is not None):
+            return
+        self.journal.append(card.line, card.front, card.box, card.timestamp)
+        if self.journal.entries >= Deck.journal_threshold and not self.saving:
+            self.save_to_file()
+
+    def replay_journal(self):
+        """ Applies journaled answers, eg. of sessions that were cancelled or crashed. Answers older
+            than a card's timestamp are skipped, they've been superseded (eg. by a session that didn't
+            remove the journal, as it had entries of another session still running).
+        """
+        if self.journal is None:
+            return
+        cards_by_front = None
+        for line, front, box, timestamp in self.journal.read():
+            card = self.deckfile_lines[line] if 0 <= line < len(self.deckfile_lines) else None
+            # Deckfile has been edited since, find card by its front.
+            if not isinstance(card, FlashCard) or card.front != front:
+                if cards_by_front is None:
+                    cards_by_front = {}
+                    for deckfile_line in reversed(self.deckfile_lines):
+                        if isinstance(deckfile_line, FlashCard):
+                            cards_by_front[deckfile_line.front] = deckfile_line
+                card = cards_by_front.get(front)
+            if card is not None and 0 <= box <= self.max_box_num and timestamp >= card.timestamp:
+                self.remove_from_box(card)
+                card.box = box
+                card.timestamp = timestamp
+                self.add_to_box(box, card)
+                self.modified = True
 
     def save_to_file(self):
         if self.filename and self.modified:
-            with open(self.filename, "w") as f:
-                for deckfile_line in self.deckfile_lines:
-                    if isinstance(deckfile_line, FlashCard):
-                        f.write(deckfile_line.to_card_spec() + "\n")
-                    elif isinstance(deckfile_line, str):
-                        f.write(deckfile_line + "\n")
-                    else:
-                        pass
+            # Other flashme processes wait, changes they (or an editor) made meanwhile get merged.
+            with DeckLock(self.filename):
+                if self.loaded_signature and self.loaded_signature != Deck.file_signature(self.filename):
+                    self.merge_changes()
+                if self.incremental_save_possible():
+                    changes = self.serialize_changes()
+                    signature = self.loaded_signature
+                    self.write_atomically(lambda f: self.write_changes(f, changes))
+                    self.patch_compiled(signature, changes)
+                else:
+                    self.materialize_cards()
+                    self.write_atomically(self.write_all)
+                # Deckfile is up to date, journaled answers are no longer needed.
+                self.journal.discard()
+            self.dirty_cards.clear()
+            self.modified = False
+
+    def patch_compiled(self, signature, changes):
+        """ Carries changes (see serialize_changes), just written to the deckfile that had the given
+            signature before, over to the binary sidecar. A sidecar that was stale already stays stale,
+            see CompiledDeck.patch.
+        """
+        records = []
+        for line, encoded_line in changes:
+            _, _, box, timestamp = FlashCard.scan_card_spec(encoded_line.decode(Deck.deckfile_encoding).rstrip())
+            records.append((line, box, timestamp))
+        CompiledDeck.patch(self.filename, signature, self.loaded_signature, records, self.line_offsets)
+
+    def adopt_changes(self):
+        """ Merges changes someone else made to the deckfile since it was loaded (see merge_changes).
+            Returns True if there were any.
+        """
+        changed = self.deckfile_changed()
+        if changed:
+            # Waits for a background save to finish; that one fails, see write_snapshot.
+            with DeckLock(self.filename):
+                self.merge_changes()
+        return changed
+
+    def deckfile_changed(self):
+        """ Returns True if someone else has changed the deckfile since it was loaded (or last saved). """
+        if not self.loaded_signature:
+            return False
+        with self.file_lock:
+            return self.loaded_signature != Deck.file_signature(self.filename)
+
+    def merge_changes(self):
+        """ Adopts the deckfile as changed by someone else since it was loaded, keeping unsaved answers,
+            see DeckMerge.
+        """
+        signature = Deck.file_signature(self.filename)
+        with open(self.filename, "rb") as f:
+            lines = list(self.read_lines(f))
+        # Cards may change boxes (and thus sequence numbers), the current card is found again below.
+        current_card = self.boxes[self.current_box_index].get(self.current_card_seq) \
+            if self.current_card_seq is not None else None
+        # Lines that haven't been loaded (None) are unchanged, the deckfile's version of them gets loaded.
+        self.deferred = None
+        self.deckfile_lines = DeckMerge(self).merge(lines)
+        self.loaded_signature = signature
+        if current_card is not None and current_card.seq is not None:
+            self.current_box_index, self.current_card_seq = self.seq_boxes[current_card.seq], current_card.seq
+        else:
+            self.current_card_seq = None
+        self.card_index = None
+        self.search_index = None
+        self.due_histogram = None
+        self.cram_sampler = None
+
+    def incremental_save_possible(self):
+        # Unless the deckfile has changed behind our back, only dirty cards need to be serialized.
+        return self.loaded_signature and self.loaded_signature == Deck.file_signature(self.filename) \
+            and len(self.line_offsets) == len(self.deckfile_lines) + 1
+
+    def start_save(self):
+        """ Saving in the background, step 1 (in the thread that owns the deck): serializes dirty cards.
+            Returns snapshot for write_snapshot, None if there's nothing to save or the deckfile needs to be
+            rewritten completely (which only save_to_file does).
+        """
+        if self.saving or not (self.filename and self.modified and self.incremental_save_possible()):
+            return None
+        snapshot = (self.serialize_changes(), self.dirty_cards, self.journal_entries, self.loaded_signature)
+        # Cards answered from now on go into the next save.
+        self.dirty_cards = set()
+        self.modified = False
+        self.saving = True
+        return snapshot
+
+    def write_snapshot(self, snapshot):
+        """ Saving in the background, step 2 (in any thread): writes the deckfile. Raises
+            DeckfileChangedError if the deckfile has been changed by someone else; merging
+            that is left to save_to_file.
+        """
+        changes, signature = snapshot[0], snapshot[3]
+        with DeckLock(self.filename):
+            # Changes refer to the deckfile as it was when they were serialized, even if it has been merged since.
+            if signature != Deck.file_signature(self.filename):
+                raise Deck.DeckfileChangedError("Deckfile has been changed by someone else")
+            self.write_atomically(lambda f: self.write_changes(f, changes))
+            self.patch_compiled(signature, changes)
+
+    def finish_save(self, snapshot, error=None):
+        """ Saving in the background, step 3 (in the thread that owns the deck). Pass the exception
+            if write_snapshot has failed; its cards will be saved next time then.
+        """
+        _, dirty_cards, journal_entries, _ = snapshot
+        self.saving = False
+        if error is not None:
+            self.dirty_cards |= dirty_cards
+            self.modified = True
+            return
+        # Journal can't go if it has answers that aren't in the deckfile. Replaying the others is harmless.
+        if self.journal_entries == journal_entries:
+            with DeckLock(self.filename):
+                self.journal.discard()
+
+    def serialize_changes(self):
+        """ Returns (deckfile line, encoded line) of dirty cards, ordered by line. """
+        lines = self.deckfile_lines
+        dirty_lines = sorted(card.line for card in self.dirty_cards
+                             if card.line is not None and card.line < len(lines) and lines[card.line] is card)
+        lazy_cards = [self.deckfile_lines[i] for i in dirty_lines if isinstance(self.deckfile_lines[i], LazyFlashCard)
+                      and not self.deckfile_lines[i].materialized()]
+        if lazy_cards:
+            with self.file_lock, open(self.filename, "rb") as f:
+                for card in lazy_cards:
+                    f.seek(self.line_offsets[card.line])
+                    card.materialize(f.readline().decode(Deck.deckfile_encoding).rstrip())
+        return [(i, (self.deckfile_lines[i].to_card_spec() + "\n").encode(Deck.deckfile_encoding)) for i in dirty_lines]
+
+    def write_all(self, f):
+        line_offsets = array("q", [0])
+        for deckfile_line in self.deckfile_lines:
+            if isinstance(deckfile_line, FlashCard):
+                line = (deckfile_line.to_card_spec() + "\n").encode(Deck.deckfile_encoding)
+            else:
+                line = (deckfile_line + "\n").encode(Deck.deckfile_encoding)
+            f.write(line)
+            line_offsets.append(line_offsets[-1] + len(line))
+        return line_offsets
+
+    def write_changes(self, f, changes):
+        """ Writes changed lines (see serialize_changes); everything in between is copied verbatim from
+            the current deckfile. Returns new line offsets.
+        """
+        offsets = self.line_offsets
+        new_offsets = array("q")
+        shift = 0
+        with open(self.filename, "rb") as old_f:
+            for i, line in changes:
+                start, end = offsets[i], offsets[i + 1]
+                Deck.copy_bytes(old_f, f, start - old_f.tell())
+                old_f.seek(end)
+                f.write(line)
+                Deck.extend_offsets(new_offsets, offsets[len(new_offsets):i + 1], shift)
+                shift += len(line) - (end - start)
+            Deck.copy_bytes(old_f, f)
+        Deck.extend_offsets(new_offsets, offsets[len(new_offsets):], shift)
+        return new_offsets
+
+    @staticmethod
+    def extend_offsets(offsets, more_offsets, shift):
+        offsets.extend(more_offsets if not shift else array("q", (offset + shift for offset in more_offsets)))
+
+    @staticmethod
+    def copy_bytes(src, dst, count=-1):
+        chunk_size = 1024 * 1024
+        while count:
+            chunk = src.read(chunk_size if count < 0 else min(chunk_size, count))
+            if not chunk:
+                break
+            dst.write(chunk)
+            if count > 0:
+                count -= len(chunk)
+
+    def write_atomically(self, write_fun):
+        """ Writes deckfile via a temp file, so a crash never leaves a half-written deckfile behind.
+            write_fun returns the new line offsets, which get recorded along with the new deckfile signature.
+        """
+        import tempfile  # pylint:disable=import-outside-toplevel
+        path = os.path.realpath(self.filename)
+        dir_name, base_name = os.path.split(path)
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=dir_name, prefix="." + base_name + ".", suffix=".tmp")
+        except OSError:
+            # Deckfile directory not writable, fall back to overwriting in place.
+            self.materialize_cards()
+            with self.file_lock:
+                with open(path, "wb") as f:
+                    self.line_offsets = self.write_all(f)
+                self.loaded_signature = Deck.file_signature(self.filename)
+            return
+        try:
+            with os.fdopen(fd, "wb") as f:
+                line_offsets = write_fun(f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(tmp_path, stat.S_IMODE(os.stat(path).st_mode))
+            with self.file_lock:
+                os.replace(tmp_path, path)
+                self.line_offsets = line_offsets
+                self.loaded_signature = Deck.file_signature(self.filename)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        Deck.fsync_dir(dir_name)
+
+    @staticmethod
+    def fsync_dir(dir_name):
+        try:
+            fd = os.open(dir_name, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def file_signature(filename):
+        """ Returns (inode, size, mtime) of a file, which changes whenever the file is rewritten. """
+        st = os.stat(filename)
+        return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+    def materialize_cards(self):
+        """ Reads texts of all lazy cards in one go, eg. before the deckfile gets overwritten. """
+        self.load_deferred()
+        lazy_cards = [line for line in self.deckfile_lines
+                      if isinstance(line, LazyFlashCard) and not line.materialized()]
+        if lazy_cards:
+            with open(self.filename, "rb") as f:
+                data = f.read()
+            for card in lazy_cards:
+                start, end = self.line_offsets[card.line], self.line_offsets[card.line + 1]
+                card.materialize(data[start:end].decode(Deck.deckfile_encoding).rstrip())
 
     @staticmethod
     def locate_file(filename):
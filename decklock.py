@@ -0,0 +1,58 @@
+import hashlib
+import os
+import os.path
+
+try:
+    import fcntl
+except ImportError:
+    # Eg. Windows: no advisory locking.
+    fcntl = None
+
+class DeckLock:
+    """ Advisory exclusive lock on a deckfile, held by flashme processes while they read, merge and
+        rewrite it. Locks a separate lock file, as saving replaces the deckfile (and thus its inode).
+        Lock files live in the user's runtime directory (or cache directory), named after the
+        deckfile's real path, so deckfile directories stay clean. Where locking isn't available (no
+        fcntl, lock file can't be created), it's a no-op: saving still detects concurrent changes,
+        see Deck.merge_changes.
+    """
+
+    suffix = ".lock"
+    xdg_runtime_dir_env_string = "XDG_RUNTIME_DIR"
+    xdg_cache_home_env_string = "XDG_CACHE_HOME"
+
+    def __init__(self, deckfile):
+        self.path = DeckLock.lock_path(deckfile)
+        self.fd = None
+
+    @staticmethod
+    def lock_dir():
+        runtime_dir = os.environ.get(DeckLock.xdg_runtime_dir_env_string)
+        if runtime_dir:
+            return os.path.join(runtime_dir, "flashme")
+        cache_home = os.environ.get(DeckLock.xdg_cache_home_env_string) or \
+            os.path.join(os.path.expanduser("~"), ".cache")
+        return os.path.join(cache_home, "flashme", "locks")
+
+    @staticmethod
+    def lock_path(deckfile):
+        """ Returns path of the lock file of deckfile; all names of a deckfile share it. """
+        key = hashlib.sha1(os.path.realpath(deckfile).encode("utf-8")).hexdigest()
+        return os.path.join(DeckLock.lock_dir(), key + DeckLock.suffix)
+
+    def __enter__(self):
+        if fcntl is not None:
+            try:
+                os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+                self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            except OSError:
+                return self
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.fd is not None:
+            # The lock file stays: removing it would let a waiting process lock a file nobody else sees.
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
@@ -0,0 +1,96 @@
+from flashcard import FlashCard, LazyFlashCard
+
+class DeckMerge:
+    """ Merges a deckfile, as changed by someone else since the deck loaded it, into the deck, keeping
+        the deck's unsaved answers. Cards are matched by front and back (front only, if the back has
+        been edited). Where both sides have answered a card, the later answer wins. Cards that are
+        unchanged stay as they are; cards that are gone from the deckfile are dropped. Lazy cards whose
+        text hasn't been read yet can't be matched, they get replaced by cards read from the deckfile.
+    """
+
+    def __init__(self, deck):
+        self.deck = deck
+        # Cards of the deck that haven't been matched yet, by (front, back).
+        self.by_text = {}
+        for card in deck.deckfile_lines:
+            if isinstance(card, FlashCard) and not (isinstance(card, LazyFlashCard) and not card.materialized()):
+                self.by_text.setdefault((card.front, card.back), []).append(card)
+
+    def merge(self, lines):
+        """ Merges the deckfile's lines into the deck, returns the deck's new deckfile lines. """
+        deckfile_lines, new_lines = self.match_texts(lines)
+        self.match_fronts(deckfile_lines, new_lines)
+        self.drop_unmatched(deckfile_lines)
+        return deckfile_lines
+
+    def match_texts(self, lines):
+        """ Returns deckfile lines with the cards matched by front and back, and the indexes of lines
+            holding (front, back, box, timestamp) of cards that couldn't be matched that way.
+        """
+        deck = self.deck
+        deckfile_lines = []
+        new_lines = []
+        for line in lines:
+            card_spec = line.rstrip()
+            fields = FlashCard.parse_card_spec(card_spec) \
+                if card_spec and not card_spec.startswith(deck.comment_leader) else None
+            if not fields or not 0 <= fields[2] <= deck.max_box_num:
+                # Comment, or a line that doesn't make sense to us: keep it as it is.
+                deckfile_lines.append(card_spec)
+                continue
+            cards = self.by_text.get((fields[0], fields[1]))
+            if cards:
+                card = cards.pop(0)
+                self.merge_card(card, fields[2], fields[3])
+                deckfile_lines.append(card)
+            else:
+                new_lines.append(len(deckfile_lines))
+                deckfile_lines.append(fields)
+        return deckfile_lines, new_lines
+
+    def match_fronts(self, deckfile_lines, new_lines):
+        """ Matches the remaining cards by front (their back has been edited), adds the others as new cards. """
+        deck = self.deck
+        by_front = {}
+        for cards in self.by_text.values():
+            for card in cards:
+                by_front.setdefault(card.front, []).append(card)
+        for line in new_lines:
+            front, back, box, timestamp = deckfile_lines[line]
+            cards = by_front.get(front)
+            if cards:
+                card = cards.pop(0)
+                card.back = back
+                self.merge_card(card, box, timestamp)
+            else:
+                card = FlashCard(front, back, box, timestamp)
+                deck.add_to_box(box, card)
+                deck.dirty_cards.discard(card)
+            deckfile_lines[line] = card
+
+    def drop_unmatched(self, deckfile_lines):
+        """ Renumbers the cards' deckfile lines, drops cards that are gone from the deckfile. """
+        deck = self.deck
+        kept = set()
+        for line, card in enumerate(deckfile_lines):
+            if isinstance(card, FlashCard):
+                card.line = line
+                kept.add(card)
+        for card in deck.deckfile_lines:
+            if isinstance(card, FlashCard) and card not in kept:
+                deck.remove_from_box(card)
+                deck.dirty_cards.discard(card)
+                card.line = None
+
+    def merge_card(self, card, box, timestamp):
+        """ Merges box and timestamp found in the deckfile into card. """
+        deck = self.deck
+        if card in deck.dirty_cards and card.timestamp >= timestamp:
+            # Our answer is the later one, it'll be saved.
+            return
+        if (card.box, card.timestamp) != (box, timestamp):
+            deck.remove_from_box(card)
+            card.box = box
+            card.timestamp = timestamp
+            deck.add_to_box(box, card)
+        deck.dirty_cards.discard(card)
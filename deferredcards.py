@@ -0,0 +1,82 @@
+import bisect
+from array import array
+
+from dueindex import DueIndex
+from expiry import ExpiryScan
+
+class DeferredCards:
+    """ Compact records of cards that weren't due when the deck was loaded (see Deck.load_due_only):
+        deckfile line, reserved sequence number, box and due time, kept in arrays sorted by due time.
+        No card objects exist for them until they come due, so memory tracks the number of due cards
+        rather than the deck size.
+        Records are taken in due order; cards in the last box (never due) come last.
+    """
+
+    def __init__(self, box_count):
+        self.lines = array("q")
+        self.seqs = array("q")
+        self.boxes = array("b")
+        self.dues = array("q")
+        # Number of records per box not taken yet.
+        self.box_counts = [0] * box_count
+        # Records before this one have been taken.
+        self.taken = 0
+
+    def __len__(self):
+        return len(self.dues) - self.taken
+
+    def add(self, line, seq, box, due):
+        """ Records a card; call sort once all cards are recorded. due is None if it never expires. """
+        self.lines.append(line)
+        self.seqs.append(seq)
+        self.boxes.append(box)
+        self.dues.append(due if due is not None else DueIndex.never)
+        self.box_counts[box] += 1
+
+    def sort(self):
+        if ExpiryScan.numpy_for(len(self.dues)):
+            import numpy  # pylint:disable=import-outside-toplevel
+            order = numpy.argsort(numpy.frombuffer(self.dues, dtype=numpy.int64), kind="stable")
+            self.lines = array("q", numpy.frombuffer(self.lines, dtype=numpy.int64)[order].tobytes())
+            self.seqs = array("q", numpy.frombuffer(self.seqs, dtype=numpy.int64)[order].tobytes())
+            self.boxes = array("b", numpy.frombuffer(self.boxes, dtype=numpy.int8)[order].tobytes())
+            self.dues = array("q", numpy.frombuffer(self.dues, dtype=numpy.int64)[order].tobytes())
+        else:
+            order = sorted(range(len(self.dues)), key=self.dues.__getitem__)
+            self.lines = array("q", (self.lines[i] for i in order))
+            self.seqs = array("q", (self.seqs[i] for i in order))
+            self.boxes = array("b", (self.boxes[i] for i in order))
+            self.dues = array("q", (self.dues[i] for i in order))
+
+    def first_due(self):
+        """ Returns earliest due time of the records not taken yet, None if none of them ever expires. """
+        if self.taken < len(self.dues) and self.dues[self.taken] != DueIndex.never:
+            return self.dues[self.taken]
+        return None
+
+    def box_due_counts(self, now):
+        """ Returns number of records per box not taken yet that are due at now. """
+        counts = [0] * len(self.box_counts)
+        for box in self.boxes[self.taken:bisect.bisect_right(self.dues, now, self.taken)]:
+            counts[box] += 1
+        return counts
+
+    def pending_dues(self):
+        """ Returns due times of the records not taken yet (DueIndex.never for those never due). """
+        return self.dues[self.taken:]
+
+    def take_due(self, now):
+        """ Returns (deckfile line, sequence number) of the records due at now, which are no longer
+            counted then.
+        """
+        return self.take(bisect.bisect_right(self.dues, now, self.taken))
+
+    def take_all(self):
+        return self.take(len(self.dues))
+
+    def take(self, end):
+        for box in self.boxes[self.taken:end]:
+            self.box_counts[box] -= 1
+        records = list(zip(self.lines[self.taken:end], self.seqs[self.taken:end]))
+        self.taken = end
+        return records
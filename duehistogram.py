@@ -0,0 +1,56 @@
+from array import array
+
+from dueindex import DueIndex
+from expiry import ExpiryScan
+
+class DueHistogram:
+    """ Number of cards coming due per hour, for forecasting review load. Buckets are sparse
+        (a dict from bucket number to card count), so the histogram stays small no matter how far
+        due times are spread. Forecasts are accurate to the bucket width.
+    """
+
+    # Seconds per bucket.
+    bucket_width = 60 * 60
+
+    def __init__(self):
+        self.counts = {}
+
+    def add(self, due, count=1):
+        """ Counts a card coming due at due; None (never due) is ignored. """
+        if due is None:
+            return
+        bucket = due // DueHistogram.bucket_width
+        total = self.counts.get(bucket, 0) + count
+        if total:
+            self.counts[bucket] = total
+        else:
+            del self.counts[bucket]
+
+    def remove(self, due):
+        self.add(due, -1)
+
+    def add_all(self, dues):
+        """ Counts all due times in array dues at once, skipping DueIndex markers. """
+        if ExpiryScan.numpy_for(len(dues)):
+            import numpy  # pylint:disable=import-outside-toplevel
+            # Copy, as arrays can't grow while NumPy looks at their buffer.
+            dues = numpy.frombuffer(array("q", dues), dtype=numpy.int64)
+            dues = dues[(dues != DueIndex.never) & (dues != DueIndex.removed)]
+            buckets, counts = numpy.unique(dues // DueHistogram.bucket_width, return_counts=True)
+            for bucket, count in zip(buckets.tolist(), counts.tolist()):
+                self.counts[bucket] = self.counts.get(bucket, 0) + count
+        else:
+            for due in dues:
+                if due not in (DueIndex.never, DueIndex.removed):
+                    self.add(due)
+
+    def forecast(self, now, periods, period):
+        """ Returns number of cards coming due in each of the next periods periods of period seconds.
+            The first period also counts cards that are due already.
+        """
+        counts = [0] * periods
+        for bucket, count in self.counts.items():
+            index = max((bucket * DueHistogram.bucket_width - now) // period, 0)
+            if index < periods:
+                counts[index] += count
+        return counts
@@ -0,0 +1,217 @@
+import heapq
+import sys
+from array import array
+
+# pylint:disable=too-many-instance-attributes
+class DueIndex:
+    """ Expiry index over the cards of a single box.
+        Cards are keyed by a sequence number that grows with every insertion, so ascending
+        sequence numbers reflect box order. Due times and card states live in arrays indexed by
+        sequence number that are shared by all boxes of a deck.
+        Cards loaded in bulk (see add_bulk) are kept in two arrays of sequence numbers, expired
+        ones in box order and pending ones in due order, which are consumed from the front as
+        time passes. Cards added one at a time (eg. answered ones) go into heaps: pending ones
+        ordered by due time, expired ones by sequence number. To save memory, pending heap items
+        pack due time and sequence number into a single int. Either way, the first expired card
+        (in box order) is found in O(log n), and a loaded card costs just a few bytes.
+        Answering a card doesn't touch the arrays, it just changes the card's state, so array
+        entries of cards whose state no longer matches are skipped.
+    """
+
+    seq_bits = 32
+    seq_mask = (1 << seq_bits) - 1
+
+    # Due time markers for cards that never expire and cards that have left the box.
+    never = sys.maxsize
+    removed = -sys.maxsize - 1
+
+    # Card states: pending and in the bulk array since loading, expired, or anything else
+    # (pending in the heap, never due, or removed).
+    state_loaded = 0
+    state_expired = 1
+    state_other = 2
+
+    # Beyond this many cards expiring at once, partition the pending heap in a single pass.
+    bulk_threshold = 64
+
+    def __init__(self, dues, states):
+        self.dues = dues
+        self.states = states
+        self.pending = []
+        self.expired = []
+        # Sequence numbers of cards loaded in bulk, consumed from the given positions on.
+        self.loaded_pending = array("I")
+        self.loaded_pending_position = 0
+        self.loaded_expired = array("I")
+        self.loaded_expired_position = 0
+        self.expired_count = 0
+        self.now = None
+
+    def add(self, seq, due):
+        self.states[seq] = DueIndex.state_other
+        # Cards without due time (last box) never expire.
+        if due is None:
+            self.dues[seq] = DueIndex.never
+        else:
+            self.dues[seq] = due
+            heapq.heappush(self.pending, (due << DueIndex.seq_bits) | seq)
+
+    def add_bulk(self, now, expired_seqs, pending_seqs):
+        """ Adds many cards at once, which must have been classified as expired or pending at the given
+            point in time: expired_seqs in ascending order, pending_seqs (arrays of sequence numbers)
+            ordered by due time. Their due times and states (expired or loaded) must already be set.
+            Sequence numbers must be greater than those of all cards added so far.
+        """
+        self.advance(now)
+        self.expired_count += len(expired_seqs)
+        self.loaded_expired = self.loaded_expired[self.loaded_expired_position:]
+        self.loaded_expired.extend(expired_seqs)
+        self.loaded_expired_position = 0
+        if self.loaded_pending_position < len(self.loaded_pending):
+            pending_seqs = sorted(self.loaded_pending[self.loaded_pending_position:] + pending_seqs,
+                                  key=self.dues.__getitem__)
+        self.loaded_pending = array("I", pending_seqs)
+        self.loaded_pending_position = 0
+
+    def remove(self, seq):
+        if self.states[seq] == DueIndex.state_expired:
+            self.expired_count -= 1
+        self.states[seq] = DueIndex.state_other
+        self.dues[seq] = DueIndex.removed
+
+    def update(self, seq, due):
+        self.remove(seq)
+        self.add(seq, due)
+
+    def advance(self, now):
+        if self.now is not None and now < self.now:
+            self.rewind()
+        expired_seqs = self.expire_loaded(now)
+        pending = self.pending
+        limit = (now << DueIndex.seq_bits) | DueIndex.seq_mask
+        popped = 0
+        while pending and pending[0] <= limit:
+            if popped == DueIndex.bulk_threshold:
+                self.expire_bulk(limit, expired_seqs)
+                break
+            key = heapq.heappop(pending)
+            due, seq = key >> DueIndex.seq_bits, key & DueIndex.seq_mask
+            popped += 1
+            # Skip stale heap items of removed or rescheduled cards.
+            if self.dues[seq] == due and self.states[seq] == DueIndex.state_other:
+                self.states[seq] = DueIndex.state_expired
+                expired_seqs.append(seq)
+        if expired_seqs:
+            self.expired_count += len(expired_seqs)
+            if len(expired_seqs) > DueIndex.bulk_threshold:
+                self.expired.extend(expired_seqs)
+                heapq.heapify(self.expired)
+            else:
+                for seq in expired_seqs:
+                    heapq.heappush(self.expired, seq)
+        self.now = now
+
+    def expire_loaded(self, now):
+        """ Marks loaded cards that are due at now as expired, returns their sequence numbers. """
+        expired_seqs = []
+        loaded_pending, position = self.loaded_pending, self.loaded_pending_position
+        dues, states = self.dues, self.states
+        while position < len(loaded_pending):
+            seq = loaded_pending[position]
+            # Cards that have been answered or removed since loading are elsewhere.
+            if states[seq] == DueIndex.state_loaded:
+                if dues[seq] > now:
+                    break
+                states[seq] = DueIndex.state_expired
+                expired_seqs.append(seq)
+            position += 1
+        self.loaded_pending_position = position
+        return expired_seqs
+
+    def expire_bulk(self, limit, expired_seqs):
+        dues = self.dues
+        states = self.states
+        seq_bits, seq_mask = DueIndex.seq_bits, DueIndex.seq_mask
+        remaining = []
+        for key in self.pending:
+            if key <= limit:
+                seq = key & seq_mask
+                if dues[seq] == key >> seq_bits and states[seq] == DueIndex.state_other:
+                    states[seq] = DueIndex.state_expired
+                    expired_seqs.append(seq)
+            else:
+                remaining.append(key)
+        heapq.heapify(remaining)
+        self.pending = remaining
+
+    def rewind(self):
+        # Time went backwards: expired cards need to be re-examined.
+        for seq in self.expired + self.loaded_expired[self.loaded_expired_position:].tolist():
+            if self.states[seq] == DueIndex.state_expired:
+                self.states[seq] = DueIndex.state_other
+                heapq.heappush(self.pending, (self.dues[seq] << DueIndex.seq_bits) | seq)
+        self.expired = []
+        self.loaded_expired = array("I")
+        self.loaded_expired_position = 0
+        self.expired_count = 0
+
+    def first_expired(self, now):
+        """ Returns sequence number of first expired card, None if no card has expired. """
+        self.advance(now)
+        states = self.states
+        expired = self.expired
+        while expired and states[expired[0]] != DueIndex.state_expired:
+            heapq.heappop(expired)
+        loaded_expired, position = self.loaded_expired, self.loaded_expired_position
+        while position < len(loaded_expired) and states[loaded_expired[position]] != DueIndex.state_expired:
+            position += 1
+        self.loaded_expired_position = position
+        seqs = expired[:1] + loaded_expired[position:position + 1].tolist()
+        return min(seqs) if seqs else None
+
+    def peek_expired(self, now, skip_seq=None):
+        """ Returns sequence number of first expired card other than skip_seq, None if there's none.
+            Unlike first_expired, doesn't drop stale entries, so it's safe to call any time.
+        """
+        self.advance(now)
+        states = self.states
+        expired = self.expired
+        first_seq = None
+        # Visit heap nodes in ascending order, starting at the root.
+        candidates = [(expired[0], 0)] if expired else []
+        while candidates:
+            seq, position = heapq.heappop(candidates)
+            if seq != skip_seq and states[seq] == DueIndex.state_expired:
+                first_seq = seq
+                break
+            for child in (2 * position + 1, 2 * position + 2):
+                if child < len(expired):
+                    heapq.heappush(candidates, (expired[child], child))
+        for position in range(self.loaded_expired_position, len(self.loaded_expired)):
+            seq = self.loaded_expired[position]
+            if first_seq is not None and seq > first_seq:
+                break
+            if seq != skip_seq and states[seq] == DueIndex.state_expired:
+                return seq
+        return first_seq
+
+    def count_expired(self, now):
+        self.advance(now)
+        return self.expired_count
+
+    def next_due(self, now):
+        """ Returns earliest due time, None if no card in this box will ever expire. """
+        self.advance(now)
+        if self.expired_count:
+            return now
+        pending = self.pending
+        while pending:
+            due, seq = pending[0] >> DueIndex.seq_bits, pending[0] & DueIndex.seq_mask
+            if self.dues[seq] == due and self.states[seq] == DueIndex.state_other:
+                break
+            heapq.heappop(pending)
+        dues = [pending[0] >> DueIndex.seq_bits] if pending else []
+        # advance stopped at the first loaded card that is still pending.
+        if self.loaded_pending_position < len(self.loaded_pending):
+            dues.append(self.dues[self.loaded_pending[self.loaded_pending_position]])
+        return min(dues) if dues else None
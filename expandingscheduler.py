@@ -0,0 +1,26 @@
+from scheduler import LeitnerScheduler, SECS_PER_DAY
+
+class ExpandingScheduler(LeitnerScheduler):
+    """ Expanding intervals: the first review is due after a day, the second after six days, and
+        from then on each interval is ease times the previous one (1, 6, 15, 37.5 days, ...). These
+        are the intervals SM-2 starts out with, but a deckfile only records box and timestamp, so
+        there's no per-card ease factor: all cards share the same intervals, one per box.
+        A wrong answer doesn't wipe out all progress: the card drops lapse_boxes boxes. The last box
+        never expires, as with Leitner.
+    """
+
+    name = "expanding"
+    ease = 2.5
+    lapse_boxes = 2
+
+    def __init__(self, box_count):
+        expiries = [0]
+        interval_days = 1
+        while len(expiries) < box_count - 1:
+            expiries.append(int(interval_days * SECS_PER_DAY))
+            interval_days = 6 if interval_days == 1 else interval_days * ExpandingScheduler.ease
+        # Last box never expires.
+        super().__init__(expiries[:box_count - 1] + [-1])
+
+    def next_box(self, box, correct):
+        return min(box + 1, self.max_box_num) if correct else max(box - ExpandingScheduler.lapse_boxes, 0)
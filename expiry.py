@@ -0,0 +1,177 @@
+import bisect
+import importlib.util
+import sys
+from array import array
+
+# Imported on first use only, as importing NumPy takes longer than answering most queries.
+numpy = None  # pylint:disable=invalid-name
+
+class ExpiryScan:
+    """ Evaluates expiry for many cards at once, given their boxes and timestamps as arrays.
+        Uses vectorized NumPy operations for many cards if NumPy is installed, plain Python otherwise.
+        A negative box marks a deckfile line without a card (eg. a comment), which is never due.
+    """
+
+    numpy_installed = importlib.util.find_spec("numpy") is not None
+    # Below this many cards, plain Python is faster than importing NumPy (and converting to its arrays).
+    numpy_threshold = 50000
+
+    # Due time of cards in the last box, which never expire.
+    never = sys.maxsize
+
+    def __init__(self, boxes, timestamps, expiries):
+        assert len(boxes) == len(timestamps)
+        self.box_count = len(expiries)
+        self.expiries = expiries
+        self.use_numpy = ExpiryScan.numpy_for(len(boxes))
+        if self.use_numpy:
+            self.boxes = numpy.asarray(boxes, dtype=numpy.int64)
+            self.timestamps = numpy.asarray(timestamps, dtype=numpy.int64)
+            # Last box never expires.
+            box_expiries = numpy.array(list(expiries[:-1]) + [0], dtype=numpy.int64)
+            self.dues = numpy.where((self.boxes >= 0) & (self.boxes < self.box_count - 1),
+                                    self.timestamps + box_expiries[self.boxes], ExpiryScan.never)
+        else:
+            self.boxes = boxes
+            self.timestamps = timestamps
+            last_box = self.box_count - 1
+            self.dues = array("q", (timestamp + expiries[box] if 0 <= box < last_box else ExpiryScan.never
+                                    for box, timestamp in zip(boxes, timestamps)))
+
+    @staticmethod
+    def numpy_for(size):
+        """ Returns whether to process size cards with NumPy, importing it if so. """
+        if not ExpiryScan.numpy_installed or size < ExpiryScan.numpy_threshold:
+            return False
+        global numpy  # pylint:disable=global-statement,invalid-name
+        if numpy is None:
+            import numpy as numpy_module  # pylint:disable=import-outside-toplevel
+            numpy = numpy_module
+        return True
+
+    def due_array(self):
+        if self.use_numpy:
+            return array("q", self.dues.astype(numpy.int64).tobytes())  # pylint:disable=no-member
+        return self.dues
+
+    def expired_flags(self, now):
+        if self.use_numpy:
+            return array("b", self.expired(now).astype(numpy.int8).tobytes())
+        return array("b", self.expired(now))
+
+    def summary(self):
+        """ Returns an ExpirySummary, holding sorted due times per box. """
+        dues = []
+        for box in range(self.box_count):
+            if self.use_numpy:
+                box_dues = self.dues[(self.boxes == box) & (self.dues != ExpiryScan.never)]
+                dues.append(array("q", numpy.sort(box_dues).astype(numpy.int64).tobytes()))
+            else:
+                dues.append(array("q", sorted(due for b, due in zip(self.boxes, self.dues)
+                                              if b == box and due != ExpiryScan.never)))
+        return ExpirySummary(self.totals(), dues)
+
+    def expired(self, now):
+        """ Returns mask of expired cards. """
+        if self.use_numpy:
+            return self.dues <= now
+        return [due <= now for due in self.dues]
+
+    def totals(self):
+        """ Returns number of cards per box. """
+        if self.use_numpy:
+            # Lines without a card (negative boxes) don't count.
+            return numpy.bincount(self.boxes[self.boxes >= 0], minlength=self.box_count).tolist()  # pylint:disable=no-member
+        totals = [0] * self.box_count
+        for box in self.boxes:
+            if box >= 0:
+                totals[box] += 1
+        return totals
+
+    def statistics(self, now):
+        """ Returns [total, expired] per box, like Deck.get_statistics. """
+        if self.use_numpy:
+            cards = self.boxes >= 0
+            totals = numpy.bincount(self.boxes[cards], minlength=self.box_count)
+            expired = numpy.bincount(self.boxes[cards & self.expired(now)], minlength=self.box_count)
+            return [[int(total), int(exp)] for total, exp in zip(totals, expired)]
+        stats = [[0, 0] for _ in range(self.box_count)]
+        for box, due in zip(self.boxes, self.dues):
+            if box < 0:
+                continue
+            stats[box][0] += 1
+            if due <= now:
+                stats[box][1] += 1
+        return stats
+
+    def next_expiry(self, now):
+        """ Returns seconds until next card expires (0 if some already have), None if none ever will. """
+        if self.use_numpy:
+            min_due = int(self.dues.min()) if self.dues.size else ExpiryScan.never  # pylint:disable=no-member
+        else:
+            min_due = min(self.dues, default=ExpiryScan.never)
+        return max(min_due - now, 0) if min_due != ExpiryScan.never else None
+
+    def box_entries(self, now, first_seq):
+        """ Splits cards (numbered consecutively from first_seq) by box.
+            Returns per box an array of expired sequence numbers, in ascending order, and an array of
+            sequence numbers of cards that will expire later, ordered by due time (see DueIndex.add_bulk).
+        """
+        if self.use_numpy:
+            entries = []
+            seqs = numpy.arange(first_seq, first_seq + len(self.dues), dtype=numpy.uint32)
+            expired = self.expired(now)
+            pending = ~expired & (self.dues != ExpiryScan.never)
+            for box in range(self.box_count):
+                in_box = self.boxes == box
+                pending_seqs = seqs[in_box & pending]
+                order = numpy.argsort(self.dues[in_box & pending], kind="stable")
+                entries.append((array("I", seqs[in_box & expired].tobytes()), array("I", pending_seqs[order].tobytes())))
+            return entries
+        entries = [(array("I"), []) for _ in range(self.box_count)]
+        seq_bits = 32
+        for seq, (box, due) in enumerate(zip(self.boxes, self.dues), first_seq):
+            if due <= now:
+                entries[box][0].append(seq)
+            elif due != ExpiryScan.never:
+                # Sorting packed ints is much faster than sorting by key.
+                entries[box][1].append((due << seq_bits) | seq)
+        seq_mask = (1 << seq_bits) - 1
+        return [(expired_seqs, array("I", (key & seq_mask for key in sorted(pending))))
+                for expired_seqs, pending in entries]
+
+class ExpirySummary:
+    """ Compact expiry summary of a deck: card count and sorted due times per box.
+        Answers statistics queries by binary search, without any cards at hand.
+    """
+
+    def __init__(self, totals, dues):
+        assert len(totals) == len(dues)
+        self.totals = totals
+        self.dues = dues
+
+    def statistics(self, now):
+        """ Returns [total, expired] per box, like Deck.get_statistics. """
+        return [[total, bisect.bisect_right(dues, now)] for total, dues in zip(self.totals, self.dues)]
+
+    def first_due(self):
+        """ Returns earliest due time, None if no card will ever expire. """
+        first_dues = [dues[0] for dues in self.dues if dues]
+        return min(first_dues) if first_dues else None
+
+    def forecast(self, now, periods, period):
+        """ Returns number of cards coming due in each of the next periods periods of period seconds,
+            like DueHistogram.forecast, but exact.
+        """
+        counts = [0] * periods
+        for dues in self.dues:
+            previous = 0
+            for index in range(periods):
+                position = bisect.bisect_left(dues, now + (index + 1) * period)
+                counts[index] += position - previous
+                previous = position
+        return counts
+
+    def next_expiry(self, now):
+        first_due = self.first_due()
+        return max(first_due - now, 0) if first_due is not None else None
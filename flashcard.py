@@ -1,6 +1,8 @@
 class FlashCard:
     """ Physical flashcard abstraction.
         Stores flashcard properties, eg. front-side text, back-side text, which box it belongs to.
+        Front and back are kept as a single string (front, sep_back, back), which is what the card
+        spec holds anyway, so loading a card takes one string instead of two.
     """
 
     # Card spec:
@@ -9,15 +11,75 @@ class FlashCard:
     sep_box = ' # '
     sep_timestamp = ' @ '
 
+    __slots__ = ("_text", "_split", "_box", "_timestamp", "listener", "seq", "line")
+
     def __init__(self, front, back="", box=0, timestamp=0):
+        # Called with the card whenever box or timestamp change, eg. to keep deck indexes up to date.
+        self.listener = None
+        # Sequence number within the deck holding the card.
+        self.seq = None
+        # Deckfile line number, if card was loaded from a deckfile.
+        self.line = None
         assert front is not None
-        self.front = front
         assert back is not None
-        self.back = back
+        self.set_text(front, back)
         assert box is not None
-        self.box = box
+        self._box = box
         assert timestamp is not None
-        self.timestamp = timestamp
+        self._timestamp = timestamp
+
+    @classmethod
+    def from_text(cls, text, split, box, timestamp, seq=None, line=None, listener=None):  # pylint:disable=too-many-arguments,too-many-positional-arguments
+        """ Creates card from text as returned by scan_card_spec, without copying it. """
+        card = cls.__new__(cls)
+        card.listener = listener
+        card.seq = seq
+        card.line = line
+        card._text = text
+        card._split = split
+        card._box = box
+        card._timestamp = timestamp
+        return card
+
+    def set_text(self, front, back):
+        self._text = front + FlashCard.sep_back + back
+        self._split = len(front)
+
+    @property
+    def front(self):
+        return self._text[:self._split]
+
+    @front.setter
+    def front(self, front):
+        self.set_text(front, self.back)
+
+    @property
+    def back(self):
+        return self._text[self._split + len(FlashCard.sep_back):]
+
+    @back.setter
+    def back(self, back):
+        self.set_text(self.front, back)
+
+    @property
+    def box(self):
+        return self._box
+
+    @box.setter
+    def box(self, box):
+        self._box = box
+        if self.listener:
+            self.listener(self)
+
+    @property
+    def timestamp(self):
+        return self._timestamp
+
+    @timestamp.setter
+    def timestamp(self, timestamp):
+        self._timestamp = timestamp
+        if self.listener:
+            self.listener(self)
 
     def to_card_spec(self):
         card_spec = ""
@@ -29,17 +91,107 @@ class FlashCard:
 
     @classmethod
     def from_card_spec(cls, card_spec):
-        card = None
-        if card_spec:
-            front_and_rest = card_spec.split(FlashCard.sep_back)
-            front = front_and_rest[0]
-            back_and_rest = front_and_rest[1].split(FlashCard.sep_box) if len(front_and_rest) == 2 else [""]
-            back = back_and_rest[0]
-            box_and_rest = back_and_rest[1].split(FlashCard.sep_timestamp) if len(back_and_rest) == 2 else [0]
+        fields = FlashCard.scan_card_spec(card_spec)
+        return cls.from_text(*fields) if fields else None
+
+    @staticmethod
+    def parse_card_spec(card_spec):
+        """ Splits card spec into (front, back, box, timestamp) in a single pass.
+            Returns None if card spec is malformed.
+        """
+        fields = FlashCard.scan_card_spec(card_spec)
+        if not fields:
+            return None
+        text, split, box, timestamp = fields
+        return (text[:split], text[split + len(FlashCard.sep_back):], box, timestamp)
+
+    @staticmethod
+    def scan_card_spec(card_spec):  # pylint:disable=too-many-return-statements
+        """ Like parse_card_spec, but returns (text, length of front, box, timestamp), text being front
+            and back joined by sep_back. Text is a slice of card_spec whenever card_spec has a back.
+        """
+        if not card_spec:
+            return None
+        # Fast path for the usual spec, with each separator once (and the back separator first).
+        text, sep, rest = card_spec.partition(FlashCard.sep_box)
+        split = text.find(FlashCard.sep_back)
+        if sep and split >= 0 and FlashCard.sep_box not in rest and card_spec.count(FlashCard.sep_back) == 1:
+            box, sep, timestamp = rest.partition(FlashCard.sep_timestamp)
             try:
-                box = int(box_and_rest[0])
-                timestamp = int(box_and_rest[1]) if len(box_and_rest) == 2 else 0
-                card = cls(front, back, box=box, timestamp=timestamp)
+                return (text, split, int(box), int(timestamp) if sep and FlashCard.sep_timestamp not in timestamp else 0)
             except ValueError:
-                pass
-        return card
+                return None
+        sep_length = len(FlashCard.sep_back)
+        split = card_spec.find(FlashCard.sep_back)
+        if split < 0:
+            return (card_spec + FlashCard.sep_back, len(card_spec), 0, 0)
+        back_start = split + sep_length
+        if card_spec.find(FlashCard.sep_back, back_start) >= 0:
+            return (card_spec[:back_start], split, 0, 0)
+        box_start = card_spec.find(FlashCard.sep_box, back_start)
+        if box_start < 0:
+            return (card_spec, split, 0, 0)
+        text = card_spec[:box_start]
+        box_start += len(FlashCard.sep_box)
+        if card_spec.find(FlashCard.sep_box, box_start) >= 0:
+            return (text, split, 0, 0)
+        timestamp_start = card_spec.find(FlashCard.sep_timestamp, box_start)
+        try:
+            if timestamp_start < 0:
+                return (text, split, int(card_spec[box_start:]), 0)
+            box = int(card_spec[box_start:timestamp_start])
+            timestamp = card_spec[timestamp_start + len(FlashCard.sep_timestamp):]
+            return (text, split, box, int(timestamp) if FlashCard.sep_timestamp not in timestamp else 0)
+        except ValueError:
+            return None
+
+# pylint:disable=too-many-instance-attributes
+class LazyFlashCard(FlashCard):
+    """ Flashcard that only keeps box and timestamp in memory.
+        Front and back of the given deckfile line are fetched via read_text when first needed.
+    """
+
+    __slots__ = ("read_text",)
+
+    # pylint:disable=super-init-not-called
+    def __init__(self, read_text, line, box=0, timestamp=0, seq=None, listener=None):  # pylint:disable=too-many-arguments,too-many-positional-arguments
+        self.listener = listener
+        self.seq = seq
+        self.read_text = read_text
+        self.line = line
+        self._text = None
+        self._split = 0
+        self._box = box
+        self._timestamp = timestamp
+
+    def materialized(self):
+        return self._text is not None
+
+    def materialize(self, card_spec=None):
+        if card_spec is None:
+            self.set_text(*self.read_text(self.line))
+            return
+        fields = FlashCard.scan_card_spec(card_spec)
+        if not fields:
+            raise ValueError("Deckfile changed, malformed card spec in line %d" % (self.line + 1))
+        self._text, self._split = fields[0], fields[1]
+
+    @property
+    def front(self):
+        if self._text is None:
+            self.materialize()
+        return self._text[:self._split]
+
+    @front.setter
+    def front(self, front):
+        self.set_text(front, self.back)
+
+    @property
+    def back(self):
+        if self._text is None:
+            self.materialize()
+        return self._text[self._split + len(FlashCard.sep_back):]
+
+    @back.setter
+    def back(self, back):
+        self.set_text(self.front, back)
@@ -5,22 +5,35 @@
 # Copyright (c) 2019 Ralf Holly, MIT License, see LICENSE file.
 #
 
-import argparse
 import sys
 import os
-import subprocess
 
+# argparse, subprocess and concurrent.futures are imported where needed: flashme runs on every
+# notifier tick (or shell prompt), and most of those runs take the fast path, see run_fast_path.
+from cache import SummaryCache
+from daemonclient import DaemonClient
 from deck import Deck, SECS_PER_DAY
+from scheduler import LeitnerScheduler
 from view import View
 from controller import Controller
 
 VERSION = "1.3.1"
 
+# pylint:disable=too-many-public-methods
 class Flashme:
     """ Main program entry point.
         Parses and handles command-line arguments, executes the study loop.
     """
-    def __init__(self):
+
+    profile_env_string = "FLASHME_PROFILE"
+    scheduler_env_string = "FLASHME_SCHEDULER"
+    # Deck methods timed when profiling.
+    profiled_methods = ["load_from_file", "load_from_specs", "load_lazily", "load_due_only", "load_compiled",
+                        "get_next_card", "get_next_card_cram_mode", "get_statistics", "next_expiry", "right", "wrong",
+                        "save_to_file", "persist"]
+    profiler = None
+    def __init__(self):  # pylint:disable=too-many-statements
+        import argparse  # pylint:disable=import-outside-toplevel
         parser = argparse.ArgumentParser(description="A flashcard system for command-line aficionados")
         parser.add_argument("file", nargs="?", type=str, default=None, metavar="DECKFILE", help="Flashcard deckfile to be used")
         parser.add_argument("-v", "--version", action="store_true", help="Show flashcard version")
@@ -33,6 +46,20 @@ class Flashme:
         parser.add_argument("-r", "--reverse", action="store_true", help="Reverse learning: show back and ask for front")
         parser.add_argument("-e", "--edit", action="store_true", help="Edit deckfile with editor defined by EDITOR variable")
         parser.add_argument("-x", "--expired", nargs="+", type=str, default=None, metavar="DECKFILE", help="List count of expired cards for given deckfiles")
+        parser.add_argument("-a", "--apply", type=str, default=None, metavar="RESULTS", help="Apply answers from tab-separated file (front, Y/N, optional timestamp; - for stdin)")
+        parser.add_argument("-S", "--search", type=str, default=None, metavar="QUERY", help="Show cards containing all words of QUERY; with --cram, cram these cards only")
+        parser.add_argument("-F", "--forecast", type=int, default=None, metavar="DAYS", help="Show number of cards coming due per day over the next DAYS days")
+        parser.add_argument("--hourly", action="store_true", help="Show --forecast per hour")
+        parser.add_argument("-d", "--dedupe", action="store_true", help="List cards with the same front")
+        parser.add_argument("-m", "--multi", nargs="*", type=str, default=None, metavar="DECKFILE",
+                            help="Study several deckfiles in one session (default: all deckfiles in FLASHME_DIR)")
+        parser.add_argument("--compile", action="store_true", help="Compile deckfile into binary sidecar for faster loading")
+        parser.add_argument("-J", "--journal", action="store_true", help="Journal each answer immediately instead of saving the deckfile on quit")
+        parser.add_argument("--daemon", action="store_true", help="Keep decks in memory and answer --expired/--info queries from there")
+        parser.add_argument("--profile", action="store_true", help="Print call counts and latencies at exit")
+        parser.add_argument("--profile-json", type=str, default=None, metavar="FILE",
+                            help="Write call counts and latencies to FILE as JSON at exit")
+        parser.add_argument("-j", "--jobs", type=int, default=None, metavar="N", help="Number of worker processes for --expired (default: CPU count)")
         self.args = parser.parse_args()
 
         self.view = View(self.args.terse, self.args.reverse, self.args.cram)
@@ -44,25 +71,29 @@ class Flashme:
         if self.args.edit:
             self.launch_editor(self.args.file)
 
+        if self.args.daemon:
+            Flashme.run_daemon()
+
         if self.args.expired:
-            print(self.view.print_expired_counts(Flashme.get_expired_counts(self.args.expired)), end="")
+            print(self.view.print_expired_counts(Flashme.get_expired_counts(self.args.expired, self.args.jobs)), end="")
             sys.exit(0)
 
-        if not self.args.file:
+        if self.args.multi is None and not self.args.file:
             parser.print_help()
             View.die("Please provide a flashcard file")
 
-        try:
-            self.deck = Deck(filename=self.args.file)
-            self.deck.load_from_file()
-        except Deck.DeckfileNotFoundError as dfe:
-            View.die(dfe)
+        if self.args.profile or self.args.profile_json is not None:
+            Flashme.start_profiler(self.args.profile_json)
 
-        self.controller = Controller(self.deck, self.args.cram)
+        if self.args.multi is not None:
+            self.open_multi_deck()
+        else:
+            self.open_deck()
 
-        if self.args.info:
-            print(self.view.print_info(self.deck.get_statistics()))
-            sys.exit(0)
+        if self.args.forecast is not None:
+            self.forecast()
+
+        self.controller = Controller(self.deck, self.args.cram)
 
         if self.args.cram is None:
             self.get_next_card_fun = self.deck.get_next_card
@@ -72,10 +103,70 @@ class Flashme:
         if self.args.silent_start and not self.get_next_card_fun():
             sys.exit(0)
 
+    def open_deck(self):
+        try:
+            self.deck = Flashme.create_deck(self.args.file, journal=self.args.journal)
+            if self.args.info:
+                print(self.view.print_info(Flashme.get_deck_statistics(self.deck)))
+                sys.exit(0)
+            if self.args.forecast is not None:
+                # Forecasting works off the summary cache, see forecast.
+                return
+            # Studying only needs due cards in memory, cramming only the texts of cards shown; the
+            # other options work on all card texts.
+            all_texts = self.args.search is not None or self.args.dedupe or self.args.apply or self.args.compile
+            self.deck.load_from_file(lazy=not all_texts, due_only=self.args.cram is None and not all_texts)
+            if self.args.search is not None:
+                self.search(self.args.search)
+            if self.args.dedupe:
+                print(self.view.print_duplicates(self.deck.find_duplicates()), end="")
+                sys.exit(0)
+            if self.args.apply:
+                print(self.view.print_applied_reviews(*self.apply_reviews(self.args.apply)))
+                sys.exit(0)
+            if self.args.compile:
+                self.deck.compile()
+                sys.exit(0)
+        except (Deck.DeckfileNotFoundError, ValueError) as ex:
+            View.die(ex)
+
+    def forecast(self):
+        if self.args.forecast < 1:
+            View.die("Forecast needs at least one day")
+        periods, period = (24 * self.args.forecast, 60 * 60) if self.args.hourly else (self.args.forecast, SECS_PER_DAY)
+        if self.args.multi is not None:
+            counts = self.deck.forecast(periods, period)
+        else:
+            counts = Flashme.get_deck_forecast(self.deck, periods, period)
+        print(self.view.print_forecast(counts, "Hour" if self.args.hourly else "Day"), end="")
+        sys.exit(0)
+
+    def open_multi_deck(self):
+        from multideck import MultiDeck  # pylint:disable=import-outside-toplevel
+        # Options that only work on a single deckfile are rejected rather than ignored.
+        args = self.args
+        if args.file:
+            View.die("Please pass deckfiles to --multi: " + args.file)
+        single_deck_options = [("--cram", args.cram is not None), ("--info", args.info), ("--search", args.search is not None),
+                               ("--dedupe", args.dedupe), ("--apply", args.apply), ("--compile", args.compile)]
+        options = [option for option, given in single_deck_options if given]
+        if options:
+            View.die(", ".join(options) + (" needs" if len(options) == 1 else " need") + " a single deckfile, not --multi")
+        deckfiles = self.args.multi or MultiDeck.find_deckfiles()
+        if not deckfiles:
+            View.die("No deckfiles found, please provide some or set " + Deck.flashme_dir_env_string)
+        try:
+            self.deck = MultiDeck(deckfiles, journal=self.args.journal, scheduler=Flashme.create_scheduler())
+        except (Deck.DeckfileNotFoundError, ValueError) as ex:
+            View.die(ex)
+
     def run(self):
         try:
             print(self.view.print_version(VERSION))
-            print(self.view.print_deckfile(self.deck.filename))
+            if self.args.multi is not None:
+                print(self.view.print_deckfiles([deck.filename for deck in self.deck.decks]))
+            else:
+                print(self.view.print_deckfile(self.deck.filename))
             print(self.view.print_info(self.deck.get_statistics()))
             self.study_loop()
 
@@ -83,38 +174,50 @@ class Flashme:
             View.die(str(cse))
 
     def study_loop(self):
-        while True:
-            my_card = self.get_next_card_fun()
-            if not my_card:
-                next_expiry = self.deck.next_expiry()
-                if next_expiry is not None:
-                    print(self.view.print_nothing_to_do_come_back(next_expiry / SECS_PER_DAY))
-                else:
-                    print(self.view.print_nothing_to_do())
-                self.controller.handle(Controller.input_quit, my_card)
-                break
-            print(self.view.print_question(my_card), end="")
-            while True:
-                print(self.view.print_input(my_card.back), end="")
-                my_inp = input().upper()
-                result = self.controller.handle(my_inp, my_card)
-                if result[0] == Controller.input_info:
-                    print(self.view.print_info(self.deck.get_statistics()))
-                elif result[0] == Controller.input_show:
-                    print(self.view.print_answer(my_card), end="" if not self.args.cram else " ")
-                    # In cram mode, wait for return key press then proceed to next question.
-                    if self.args.cram:
-                        input()
-                        break
-                elif result[0] == Controller.input_cancel:
-                    my_inp = input(self.view.print_input_cancel_check()).upper()
-                    if my_inp == Controller.input_yes:
-                        return
-                else:
-                    break
+        # Only interactive sessions need asyncio, which takes a while to import.
+        import asyncio  # pylint:disable=import-outside-toplevel
+        from session import StudySession  # pylint:disable=import-outside-toplevel
+        asyncio.run(StudySession(self.deck, self.view, self.controller, self.get_next_card_fun, self.args.cram).run())
 
-            if my_inp == Controller.input_quit:
-                return
+    def search(self, query):
+        cards = self.deck.search(query)
+        if self.args.cram is None:
+            now = self.deck.time_fun()
+            results = []
+            for card in cards:
+                due = self.deck.card_due(card)
+                results.append((card, card.box, due - now if due is not None else None))
+            print(self.view.print_search_results(results), end="")
+            sys.exit(0)
+        if not any(self.args.cram in (card.box, -1) for card in cards):
+            View.die("No cards match " + query)
+        self.deck.restrict_cram(cards)
+
+    def apply_reviews(self, results_file):
+        try:
+            if results_file == "-":
+                applied, unknown = self.deck.apply_reviews(Flashme.read_reviews(sys.stdin))
+            else:
+                with open(results_file, "r", encoding="utf-8") as f:
+                    applied, unknown = self.deck.apply_reviews(Flashme.read_reviews(f))
+        except (OSError, ValueError) as ex:
+            View.die(ex)
+        self.deck.save_to_file()
+        return applied, unknown
+
+    @staticmethod
+    def read_reviews(lines):
+        """ Parses tab-separated review results: card front, Y or N, optionally the time of the review. """
+        for line_number, line in enumerate(lines, 1):
+            line = line.rstrip("\r\n")
+            if not line or line.startswith(Deck.comment_leader):
+                continue
+            fields = line.split("\t")
+            if len(fields) not in (2, 3) or fields[1].upper() not in (Controller.input_yes, Controller.input_no) \
+                    or (len(fields) == 3 and not fields[2].isdigit()):
+                raise ValueError("Malformed review in line %d: %s" % (line_number, line))
+            timestamp = int(fields[2]) if len(fields) == 3 else None
+            yield fields[0], fields[1].upper() == Controller.input_yes, timestamp
 
     def init_cram_mode(self):
         sts = self.deck.get_statistics()
@@ -135,6 +238,7 @@ class Flashme:
         return None
 
     def launch_editor(self, deckfile):
+        import subprocess  # pylint:disable=import-outside-toplevel
         editor = os.environ.get("EDITOR")
         if not editor:
             View.die("EDITOR environment variable not defined")
@@ -147,19 +251,156 @@ class Flashme:
             View.die("Failed to launch editor " + editor)
 
     @staticmethod
-    def get_expired_counts(deckfiles):
-        expired_counts = []
-        for deckfile in deckfiles:
+    def start_profiler(output=None):
+        """ Instruments hot paths and user think time, see Profiler. Results get reported at exit. """
+        import atexit  # pylint:disable=import-outside-toplevel
+        from profiler import Profiler  # pylint:disable=import-outside-toplevel
+        from session import StudySession  # pylint:disable=import-outside-toplevel
+        if Flashme.profiler is not None:
+            return
+        Flashme.profiler = Profiler(output)
+        for name in Flashme.profiled_methods:
+            Flashme.profiler.instrument(Deck, name)
+        Flashme.profiler.instrument(StudySession, "input", "think time")
+        atexit.register(Flashme.profiler.dump)
+
+    @staticmethod
+    def run_daemon():
+        from daemon import Daemon  # pylint:disable=import-outside-toplevel
+        import signal  # pylint:disable=import-outside-toplevel
+        # Make sure the socket file gets removed on SIGTERM, too.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            Daemon(scheduler=Flashme.create_scheduler()).serve()
+        except KeyboardInterrupt:
+            pass
+        except (OSError, ValueError) as ex:
+            View.die(ex)
+        sys.exit(0)
+
+    @staticmethod
+    def create_scheduler():
+        """ Returns scheduler named by FLASHME_SCHEDULER (default: Leitner). """
+        name = os.environ.get(Flashme.scheduler_env_string) or LeitnerScheduler.name
+        if name == LeitnerScheduler.name:
+            return LeitnerScheduler(Deck.default_expiries)
+        from expandingscheduler import ExpandingScheduler  # pylint:disable=import-outside-toplevel
+        if name == ExpandingScheduler.name:
+            return ExpandingScheduler(len(Deck.default_expiries))
+        raise ValueError("Unknown scheduler %s, please set %s to %s or %s" % (
+            name, Flashme.scheduler_env_string, LeitnerScheduler.name, ExpandingScheduler.name))
+
+    @staticmethod
+    def create_deck(deckfile, **kwargs):
+        """ Returns deck of deckfile, scheduled by the scheduler picked by FLASHME_SCHEDULER. """
+        return Deck(filename=deckfile, scheduler=Flashme.create_scheduler(), **kwargs)
+
+    @staticmethod
+    def get_statistics_from_daemon(deckfiles):
+        """ Returns statistics of deckfiles as known to a running daemon, None if there's no daemon
+            (or it failed to answer). Raises Deck.DeckfileNotFoundError like the Deck constructor.
+        """
+        paths = [os.path.abspath(Deck(filename=deckfile).filename) for deckfile in deckfiles]
+        client = DaemonClient.connect()
+        if client is None:
+            return None
+        with client:
             try:
-                deck = Deck(filename=deckfile)
-                deck.load_from_file()
-                stats = deck.get_statistics()
-                expired = sum([exp for tot, exp in stats])
-                if expired:
-                    expired_counts.append((deckfile, expired))
-            except Deck.DeckfileNotFoundError as dfe:
-                View.die(dfe)
-        return expired_counts
+                return [client.statistics(path) for path in paths]
+            except DaemonClient.QueryError:
+                # Let direct loading handle (and report) the problem.
+                return None
+
+    @staticmethod
+    def get_expired_counts(deckfiles, jobs=None):
+        try:
+            stats = Flashme.get_statistics_from_daemon(deckfiles)
+            if stats is not None:
+                counts = [sum(exp for tot, exp in deck_stats) for deck_stats in stats]
+            else:
+                # Cache hits are cheap, only decks that need scanning are worth extra processes.
+                counts = [Flashme.get_cached_expired_count(deckfile) for deckfile in deckfiles]
+                stale = [i for i, count in enumerate(counts) if count is None]
+                jobs = min(jobs or os.cpu_count() or 1, len(stale))
+                if jobs > 1:
+                    from concurrent.futures import ProcessPoolExecutor  # pylint:disable=import-outside-toplevel
+                    with ProcessPoolExecutor(max_workers=jobs) as executor:
+                        scanned = list(executor.map(Flashme.get_expired_count, [deckfiles[i] for i in stale]))
+                else:
+                    scanned = [Flashme.get_expired_count(deckfiles[i]) for i in stale]
+                for i, count in zip(stale, scanned):
+                    counts[i] = count
+        except (Deck.DeckfileNotFoundError, ValueError) as ex:
+            View.die(ex)
+        return [(deckfile, expired) for deckfile, expired in zip(deckfiles, counts) if expired]
+
+    @staticmethod
+    def get_cached_expired_count(deckfile):
+        """ Returns number of expired cards from the summary cache, None if the deck needs scanning. """
+        deck = Flashme.create_deck(deckfile)
+        if os.path.exists(deck.journal_path()):
+            return None
+        summary = SummaryCache().load(deck, Deck.file_signature(deck.filename))
+        return sum(exp for tot, exp in summary.statistics(deck.time_fun())) if summary is not None else None
+
+    @staticmethod
+    def get_expired_count(deckfile):
+        """ Returns number of expired cards, without asking the daemon (which had no answer). """
+        stats = Flashme.get_local_deck_statistics(Flashme.create_deck(deckfile))
+        return sum(exp for tot, exp in stats)
+
+    @staticmethod
+    def get_deck_statistics(deck):
+        """ Returns statistics of an unloaded deck, preferably without loading it. """
+        stats = Flashme.get_statistics_from_daemon([deck.filename])
+        if stats is not None:
+            return stats[0]
+        return Flashme.get_local_deck_statistics(deck)
+
+    @staticmethod
+    def get_local_deck_statistics(deck):
+        if os.path.exists(deck.journal_path()):
+            # Journaled answers aren't reflected by the deckfile (nor its cached summary) yet.
+            deck.load_from_file(lazy=True)
+            return deck.get_statistics()
+        return SummaryCache().summary(deck).statistics(deck.time_fun())
+
+    @staticmethod
+    def get_deck_forecast(deck, periods, period):
+        """ Returns forecast of an unloaded deck (see Deck.forecast), preferably without loading it. """
+        if os.path.exists(deck.journal_path()):
+            deck.load_from_file(lazy=True)
+            return deck.forecast(periods, period)
+        return SummaryCache().summary(deck).forecast(deck.time_fun(), periods, period)
+
+    @staticmethod
+    def run_fast_path(argv):
+        """ Handles plain --expired, --info and --silent-start invocations without argparse and
+            without building a study session. Returns False if argv needs the full treatment.
+        """
+        if len(argv) >= 2 and argv[0] in ("-x", "--expired") and not any(arg.startswith("-") for arg in argv[1:]):
+            view = View(False, False, None)
+            print(view.print_expired_counts(Flashme.get_expired_counts(argv[1:])), end="")
+            return True
+        if len(argv) != 2:
+            return False
+        options = [arg for arg in argv if arg.startswith("-")]
+        deckfiles = [arg for arg in argv if not arg.startswith("-")]
+        if len(options) != 1 or len(deckfiles) != 1 or options[0] not in ("-i", "--info", "-s", "--silent-start"):
+            return False
+        try:
+            stats = Flashme.get_deck_statistics(Flashme.create_deck(deckfiles[0]))
+        except (Deck.DeckfileNotFoundError, ValueError) as ex:
+            View.die(ex)
+        if options[0] in ("-i", "--info"):
+            print(View(False, False, None).print_info(stats))
+            return True
+        # Silent start: done if nothing has expired, otherwise start a regular session.
+        return not any(expired for total, expired in stats)
 
 if __name__ == "__main__":
-    Flashme().run()
+    # FLASHME_PROFILE=1: print profile, any other value: write it as JSON to that file.
+    if os.environ.get(Flashme.profile_env_string):
+        Flashme.start_profiler(os.environ[Flashme.profile_env_string] if os.environ[Flashme.profile_env_string] != "1" else None)
+    if not Flashme.run_fast_path(sys.argv[1:]):
+        Flashme().run()
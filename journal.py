@@ -0,0 +1,106 @@
+import os
+
+from decklock import DeckLock
+
+class Journal:
+    """ Answers of a deck in journal mode, appended to <deckfile>.journal as they're given (one JSON
+        object per line: deckfile line, front, box and timestamp), so they survive crashes without
+        rewriting the deckfile after each answer. Sessions on the same deckfile share the journal;
+        whoever saves the deckfile removes it, unless it has entries that session hasn't read (see
+        discard). Journal files are only touched with the DeckLock of the deckfile held.
+    """
+
+    suffix = ".journal"
+    encoding = "utf-8"
+
+    def __init__(self, deckfile):
+        self.deckfile = deckfile
+        # Stays open for the whole session, see close.
+        self.file = None
+        # Entries written or read since the deckfile was last saved.
+        self.entries = 0
+        # (inode, size) of the journal file while all its entries are known to this session, see discard.
+        self.known = None
+
+    @staticmethod
+    def path_of(deckfile):
+        return os.path.realpath(deckfile) + Journal.suffix
+
+    def path(self):
+        return Journal.path_of(self.deckfile)
+
+    def append(self, line, front, box, timestamp):
+        import json  # pylint:disable=import-outside-toplevel
+        entry = {"line": line, "front": front, "box": box, "timestamp": timestamp}
+        data = (json.dumps(entry) + "\n").encode(Journal.encoding)
+        # Another process may be reading (and removing) the journal meanwhile.
+        with DeckLock(self.deckfile):
+            self.open()
+            inode, size = Journal.file_state(self.file)
+            self.file.write(data)
+            self.file.flush()
+            self.known = (inode, size + len(data)) if self.known == (inode, size) else None
+        self.entries += 1
+
+    def open(self):
+        """ Opens the journal for appending, reopening it if another process has removed it meanwhile
+            (see discard). Call with the DeckLock held.
+        """
+        path = self.path()
+        if self.file is not None:
+            try:
+                removed = os.stat(path).st_ino != os.fstat(self.file.fileno()).st_ino
+            except FileNotFoundError:
+                removed = True
+            if removed:
+                self.close()
+        if self.file is None:
+            self.file = open(path, "ab")  # pylint:disable=consider-using-with
+            if Journal.file_state(self.file)[1] == 0:
+                self.known = Journal.file_state(self.file)
+
+    @staticmethod
+    def file_state(f):
+        st = os.fstat(f.fileno())
+        return st.st_ino, st.st_size
+
+    def read(self):
+        """ Yields (line, front, box, timestamp) of all entries, with the DeckLock held. Torn entries
+            (eg. the last one, after a crash) are skipped.
+        """
+        try:
+            f = open(self.path(), "rb")  # pylint:disable=consider-using-with
+        except FileNotFoundError:
+            return
+        # Only imported if there is a journal, to keep startup fast.
+        import json  # pylint:disable=import-outside-toplevel
+        with f, DeckLock(self.deckfile):
+            for journal_line in f:
+                try:
+                    entry = json.loads(journal_line)
+                    fields = entry["line"], entry["front"], entry["box"], entry["timestamp"]
+                except (ValueError, KeyError, TypeError):
+                    continue
+                yield fields
+                self.entries += 1
+            self.known = (os.fstat(f.fileno()).st_ino, f.tell())
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def discard(self):
+        """ Removes the journal once the deckfile has been saved, unless it has entries this session doesn't
+            know of (appended by another session, which keeps them until it saves itself). Call with the
+            DeckLock held.
+        """
+        self.close()
+        try:
+            st = os.stat(self.path())
+            if (st.st_ino, st.st_size) == self.known:
+                os.remove(self.path())
+        except FileNotFoundError:
+            pass
+        self.entries = 0
+        self.known = None
@@ -0,0 +1,185 @@
+import heapq
+import os
+import os.path
+import time
+
+from cache import SummaryCache
+from compiled import CompiledDeck
+from deck import Deck
+from journal import Journal
+
+# pylint:disable=too-many-instance-attributes
+class MultiDeck:
+    """ Studies many decks in one session, standing in for a single Deck (as far as Controller and
+        StudySession are concerned). Decks are merged by due time: a heap holds one entry per deck,
+        keyed by the earliest due time of its cards. The deck at the top presents its expired cards
+        (in its usual order) until none are left, then it's queued again by its next due time. This
+        way, a deck is only loaded once it's due and actually studied; until then, its due times come
+        from its cached expiry summary (see SummaryCache). Only decks that have been modified are saved.
+    """
+
+    def __init__(self, deckfiles, **kwargs):
+        self.decks = [Deck(filename=deckfile, **kwargs) for deckfile in deckfiles]
+        self.time_fun = kwargs['time_fun'] if 'time_fun' in kwargs else lambda: int(time.time())
+        self.journal_enabled = kwargs['journal'] if 'journal' in kwargs else False
+        self.box_count = self.decks[0].box_count
+        self.max_box_num = self.box_count - 1
+        self.cache = SummaryCache(kwargs['cache_dir'] if 'cache_dir' in kwargs else None)
+        self.loaded = [False] * len(self.decks)
+        # Expiry summaries of decks that haven't been loaded yet.
+        self.summaries = [None] * len(self.decks)
+        # Heap of (due time, deck index). An item is stale unless its due time equals keys[deck index].
+        self.heap = []
+        self.keys = [None] * len(self.decks)
+        # Index of the deck that presented the current card.
+        self.current = None
+        for index, deck in enumerate(self.decks):
+            if os.path.exists(deck.journal_path()):
+                # Journaled answers aren't reflected by the deckfile (nor its cached summary) yet.
+                self.load(index)
+                self.set_key(index, self.next_due(index))
+            else:
+                self.summaries[index] = self.cache.summary(deck)
+                self.set_key(index, self.summaries[index].first_due())
+
+    @staticmethod
+    def find_deckfiles():
+        """ Returns all deckfiles in the directories listed in FLASHME_DIR. """
+        deckfiles = []
+        for flashme_dir in os.environ.get(Deck.flashme_dir_env_string, "").split(os.pathsep):
+            if not flashme_dir or not os.path.isdir(flashme_dir):
+                continue
+            for name in sorted(os.listdir(flashme_dir)):
+                path = os.path.join(flashme_dir, name)
+                if not name.startswith(".") and not name.endswith((Journal.suffix, CompiledDeck.suffix)) \
+                        and os.path.isfile(path):
+                    deckfiles.append(path)
+        return deckfiles
+
+    def load(self, index):
+        self.decks[index].load_from_file(lazy=True)
+        self.loaded[index] = True
+        self.summaries[index] = None
+
+    def next_due(self, index):
+        """ Returns when (loaded) deck's next card expires (now if some have), None if none ever will. """
+        next_expiry = self.decks[index].next_expiry()
+        return self.time_fun() + next_expiry if next_expiry is not None else None
+
+    def set_key(self, index, key):
+        self.keys[index] = key
+        if key is not None:
+            heapq.heappush(self.heap, (key, index))
+
+    def get_next_card(self, consume=False):
+        now = self.time_fun()
+        heap = self.heap
+        while heap:
+            key, index = heap[0]
+            if key != self.keys[index]:
+                heapq.heappop(heap)
+                continue
+            if key > now:
+                break
+            if not self.loaded[index]:
+                self.load(index)
+            deck = self.decks[index]
+            card = deck.get_next_card(consume)
+            if card is not None:
+                self.current = index
+                return card
+            # Deck is done for now.
+            heapq.heappop(heap)
+            self.set_key(index, self.next_due(index))
+        self.current = None
+        return None
+
+    def peek_next_card(self):
+        """ Returns card that get_next_card will most likely return once the current card has been
+            answered. Decks that haven't been loaded yet aren't looked at, loading one takes too long.
+        """
+        if self.current is not None:
+            card = self.decks[self.current].peek_next_card()
+            if card is not None:
+                return card
+        now = self.time_fun()
+        candidates = [(key, index) for index, key in enumerate(self.keys)
+                      if index != self.current and key is not None and key <= now]
+        if not candidates:
+            return None
+        index = min(candidates)[1]
+        return self.decks[index].peek_next_card() if self.loaded[index] else None
+
+    def consume_current_card(self):
+        if self.current is not None:
+            self.decks[self.current].consume_current_card()
+
+    def wrong(self, card):
+        self.decks[self.current].wrong(card)
+
+    def right(self, card):
+        self.decks[self.current].right(card)
+
+    def get_statistics(self):
+        now = self.time_fun()
+        totals = [[0, 0] for _ in range(self.box_count)]
+        for index, deck in enumerate(self.decks):
+            stats = deck.get_statistics() if self.loaded[index] else self.summaries[index].statistics(now)
+            for entry, (total, expired) in zip(totals, stats):
+                entry[0] += total
+                entry[1] += expired
+        return totals
+
+    def next_expiry(self):
+        now = self.time_fun()
+        expiries = [deck.next_expiry() if self.loaded[index] else self.summaries[index].next_expiry(now)
+                    for index, deck in enumerate(self.decks)]
+        expiries = [expiry for expiry in expiries if expiry is not None]
+        return min(expiries) if expiries else None
+
+    def forecast(self, periods, period):
+        """ Like Deck.forecast, summed over all decks. """
+        now = self.time_fun()
+        counts = [0] * periods
+        for index, deck in enumerate(self.decks):
+            deck_counts = deck.forecast(periods, period) if self.loaded[index] \
+                else self.summaries[index].forecast(now, periods, period)
+            counts = [count + deck_count for count, deck_count in zip(counts, deck_counts)]
+        return counts
+
+    def loaded_decks(self):
+        return [deck for deck, loaded in zip(self.decks, self.loaded) if loaded]
+
+    @property
+    def modified(self):
+        return any(deck.modified for deck in self.loaded_decks())
+
+    @property
+    def journal_entries(self):
+        return sum(deck.journal_entries for deck in self.loaded_decks())
+
+    def persist(self):
+        # Decks that haven't been loaded can't have changed.
+        for deck in self.loaded_decks():
+            deck.persist()
+
+    def start_save(self):
+        """ Like Deck.start_save, for all modified decks. """
+        snapshot = []
+        for deck in self.loaded_decks():
+            deck_snapshot = deck.start_save()
+            if deck_snapshot is not None:
+                snapshot.append([deck, deck_snapshot, None])
+        return snapshot or None
+
+    def write_snapshot(self, snapshot):
+        # A deck that fails to save mustn't keep the others from saving.
+        for entry in snapshot:
+            try:
+                entry[0].write_snapshot(entry[1])
+            except OSError as ose:
+                entry[2] = ose
+
+    def finish_save(self, snapshot, error=None):
+        for deck, deck_snapshot, deck_error in snapshot:
+            deck.finish_save(deck_snapshot, deck_error or error)
@@ -0,0 +1,108 @@
+import functools
+import inspect
+import json
+import os.path
+import sys
+import time
+
+class Profiler:
+    """ Opt-in instrumentation: counts calls of selected methods and records their latencies in
+        histograms with power-of-two microsecond buckets. Methods get wrapped only when profiling
+        is switched on, so there's no overhead otherwise. Coroutine methods are timed until they
+        complete (eg. waiting for user input).
+    """
+
+    def __init__(self, output=None):
+        # None: print summary to stderr, otherwise write JSON to this file.
+        self.output = output
+        # label -> [calls, total seconds, max seconds, {bucket: count}]
+        self.stats = {}
+
+    def record(self, label, seconds):
+        entry = self.stats.get(label)
+        if entry is None:
+            entry = self.stats[label] = [0, 0.0, 0.0, {}]
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] = max(entry[2], seconds)
+        # Bucket b holds latencies below 2**b microseconds.
+        bucket = int(seconds * 1e6).bit_length()
+        entry[3][bucket] = entry[3].get(bucket, 0) + 1
+
+    def instrument(self, cls, name, label=None):
+        """ Replaces method name of cls by a wrapper that records each call. """
+        method = getattr(cls, name)
+        label = label or "%s.%s" % (cls.__name__, name)
+        if inspect.iscoroutinefunction(method):
+            @functools.wraps(method)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await method(*args, **kwargs)
+                finally:
+                    self.record(label, time.perf_counter() - start)
+            setattr(cls, name, async_wrapper)
+        else:
+            @functools.wraps(method)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return method(*args, **kwargs)
+                finally:
+                    self.record(label, time.perf_counter() - start)
+            setattr(cls, name, wrapper)
+
+    @staticmethod
+    def percentile(histogram, calls, fraction):
+        """ Returns upper bound (microseconds) of the bucket holding the given fraction of calls. """
+        seen = 0
+        for bucket in sorted(histogram):
+            seen += histogram[bucket]
+            if seen >= fraction * calls:
+                return 1 << bucket
+        return 0
+
+    def results(self):
+        results = {}
+        for label, (calls, total, maximum, histogram) in self.stats.items():
+            results[label] = {
+                "calls": calls,
+                "total_ms": total * 1e3,
+                "mean_us": total / calls * 1e6,
+                "max_us": maximum * 1e6,
+                "p50_us": Profiler.percentile(histogram, calls, 0.5),
+                "p99_us": Profiler.percentile(histogram, calls, 0.99),
+                "histogram_us": {str(1 << bucket): count for bucket, count in sorted(histogram.items())},
+            }
+        return results
+
+    @staticmethod
+    def is_profile(path):
+        try:
+            with open(path, encoding="utf-8") as f:
+                return isinstance(json.load(f), dict)
+        except (OSError, ValueError):
+            return False
+
+    def summary(self):
+        lines = ["%-32s %8s %11s %11s %10s %10s" % ("profile", "calls", "total ms", "mean us", "p50 us <", "p99 us <")]
+        for label, result in sorted(self.results().items(), key=lambda item: -item[1]["total_ms"]):
+            lines.append("%-32s %8d %11.2f %11.1f %10d %10d" % (label, result["calls"], result["total_ms"],
+                                                               result["mean_us"], result["p50_us"], result["p99_us"]))
+        return "\n".join(lines) + "\n"
+
+    def dump(self):
+        """ Reports results, meant to run at exit. Never overwrites a file that isn't a profile (eg. a
+            deckfile passed by mistake).
+        """
+        if self.output is None:
+            sys.stderr.write(self.summary())
+            return
+        if os.path.exists(self.output) and not Profiler.is_profile(self.output):
+            print("Not writing profile, %s exists and isn't one" % self.output, file=sys.stderr)
+            return
+        try:
+            with open(self.output, "w", encoding="utf-8") as f:
+                json.dump(self.results(), f, indent=2)
+        except OSError as ose:
+            print("Cannot write profile:", ose, file=sys.stderr)
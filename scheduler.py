@@ -0,0 +1,31 @@
+from expiry import ExpiryScan
+
+SECS_PER_DAY = 60 * 60 * 24
+
+class LeitnerScheduler:
+    """ Decides when cards are due and which box they move to when answered. This one implements
+        the Leitner system: each box has a fixed expiry time, a right answer promotes a card by one
+        box, a wrong answer demotes it to box 0, and the last box never expires.
+        A card's due time only depends on its box and timestamp (due = timestamp + expiries[box]).
+        That's what allows decks to keep a precomputed due time per card, and to compute them in bulk
+        (see scan), so subclasses only pick the expiries and how answers move cards. A scheduler
+        that computes due times differently has to override both due and scan.
+    """
+
+    name = "leitner"
+
+    def __init__(self, expiries):
+        self.expiries = list(expiries)
+        self.box_count = len(self.expiries)
+        self.max_box_num = self.box_count - 1
+
+    def due(self, box, timestamp):
+        """ Returns point in time when a card expires, None if it never expires. """
+        return timestamp + self.expiries[box] if box < self.max_box_num else None
+
+    def scan(self, boxes, timestamps):
+        """ Returns an ExpiryScan over many cards, given their boxes and timestamps as arrays. """
+        return ExpiryScan(boxes, timestamps, self.expiries)
+
+    def next_box(self, box, correct):
+        return min(box + 1, self.max_box_num) if correct else 0
@@ -0,0 +1,42 @@
+import bisect
+import re
+
+class SearchIndex:
+    """ Inverted index from words to the cards that contain them (front or back, case-insensitive).
+        Escaped newlines count as word separators. A query matches cards that contain all of its
+        words; it's answered by intersecting the posting lists, shortest first, so its cost depends
+        on the number of candidate cards rather than on deck size.
+    """
+
+    word_pattern = re.compile(r"\w+")
+
+    def __init__(self):
+        # word -> list of card numbers
+        self.postings = {}
+        self.cards = []
+
+    @staticmethod
+    def words(text):
+        return set(SearchIndex.word_pattern.findall(text.replace("\\n", "\n").lower()))
+
+    def add(self, card):
+        number = len(self.cards)
+        self.cards.append(card)
+        for word in SearchIndex.words(card.front) | SearchIndex.words(card.back):
+            self.postings.setdefault(word, []).append(number)
+
+    def search(self, query):
+        """ Returns cards containing all words of query, in the order they were added. """
+        postings = sorted((self.postings.get(word, []) for word in SearchIndex.words(query)), key=len)
+        if not postings:
+            return []
+        # Posting lists are sorted, so candidates can be looked up by binary search.
+        numbers = postings[0]
+        for posting in postings[1:]:
+            numbers = [number for number in numbers if SearchIndex.contains(posting, number)]
+        return [self.cards[number] for number in numbers]
+
+    @staticmethod
+    def contains(posting, number):
+        position = bisect.bisect_left(posting, number)
+        return position < len(posting) and posting[position] == number
@@ -0,0 +1,156 @@
+import asyncio
+import threading
+import time
+
+from controller import Controller
+from deck import Deck, SECS_PER_DAY
+from flashcard import LazyFlashCard
+
+# pylint:disable=too-many-instance-attributes
+class StudySession:
+    """ Asynchronous study loop. User input is read in a worker thread. Meanwhile, the text of the
+        card that most likely comes next is read (for lazily loaded decks), and in journal mode the
+        deckfile is saved in the background once save_interval seconds or save_threshold answers have
+        passed, which keeps the journal short. Neither deck size nor saving delays the next question.
+        The deck itself is only ever touched by the event loop thread, except for the steps that
+        Deck allows to run in other threads (LazyFlashCard.materialize, Deck.write_snapshot).
+    """
+
+    save_interval = 60
+    save_threshold = 100
+
+    def __init__(self, deck, view, controller, get_next_card_fun, cram):
+        self.deck = deck
+        self.view = view
+        self.controller = controller
+        self.get_next_card_fun = get_next_card_fun
+        self.cram = cram
+        self.loop = None
+        self.prefetch_task = None
+        self.save_task = None
+        self.last_save_time = time.monotonic()
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        try:
+            await self.study_loop()
+        finally:
+            await self.wait_for_background_tasks()
+
+    async def input(self, prompt=""):
+        # Not in the loop's executor: asyncio.run joins its threads on exit, so Ctrl-C would only take
+        # effect after the next Enter key press. A daemon thread is simply abandoned.
+        future = self.loop.create_future()
+        threading.Thread(target=StudySession.read_input, args=(self.loop, future, prompt), daemon=True).start()
+        return await future
+
+    @staticmethod
+    def read_input(loop, future, prompt):
+        try:
+            result = (input(prompt), None)
+        except (EOFError, OSError, UnicodeDecodeError) as ex:
+            result = (None, ex)
+        try:
+            loop.call_soon_threadsafe(StudySession.resolve, future, *result)
+        except RuntimeError:
+            # Loop has been closed meanwhile.
+            pass
+
+    @staticmethod
+    def resolve(future, result, exception):
+        if future.done():
+            # Cancelled, eg. by Ctrl-C.
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    async def study_loop(self):
+        while True:
+            my_card = self.get_next_card_fun()
+            if not my_card:
+                next_expiry = self.deck.next_expiry()
+                if next_expiry is not None:
+                    print(self.view.print_nothing_to_do_come_back(next_expiry / SECS_PER_DAY))
+                else:
+                    print(self.view.print_nothing_to_do())
+                await self.handle(Controller.input_quit, my_card)
+                break
+            print(self.view.print_question(my_card), end="")
+            self.start_prefetch()
+            while True:
+                print(self.view.print_input(my_card.back), end="")
+                my_inp = (await self.input()).upper()
+                result = await self.handle(my_inp, my_card)
+                if result[0] == Controller.input_info:
+                    print(self.view.print_info(self.deck.get_statistics()))
+                elif result[0] == Controller.input_show:
+                    print(self.view.print_answer(my_card), end="" if not self.cram else " ")
+                    # In cram mode, wait for return key press then proceed to next question.
+                    if self.cram:
+                        await self.input()
+                        break
+                elif result[0] == Controller.input_cancel:
+                    my_inp = (await self.input(self.view.print_input_cancel_check(self.deck.journal_enabled))).upper()
+                    if my_inp == Controller.input_yes:
+                        return
+                else:
+                    break
+
+            if my_inp == Controller.input_quit:
+                return
+            self.start_background_save()
+
+    async def handle(self, inp, card):
+        # Controller works on the deck, which must not change under the feet of background tasks.
+        await self.wait_for_background_tasks(save=inp == Controller.input_quit)
+        return self.controller.handle(inp, card)
+
+    async def wait_for_background_tasks(self, save=True):
+        if self.prefetch_task is not None:
+            await self.prefetch_task
+            self.prefetch_task = None
+        if save and self.save_task is not None:
+            await self.save_task
+            self.save_task = None
+
+    def start_prefetch(self):
+        # Cram mode picks cards at random, nothing to predict.
+        card = self.deck.peek_next_card() if self.cram is None else None
+        if isinstance(card, LazyFlashCard) and not card.materialized():
+            self.prefetch_task = self.loop.run_in_executor(None, StudySession.prefetch, card)
+
+    @staticmethod
+    def prefetch(card):
+        try:
+            card.materialize()
+        except Deck.DeckfileChangedError:
+            # The deck adopts the changed deckfile before presenting the next card.
+            pass
+
+    def start_background_save(self):
+        if self.save_task is not None:
+            if not self.save_task.done():
+                return
+            # Raises unexpected errors of the previous save.
+            self.save_task.result()
+            self.save_task = None
+        # Without journal, answers are only meant to be saved on quit.
+        if not self.deck.journal_enabled or not self.deck.modified:
+            return
+        if self.deck.journal_entries >= StudySession.save_threshold \
+                or time.monotonic() - self.last_save_time >= StudySession.save_interval:
+            snapshot = self.deck.start_save()
+            if snapshot is not None:
+                self.last_save_time = time.monotonic()
+                self.save_task = self.loop.create_task(self.save(snapshot))
+
+    async def save(self, snapshot):
+        try:
+            await self.loop.run_in_executor(None, self.deck.write_snapshot, snapshot)
+        except OSError as ose:
+            # Answers are still in the journal, saving will be retried.
+            self.deck.finish_save(snapshot, ose)
+        else:
+            self.deck.finish_save(snapshot)
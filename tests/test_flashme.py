@@ -1,13 +1,64 @@
+# pylint:disable=too-many-lines
+import asyncio
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
 import unittest
+from array import array
+from unittest import mock
 
-from flashcard import FlashCard
-from flashme import Deck
+from box import Box
+from expiry import ExpiryScan
+from flashcard import FlashCard, LazyFlashCard
+from cache import SummaryCache
+from compiled import CompiledDeck
+from daemon import Daemon
+from daemonclient import DaemonClient
+from decklock import DeckLock
+from expandingscheduler import ExpandingScheduler
+from multideck import MultiDeck
+from profiler import Profiler
+from scheduler import LeitnerScheduler
+from session import StudySession
+from view import View
+from controller import Controller
+from flashme import Deck, Flashme
 
 # pylint:disable=no-self-use
 # pylint:disable=invalid-name
+# pylint:disable=too-many-public-methods
 
 class TestFlashMe(unittest.TestCase):
 
+    def setUp(self):
+        # Keep lock files out of the user's runtime directory.
+        runtime_dir = tempfile.TemporaryDirectory()  # pylint:disable=consider-using-with
+        self.addCleanup(runtime_dir.cleanup)
+        environ = mock.patch.dict(os.environ, {DeckLock.xdg_runtime_dir_env_string: runtime_dir.name})
+        environ.start()
+        self.addCleanup(environ.stop)
+        tmp_dir = tempfile.TemporaryDirectory()  # pylint:disable=consider-using-with
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+
+    def write_deckfile(self, specs, name="deck"):
+        """ Writes specs to a deckfile in the test's temporary directory, returns its path. """
+        deckfile = os.path.join(self.tmp_dir, name)
+        with open(deckfile, "w", encoding="utf-8") as f:
+            f.write(specs)
+        return deckfile
+
+    @staticmethod
+    def load_deck(deckfile, lazy=False, due_only=False, **kwargs):
+        """ Returns a deck loaded from deckfile, at time 1000 unless time_fun is given. """
+        kwargs.setdefault("time_fun", lambda: 1000)
+        deck = Deck(filename=deckfile, **kwargs)
+        deck.load_from_file(lazy=lazy, due_only=due_only)
+        return deck
+
     def test_setup(self):
         self.assertEqual(3, 1 + 2)
 
@@ -300,3 +351,731 @@ class TestFlashMe(unittest.TestCase):
         self.assertEqual(1500 + 1000 - 2001, deck.next_expiry())
         deck.insert_card(FlashCard("front", "back", box=2, timestamp=1000))
         self.assertEqual(0, deck.next_expiry())
+
+    def test_get_next_card_box_order_not_due_order(self):
+        expiries = [0, 100, 200, 300, 400, 500]
+        deck = Deck(expiries, time_fun=lambda: 1000)
+        deck.insert_card(FlashCard("q1", "a1", timestamp=950), 1)
+        deck.insert_card(FlashCard("q2", "a2", timestamp=800), 1)
+        deck.insert_card(FlashCard("q3", "a3", timestamp=850), 1)
+        self.assertEqual("q2", deck.get_next_card(consume=True).front)
+        self.assertEqual("q3", deck.get_next_card(consume=True).front)
+        self.assertEqual(None, deck.get_next_card(consume=True))
+        deck.time_fun = lambda: 1050
+        self.assertEqual("q1", deck.get_next_card(consume=True).front)
+
+    def test_get_next_card_time_goes_backwards(self):
+        expiries = [0, 100, 200, 300, 400, 500]
+        deck = Deck(expiries, time_fun=lambda: 2000)
+        deck.insert_card(FlashCard("q1", "a1", timestamp=1000), 1)
+        self.assertEqual("q1", deck.get_next_card().front)
+        deck.time_fun = lambda: 1050
+        self.assertEqual(None, deck.get_next_card())
+        deck.time_fun = lambda: 1100
+        self.assertEqual("q1", deck.get_next_card().front)
+
+    def test_get_next_card_timestamp_changed(self):
+        expiries = [0, 100, 200, 300, 400, 500]
+        deck = Deck(expiries, time_fun=lambda: 1000)
+        card = FlashCard("q1", "a1", timestamp=1000)
+        deck.insert_card(card, 2)
+        self.assertEqual(None, deck.get_next_card())
+        card.timestamp = 0
+        self.assertEqual("q1", deck.get_next_card().front)
+        card.timestamp = 1000
+        self.assertEqual(None, deck.get_next_card())
+
+    def test_get_next_card_loaded_and_answered_cards(self):
+        expiries = [0, 100, 200, 300, 400, 500]
+        now = [1000]
+        deck = Deck(expiries, time_fun=lambda: now[0])
+        deck.load_from_specs(["q0 : a0 # 1 @ 950", "q1 : a1 # 1 @ 800", "# comment", "q2 : a2 # 1 @ 850",
+                              "q3 : a3 # 1 @ 920", "q4 : a4 # 1 @ 700"])
+        self.assertEqual([5, 3], deck.get_statistics()[1])
+        self.assertEqual("q1", deck.get_next_card().front)
+        self.assertEqual("q2", deck.peek_next_card().front)
+        deck.wrong(deck.get_next_card(consume=True))
+        # Rescheduled, q2 comes due after q0 and q3.
+        deck.find_cards("q2")[0].timestamp = 960
+        self.assertEqual([[1, 1], [4, 1]], deck.get_statistics()[:2])
+        now[0] = 1055
+        self.assertEqual([4, 3], deck.get_statistics()[1])
+        self.assertEqual("q0", deck.get_next_card().front)
+        now[0] = 1000
+        self.assertEqual([4, 1], deck.get_statistics()[1])
+        self.assertEqual("q4", deck.get_next_card().front)
+        now[0] = 1060
+        self.assertEqual(["q0", "q2", "q3", "q4"], [deck.get_next_card(consume=True).front for _ in range(4)])
+        self.assertEqual([0, 0], deck.get_statistics()[1])
+
+    def test_box_remove_keeps_order(self):
+        # Box 1 of cards stored by sequence number, interleaved with box 0.
+        box = Box(1, [None] * 10, array("b", [0] * 10))
+        for seq in range(5):
+            box.add(2 * seq + 1, FlashCard("q%d" % seq))
+        box.remove(1)
+        box.remove(7)
+        self.assertEqual(["q1", "q2", "q4"], [card.front for card in box])
+        self.assertEqual(3, len(box))
+        self.assertEqual("q2", box[1].front)
+        self.assertEqual("q4", box[-1].front)
+        with self.assertRaises(IndexError):
+            box[3]  # pylint:disable=pointless-statement
+
+    def test_cram_mode_skips_moved_cards(self):
+        deck = Deck()
+        deck.insert_card(FlashCard("q1", "a1"), 2)
+        deck.insert_card(FlashCard("q2", "a2"), 2)
+        card = deck.get_next_card_cram_mode(cram=2)
+        other = deck.boxes[2][0] if deck.boxes[2][0] is not card else deck.boxes[2][1]
+        deck.wrong(other)
+        self.assertIs(card, deck.get_next_card_cram_mode(cram=2))
+        self.assertEqual(2, card.box)
+
+    def test_cram_mode_shows_every_card_once_per_round(self):
+        deck = Deck()
+        for i in range(10):
+            deck.insert_card(FlashCard("q%d" % i, "a%d" % i), i % deck.box_count)
+        for _ in range(3):
+            fronts = [deck.get_next_card_cram_mode(cram=-1).front for _ in range(10)]
+            self.assertEqual(sorted("q%d" % i for i in range(10)), sorted(fronts))
+
+    def test_cram_mode_handles_cards_moved_mid_round(self):
+        deck = Deck()
+        for i in range(6):
+            deck.insert_card(FlashCard("q%d" % i, "a%d" % i), 1)
+        drawn = set()
+        for _ in range(3):
+            card = deck.get_next_card_cram_mode(cram=1)
+            self.assertEqual(1, card.box)
+            drawn.add(card.front)
+            deck.wrong(card)
+        rest = {deck.get_next_card_cram_mode(cram=1).front for _ in range(3)}
+        self.assertEqual({"q%d" % i for i in range(6)} - drawn, rest)
+        self.assertEqual(1, deck.get_next_card_cram_mode(cram=1).box)
+        for card in list(deck.boxes[1]):
+            deck.wrong(card)
+        self.assertIsNone(deck.get_next_card_cram_mode(cram=1))
+
+    def test_cram_mode_weights(self):
+        deck = Deck()
+        for i in range(4):
+            deck.insert_card(FlashCard("q%d" % i, "a%d" % i), i % 2)
+        weights = [0, 1, 0, 0, 0, 0]
+        boxes = {deck.get_next_card_cram_mode(cram=-1, weights=weights).box for _ in range(20)}
+        self.assertEqual({1}, boxes)
+        weights = [3, 1, 0, 0, 0, 0]
+        boxes = [deck.get_next_card_cram_mode(cram=-1, weights=weights).box for _ in range(400)]
+        self.assertTrue(200 < boxes.count(0) < 400)
+
+    def test_get_statistics_tracks_answers_and_time(self):
+        expiries = [0, 500, 1000, 5000, 8000, 10000]
+        now = [1000]
+        deck = Deck(expiries, time_fun=lambda: now[0])
+        deck.load_from_specs(["q1 : a1 # 0 @ 1000", "q2 : a2 # 1 @ 600", "q3 : a3 # 1 @ 900"])
+        self.assertEqual([[1, 1], [2, 0], [0, 0], [0, 0], [0, 0], [0, 0]], deck.get_statistics())
+        now[0] = 1100
+        self.assertEqual([[1, 1], [2, 1], [0, 0], [0, 0], [0, 0], [0, 0]], deck.get_statistics())
+        card = deck.get_next_card(consume=True)
+        deck.right(card)
+        self.assertEqual([[0, 0], [3, 1], [0, 0], [0, 0], [0, 0], [0, 0]], deck.get_statistics())
+        self.assertEqual(0, deck.next_expiry())
+        card = deck.get_next_card(consume=True)
+        deck.wrong(card)
+        self.assertEqual([[1, 1], [2, 0], [0, 0], [0, 0], [0, 0], [0, 0]], deck.get_statistics())
+        now[0] = 900
+        self.assertEqual([[1, 0], [2, 0], [0, 0], [0, 0], [0, 0], [0, 0]], deck.get_statistics())
+
+    def test_load_from_file_lazy(self):
+        deckfile = self.write_deckfile("# Comment\n\nq1 : a1 # 4 @ 100\nq\u00e4 : a\u00f6\r\nq3 : a3 : x # 2\n")
+        deck = self.load_deck(deckfile, lazy=True)
+        card = deck.boxes[4][0]
+        self.assertIsInstance(card, LazyFlashCard)
+        self.assertFalse(card.materialized())
+        self.assertEqual(100, card.timestamp)
+        self.assertEqual("q\u00e4", deck.boxes[0][0].front)
+        self.assertEqual("a\u00f6", deck.boxes[0][0].back)
+        self.assertEqual("", deck.boxes[0][1].back)
+        self.assertFalse(card.materialized())
+        deck.right(deck.boxes[0][0])
+        deck.save_to_file()
+        with open(deckfile, encoding="utf-8") as f:
+            self.assertEqual(["# Comment", "", "q1 : a1 # 4 @ 100", "q\u00e4 : a\u00f6 # 1 @ 1000",
+                              "q3 : a3 : x # 2"], f.read().splitlines())
+
+    def test_load_due_only(self):
+        deckfile = self.write_deckfile("# Comment\nq1 : a1 # 1 @ 0\nq2 : a2 # 5 @ 0\nq3 : a3 # 1 @ 1000000\nq4 : a4\n")
+        now = [1000]
+        deck = self.load_deck(deckfile, due_only=True, time_fun=lambda: now[0])
+        # Only the due card is in memory, the others are recorded.
+        self.assertEqual([None, None, None, None], deck.deckfile_lines[:4])
+        self.assertEqual(3, len(deck.deferred))
+        self.assertEqual([[1, 1], [2, 0], [0, 0], [0, 0], [0, 0], [1, 0]], deck.get_statistics())
+        card = deck.get_next_card(consume=True)
+        self.assertEqual("q4", card.front)
+        deck.right(card)
+        self.assertIsNone(deck.get_next_card())
+        self.assertEqual(2 * 24 * 60 * 60 - 1000, deck.next_expiry())
+        deck.save_to_file()
+        # Cards coming due during the session get loaded then.
+        now[0] = 2 * 24 * 60 * 60
+        card = deck.get_next_card(consume=True)
+        self.assertEqual("q1", card.front)
+        self.assertIs(card, deck.deckfile_lines[1])
+        deck.right(card)
+        deck.save_to_file()
+        with open(deckfile, encoding="utf-8") as f:
+            self.assertEqual(["# Comment", "q1 : a1 # 2 @ 172800", "q2 : a2 # 5 @ 0", "q3 : a3 # 1 @ 1000000",
+                              "q4 : a4 # 1 @ 1000"], f.read().splitlines())
+        self.assertEqual([[0, 0], [2, 0], [1, 0], [0, 0], [0, 0], [1, 0]], deck.get_statistics())
+        # Cards coming due after someone else changed the deckfile stay deferred, but count as expired.
+        with open(deckfile, "a", encoding="utf-8") as f:
+            f.write("q5 : a5 # 2 @ 0\n")
+        now[0] = 1000000 + 2 * 24 * 60 * 60
+        self.assertEqual([[0, 0], [2, 2], [1, 1], [0, 0], [0, 0], [1, 0]], deck.get_statistics())
+        self.assertEqual(0, deck.next_expiry())
+        now[0] = 2 * 24 * 60 * 60
+        # Anything that needs all cards loads the rest.
+        self.assertEqual(5, deck.find_cards("q2")[0].box)
+        self.assertIsNone(deck.deferred)
+        self.assertEqual("# Comment", deck.deckfile_lines[0])
+        # Including the card added meanwhile.
+        self.assertEqual([[0, 0], [2, 0], [2, 0], [0, 0], [0, 0], [1, 0]], deck.get_statistics())
+
+    def test_load_due_only_keeps_box_order(self):
+        deckfile = self.write_deckfile("p : 1 # 1 @ 1000\nq : 2 # 1 @ 0\nr : 3 # 1 @ 0\ns : 4 # 1 @ 0\n")
+        now = [2 * 24 * 60 * 60]
+        deck = self.load_deck(deckfile, due_only=True, time_fun=lambda: now[0])
+        card = deck.get_next_card(consume=True)
+        self.assertEqual("q", card.front)
+        deck.right(card)
+        # Cards coming due later still come in deckfile order within their box.
+        now[0] += 1000
+        self.assertEqual("p", deck.peek_next_card().front)
+        self.assertEqual("p", deck.get_next_card().front)
+        # Someone else answers a card meanwhile; reading the deck doesn't lose the current card.
+        other = self.load_deck(deckfile, time_fun=lambda: now[0])
+        other.right(other.find_cards("s")[0])
+        other.save_to_file()
+        self.assertEqual("r", deck.peek_next_card().front)
+        self.assertEqual(4, len(list(deck.all_cards())))
+        deck.consume_current_card()
+        card = deck.find_cards("p")[0]
+        deck.right(card)
+        deck.save_to_file()
+        with open(deckfile, encoding="utf-8") as f:
+            self.assertEqual(["p : 1 # 2 @ 173800", "q : 2 # 2 @ 172800", "r : 3 # 1 @ 0", "s : 4 # 2 @ 173800"],
+                             f.read().splitlines())
+
+    def test_expiry_scan(self):
+        expiries = [0, 500, 1000, 5000, 8000, 10000]
+        boxes = [0, 0, 0, 1, 1, 1, 2, 2, 5, 5]
+        timestamps = [0, 1000, 1700, 1000, 1800, 1900, 1000, 1500, 1000, 2000]
+        # Few cards don't pay for importing NumPy.
+        self.assertFalse(ExpiryScan(boxes, timestamps, expiries).use_numpy)
+        # Plain Python, and NumPy no matter how few cards.
+        thresholds = [sys.maxsize, 0] if ExpiryScan.numpy_installed else [sys.maxsize]
+        threshold = ExpiryScan.numpy_threshold
+        try:
+            for ExpiryScan.numpy_threshold in thresholds:
+                scan = ExpiryScan(boxes, timestamps, expiries)
+                self.assertEqual(ExpiryScan.numpy_threshold == 0, scan.use_numpy)
+                self.assertEqual([[3, 3], [3, 1], [2, 1], [0, 0], [0, 0], [2, 0]], scan.statistics(2001))
+                self.assertEqual(0, scan.next_expiry(2001))
+                self.assertEqual(1000, scan.next_expiry(-1000))
+                self.assertEqual(None, ExpiryScan([5], [0], expiries).next_expiry(2001))
+                expired_seqs, pending = scan.box_entries(2001, 10)[1]
+                self.assertEqual([13], list(expired_seqs))
+                self.assertEqual([14, 15], list(pending))
+        finally:
+            ExpiryScan.numpy_threshold = threshold
+
+    def test_get_expired_counts(self):
+        deckfiles = []
+        for i, specs in enumerate(["q1\nq2 # 1\n", "q1 : a1 # 5\n", "# q1\nq1 : a1 # 2 @ 0\n"]):
+            deckfiles.append(self.write_deckfile(specs, name="deck%d" % i))
+        expected = [(deckfiles[0], 2), (deckfiles[2], 1)]
+        with mock.patch.dict(os.environ, {SummaryCache.xdg_cache_home_env_string: self.tmp_dir}):
+            self.assertEqual(expected, Flashme.get_expired_counts(deckfiles, jobs=3))
+            self.assertEqual(expected, Flashme.get_expired_counts(deckfiles, jobs=1))
+            # All summaries cached: no worker processes.
+            with mock.patch("concurrent.futures.ProcessPoolExecutor") as executor:
+                self.assertEqual(expected, Flashme.get_expired_counts(deckfiles, jobs=3))
+            executor.assert_not_called()
+
+    def test_run_fast_path(self):
+        deckfile = self.write_deckfile("q1 : a1 # 5\nq2 : a2 # 1 @ 0\n")
+        with mock.patch.dict(os.environ, {SummaryCache.xdg_cache_home_env_string: self.tmp_dir}), \
+                mock.patch("builtins.print") as print_mock:
+            self.assertTrue(Flashme.run_fast_path(["--info", deckfile]))
+            print_mock.assert_called_once_with("Expired/total: 1/2 (0/0 1/1 0/0 0/0 0/0 0/1)")
+            self.assertFalse(Flashme.run_fast_path(["-s", deckfile]))
+            self.assertFalse(Flashme.run_fast_path(["-i", "-t", deckfile]))
+            self.assertFalse(Flashme.run_fast_path([deckfile]))
+            self.write_deckfile("q1 : a1 # 5\n")
+            self.assertTrue(Flashme.run_fast_path([deckfile, "--silent-start"]))
+            print_mock.assert_called_once()
+
+    def test_daemon(self):
+        deckfile = self.write_deckfile("q1 : a1 # 5\nq2 : a2 # 1 @ 0\n")
+        with mock.patch.dict(os.environ, {DaemonClient.xdg_runtime_dir_env_string: self.tmp_dir,
+                                          SummaryCache.xdg_cache_home_env_string: self.tmp_dir}):
+            self.assertIsNone(DaemonClient.connect())
+            self.assertIsNone(Flashme.get_statistics_from_daemon([deckfile]))
+            daemon = Daemon()
+            daemon.listen()
+            thread = threading.Thread(target=lambda: [daemon.accept() for _ in range(2)], daemon=True)
+            thread.start()
+            try:
+                with DaemonClient.connect() as client:
+                    self.assertEqual([[0, 0], [1, 1], [0, 0], [0, 0], [0, 0], [1, 0]], client.statistics(deckfile))
+                    self.assertEqual(0, client.next_expiry(deckfile))
+                    self.write_deckfile("q1 : a1 # 5\n")
+                    self.assertEqual([[0, 0], [0, 0], [0, 0], [0, 0], [0, 0], [1, 0]], client.statistics(deckfile))
+                    self.assertIsNone(client.next_expiry(deckfile))
+                    with self.assertRaises(DaemonClient.QueryError):
+                        client.statistics(os.path.join(self.tmp_dir, "nodeck"))
+                with open(deckfile, "a", encoding="utf-8") as f:
+                    f.write("q2\n")
+                self.assertEqual([(deckfile, 1)], Flashme.get_expired_counts([deckfile]))
+            finally:
+                thread.join(DaemonClient.timeout)
+                daemon.close()
+            self.assertFalse(os.path.exists(DaemonClient.default_socket_path()))
+
+    def test_summary_cache(self):
+        deckfile = self.write_deckfile("q1 : a1 # 0 @ 1000\nq2 : a2 # 1 @ 1000\nq3 : a3 # 1 @ 100\nq4 : a4 # 5 @ 0\n")
+        expiries = [0, 500, 1000, 5000, 8000, 10000]
+        deck = Deck(expiries, filename=deckfile)
+        cache = SummaryCache(os.path.join(self.tmp_dir, "cache"))
+        signature = Deck.file_signature(deckfile)
+        self.assertEqual(None, cache.load(deck, signature))
+        summary = cache.summary(deck)
+        self.assertEqual([[1, 1], [2, 1], [0, 0], [0, 0], [0, 0], [1, 0]], summary.statistics(1000))
+        cached = cache.load(deck, signature)
+        self.assertEqual([[1, 0], [2, 0], [0, 0], [0, 0], [0, 0], [1, 0]], cached.statistics(0))
+        self.assertEqual([[1, 1], [2, 2], [0, 0], [0, 0], [0, 0], [1, 0]], cached.statistics(1500))
+        self.assertEqual(500, cached.next_expiry(100))
+        # Modified deckfile invalidates cache entry.
+        with open(deckfile, "a", encoding="utf-8") as f:
+            f.write("q5\n")
+        self.assertEqual(None, cache.load(deck, Deck.file_signature(deckfile)))
+        self.assertEqual([[2, 2], [2, 1], [0, 0], [0, 0], [0, 0], [1, 0]], cache.summary(deck).statistics(1000))
+
+    def test_save_to_file_rewrites_dirty_cards_only(self):
+        deckfile = self.write_deckfile("# Comment   \nq1\nq2 : a2 # 1 @ 0\nq3 : a3\r\n")
+        os.chmod(deckfile, 0o640)
+        deck = self.load_deck(deckfile, lazy=True)
+        card = deck.get_next_card(consume=True)
+        self.assertEqual("q1", card.front)
+        deck.right(card)
+        deck.save_to_file()
+        with open(deckfile, encoding="utf-8") as f:
+            self.assertEqual(["# Comment   ", "q1 :  # 1 @ 1000", "q2 : a2 # 1 @ 0", "q3 : a3"], f.read().splitlines())
+        self.assertEqual(0o640, os.stat(deckfile).st_mode & 0o777)
+        # No temp files (nor lock files) left behind.
+        self.assertEqual(["deck"], os.listdir(self.tmp_dir))
+        # Lazy cards still find their text after lines have moved.
+        self.assertEqual("a3", deck.boxes[0][0].back)
+        # Deckfile changed behind our back (after the card has been shown): the change gets merged,
+        # not overwritten.
+        card = deck.boxes[1][0]
+        self.assertEqual("q2", card.front)
+        with open(deckfile, "a", encoding="utf-8") as f:
+            f.write("q4\n")
+        deck.wrong(card)
+        deck.save_to_file()
+        with open(deckfile, encoding="utf-8") as f:
+            self.assertEqual(["# Comment   ", "q1 :  # 1 @ 1000", "q2 : a2 # 0 @ 1000", "q3 : a3", "q4"],
+                             f.read().splitlines())
+
+    def test_concurrent_sessions(self):
+        deckfile = self.write_deckfile("q1 : a1\nq2 : a2\nq3 : a3\nq4 : a4\n")
+        deck1 = self.load_deck(deckfile)
+        deck2 = self.load_deck(deckfile, lazy=True, time_fun=lambda: 2000)
+        deck1.right(deck1.find_cards("q1")[0])
+        deck1.right(deck1.find_cards("q3")[0])
+        deck2.wrong(deck2.get_next_card(consume=True))
+        deck2.right(deck2.get_next_card(consume=True))
+        deck1.save_to_file()
+        # Meanwhile, someone edits the deckfile: adds a card, removes one and changes a back.
+        with open(deckfile, "r+", encoding="utf-8") as f:
+            lines = f.read().splitlines()
+            f.seek(0)
+            f.truncate()
+            f.write("\n".join(["q0 : a0"] + lines[:2] + ["q3 : changed # 1 @ 1000"]) + "\n")
+        # Answers to different cards get merged, of answers to the same card the later one wins.
+        deck2.save_to_file()
+        with open(deckfile, encoding="utf-8") as f:
+            self.assertEqual(["q0 : a0", "q1 : a1 # 0 @ 2000", "q2 : a2 # 1 @ 2000", "q3 : changed # 1 @ 1000"],
+                             f.read().splitlines())
+        self.assertEqual([["q0", "q1"], ["q2", "q3"]],
+                         [sorted(card.front for card in deck2.boxes[box]) for box in range(2)])
+        # Background saves don't merge, they leave that to save_to_file.
+        deck2.right(deck2.find_cards("q0")[0])
+        snapshot = deck2.start_save()
+        with open(deckfile, "a", encoding="utf-8") as f:
+            f.write("q5 : a5\n")
+        with self.assertRaises(Deck.DeckfileChangedError):
+            deck2.write_snapshot(snapshot)
+        deck2.finish_save(snapshot, Deck.DeckfileChangedError())
+        deck2.save_to_file()
+        with open(deckfile, encoding="utf-8") as f:
+            self.assertEqual(["q0 : a0 # 1 @ 2000", "q5 : a5"], f.read().splitlines()[::4])
+
+    def test_lazy_cards_after_deckfile_edit(self):
+        deckfile = self.write_deckfile("apple : a # 0 @ 0\nkiwi : k # 0 @ 0\n")
+        deck = self.load_deck(deckfile, lazy=True)
+        self.write_deckfile("pear : p # 0 @ 0\nkiwi : k # 0 @ 0\n")
+        # Stale line offsets are never read from.
+        with self.assertRaises(Deck.DeckfileChangedError):
+            _ = deck.boxes[0][0].front
+        card = deck.get_next_card(consume=True)
+        self.assertEqual("pear", card.front)
+        deck.right(card)
+        deck.save_to_file()
+        with open(deckfile, encoding="utf-8") as f:
+            self.assertEqual(["pear : p # 1 @ 1000", "kiwi : k # 0 @ 0"], f.read().splitlines())
+        # Same for cramming.
+        deck = self.load_deck(deckfile, lazy=True)
+        deck.get_next_card_cram_mode(cram=-1)
+        with open(deckfile, "a", encoding="utf-8") as f:
+            f.write("plum : p # 0 @ 0\n")
+        fronts = {deck.get_next_card_cram_mode(cram=-1).front for _ in range(3)}
+        self.assertEqual({"pear", "kiwi", "plum"}, fronts)
+
+    def test_deck_lock(self):
+        deckfile = os.path.join(self.tmp_dir, "deck")
+        events = []
+
+        def lock():
+            with DeckLock(deckfile):
+                events.append("locked")
+
+        with DeckLock(deckfile):
+            thread = threading.Thread(target=lock, daemon=True)
+            thread.start()
+            thread.join(0.2)
+            events.append("released")
+        thread.join(5)
+        self.assertEqual(["released", "locked"], events)
+        # Lock file is in the runtime directory, shared by all names of the deckfile.
+        os.symlink(deckfile, os.path.join(self.tmp_dir, "link"))
+        self.assertEqual(DeckLock.lock_path(deckfile), DeckLock.lock_path(os.path.join(self.tmp_dir, "link")))
+        self.assertTrue(os.path.exists(DeckLock.lock_path(deckfile)))
+        self.assertTrue(DeckLock.lock_path(deckfile).startswith(os.environ[DeckLock.xdg_runtime_dir_env_string]))
+
+    def test_journal(self):
+        deckfile = self.write_deckfile("q1 : a1\nq2 : a2\nq3 : a3\n")
+        deck = self.load_deck(deckfile, journal=True)
+        deck.right(deck.get_next_card(consume=True))
+        deck.wrong(deck.get_next_card(consume=True))
+        deck.persist()
+        with open(deckfile, encoding="utf-8") as f:
+            self.assertEqual("q1 : a1\nq2 : a2\nq3 : a3\n", f.read())
+        self.assertTrue(os.path.exists(deck.journal_path()))
+
+        # Replayed even if the deckfile has been edited in the meantime.
+        self.write_deckfile("q0 : a0\nq1 : a1\nq2 : a2\nq3 : a3\n")
+        deck = self.load_deck(deckfile, journal=True, time_fun=lambda: 2000)
+        self.assertEqual(["q0", "q3", "q2"], [card.front for card in deck.boxes[0]])
+        self.assertEqual(["q1"], [card.front for card in deck.boxes[1]])
+        self.assertEqual(1000, deck.boxes[1][0].timestamp)
+
+        # Compaction writes deckfile and removes journal.
+        with mock.patch.object(Deck, "journal_threshold", 3):
+            deck.right(deck.get_next_card(consume=True))
+        with open(deckfile, encoding="utf-8") as f:
+            self.assertEqual("q0 : a0 # 1 @ 2000\nq1 : a1 # 1 @ 1000\nq2 : a2 # 0 @ 1000\nq3 : a3\n", f.read())
+        self.assertFalse(os.path.exists(deck.journal_path()))
+
+    def test_journal_shared_by_sessions(self):
+        deckfile = self.write_deckfile("q1 : a1\nq2 : a2\nq3 : a3\n")
+        deck1 = self.load_deck(deckfile, journal=True)
+        deck1.right(deck1.find_cards("q1")[0])
+        # Another session replays the journal, saves and removes it...
+        deck2 = self.load_deck(deckfile, time_fun=lambda: 1500)
+        deck2.right(deck2.find_cards("q3")[0])
+        deck2.save_to_file()
+        self.assertFalse(os.path.exists(deck1.journal_path()))
+        # ... the journaling session starts a new journal.
+        deck1.right(deck1.find_cards("q2")[0])
+        deck1.persist()
+        self.assertTrue(os.path.exists(deck1.journal_path()))
+        # A journal with entries a session hasn't replayed is left alone.
+        deck3 = self.load_deck(deckfile, time_fun=lambda: 3000)
+        deck1.right(deck1.find_cards("q3")[0])
+        deck1.persist()
+        deck3.wrong(deck3.find_cards("q1")[0])
+        deck3.save_to_file()
+        self.assertTrue(os.path.exists(deck1.journal_path()))
+        # Replaying it again only applies answers that are still the latest.
+        deck = self.load_deck(deckfile, time_fun=lambda: 4000)
+        self.assertEqual([("q1", 0, 3000), ("q2", 1, 1000), ("q3", 1, 1500)],
+                         [(card.front, card.box, card.timestamp) for card in deck.all_cards()])
+
+    def test_peek_next_card(self):
+        deck = Deck(time_fun=lambda: 1000000)
+        deck.load_from_specs(["q1 : a1", "q2 : a2 # 1 @ 0", "q3 : a3"])
+        card = deck.get_next_card()
+        self.assertEqual("q3", deck.peek_next_card().front)
+        self.assertIs(card, deck.get_next_card())
+        deck.consume_current_card()
+        deck.right(card)
+        self.assertEqual("q3", deck.get_next_card(consume=True).front)
+        self.assertEqual("q2", deck.peek_next_card().front)
+
+    def test_background_save(self):
+        deckfile = self.write_deckfile("q1 : a1\nq2 : a2\nq3 : a3\n")
+        deck = self.load_deck(deckfile, lazy=True, journal=True)
+        deck.right(deck.get_next_card(consume=True))
+        snapshot = deck.start_save()
+        self.assertIsNone(deck.start_save())
+        # Answered while saving.
+        deck.right(deck.get_next_card(consume=True))
+        deck.write_snapshot(snapshot)
+        deck.finish_save(snapshot)
+        with open(deckfile, encoding="utf-8") as f:
+            self.assertEqual("q1 : a1 # 1 @ 1000\nq2 : a2\nq3 : a3\n", f.read())
+        self.assertEqual("q3", deck.get_next_card().front)
+        # Journal still has the second answer.
+        self.assertTrue(os.path.exists(deck.journal_path()))
+        snapshot = deck.start_save()
+        deck.finish_save(snapshot, OSError())
+        self.assertTrue(deck.modified)
+        deck.save_to_file()
+        with open(deckfile, encoding="utf-8") as f:
+            self.assertEqual("q1 : a1 # 1 @ 1000\nq2 : a2 # 1 @ 1000\nq3 : a3\n", f.read())
+        self.assertFalse(os.path.exists(deck.journal_path()))
+
+    def test_study_session(self):
+        deckfile = self.write_deckfile("q1 : a1\nq2 : a2\nq3 : a3\n")
+        deck = self.load_deck(deckfile, lazy=True, journal=True)
+        session = StudySession(deck, View(False, False, None), Controller(deck, None), deck.get_next_card, None)
+        with mock.patch("builtins.input", side_effect=["Y", "", "N", "Y", "Q"]), mock.patch("builtins.print"), \
+                mock.patch.object(StudySession, "save_threshold", 1):
+            asyncio.run(session.run())
+        self.assertFalse(deck.saving)
+        deck = self.load_deck(deckfile)
+        self.assertEqual(["q2"], [card.front for card in deck.boxes[0]])
+        self.assertEqual(["q1", "q3"], [card.front for card in deck.boxes[1]])
+
+    def test_card_index(self):
+        deck = Deck()
+        deck.load_from_specs(["a : 1", "b : 2", "# c : 3", "a : 1 # 2", "b : 3"])
+        card = FlashCard("c", "3")
+        deck.insert_card(card)
+        self.assertEqual([card], deck.find_cards("c"))
+        self.assertEqual([], deck.find_cards("# c"))
+        self.assertEqual(["2", "3"], [card.back for card in deck.find_cards("b")])
+        self.assertEqual(["b"], [card.front for card in deck.find_cards("b", "3")])
+        self.assertEqual(["b"], [card.front for card in deck.index_cards().find_by_back("2")])
+        duplicates = deck.find_duplicates()
+        self.assertEqual([["a", "a"], ["b", "b"]], [[card.front for card in cards] for cards in duplicates])
+        self.assertEqual([[0, 3], [1, 4]], [[card.line for card in cards] for cards in duplicates])
+        # Answering doesn't change identity.
+        deck.wrong(deck.find_cards("c")[0])
+        deck.insert_card(FlashCard("c", "4"), 1)
+        self.assertEqual(["3", "4"], [card.back for card in deck.find_cards("c")])
+        self.assertEqual(6, len(deck.index_cards()))
+
+    def test_scheduler(self):
+        self.assertIsInstance(Deck().scheduler, LeitnerScheduler)
+        self.assertEqual(Deck.default_expiries, Deck().expiries)
+        day = 60 * 60 * 24
+        self.assertEqual([0, day, 6 * day, 15 * day, int(37.5 * day), -1], ExpandingScheduler(6).expiries)
+        with mock.patch.dict(os.environ, {Flashme.scheduler_env_string: "expanding"}):
+            self.assertIsInstance(Flashme.create_scheduler(), ExpandingScheduler)
+            # Only flashme picks the scheduler from the environment, a deck's expiries stay as given.
+            self.assertEqual([0, 1, 2, -1], Deck(expiries=[0, 1, 2, -1]).expiries)
+        with mock.patch.dict(os.environ, {Flashme.scheduler_env_string: "nonsense"}):
+            with self.assertRaises(ValueError):
+                Flashme.create_scheduler()
+        deck = Deck(scheduler=ExpandingScheduler(6), time_fun=lambda: 1000)
+        card = FlashCard("q", "a", 3, 0)
+        deck.insert_card(card, 3)
+        self.assertEqual(15 * day, deck.card_due(card))
+        self.assertFalse(deck.card_expired(card))
+        deck.right(card)
+        self.assertEqual(4, card.box)
+        self.assertEqual(1000 + int(37.5 * day), deck.card_due(card))
+        # Lapses cost two boxes, not all progress.
+        deck.wrong(card)
+        self.assertEqual(2, card.box)
+        self.assertEqual([[0, 0], [0, 0], [1, 0], [0, 0], [0, 0], [0, 0]], deck.get_statistics())
+        self.assertEqual(6 * day, deck.next_expiry())
+        deck.wrong(card)
+        deck.wrong(card)
+        self.assertEqual(0, card.box)
+        self.assertTrue(deck.card_expired(card))
+        self.assertEqual(card, deck.get_next_card())
+        # Loading evaluates expiry in bulk, by the deck's scheduler.
+        deck = Deck(scheduler=ExpandingScheduler(6), time_fun=lambda: day + 1)
+        deck.load_from_specs(["q1 : a1 # 1 @ 0", "q2 : a2 # 2 @ 0"])
+        self.assertEqual([[0, 0], [1, 1], [1, 0], [0, 0], [0, 0], [0, 0]], deck.get_statistics())
+
+    def test_forecast(self):
+        day = 60 * 60 * 24
+        now = 100 * day
+        specs = ["q0 : a0 # 0 @ %d" % (now - 10), "q1 : a1 # 1 @ %d" % (now - day), "q2 : a2 # 1 @ %d" % (now + 3600),
+                 "q3 : a3 # 2 @ %d" % (now - 9 * day + 7200), "q4 : a4 # 5 @ 0"]
+        for threshold in sorted({sys.maxsize, 0 if ExpiryScan.numpy_installed else sys.maxsize}):
+            with mock.patch.object(ExpiryScan, "numpy_threshold", threshold):
+                deck = Deck(time_fun=lambda: now)
+                deck.load_from_specs(specs)
+                # q0 expired, q1 due in a day, q2 in two days (plus an hour), q3 in a day (plus two hours).
+                self.assertEqual([1, 2, 1, 0], deck.forecast(4, day))
+                scan = ExpiryScan(deck.seq_boxes, [card.timestamp for card in deck.deckfile_lines], deck.expiries)
+                self.assertEqual([1, 2, 1, 0], scan.summary().forecast(now, 4, day))
+                # Histogram follows answers.
+                card = deck.get_next_card(consume=True)
+                deck.right(card)
+                self.assertEqual([0, 2, 2, 0], deck.forecast(4, day))
+                deck.wrong(deck.find_cards("q2")[0])
+                self.assertEqual([1, 2, 1, 0], deck.forecast(4, day))
+                self.assertEqual([1, 0, 0], deck.forecast(3, 3600))
+
+    def test_profiler(self):
+        class Worker:
+            def work(self, value):
+                return value + 1
+
+            async def wait(self):
+                await asyncio.sleep(0)
+                return "done"
+
+        profiler = Profiler()
+        profiler.instrument(Worker, "work")
+        profiler.instrument(Worker, "wait", "waiting")
+        worker = Worker()
+        self.assertEqual(2, worker.work(1))
+        self.assertEqual(3, worker.work(2))
+        self.assertEqual("done", asyncio.run(worker.wait()))
+        results = profiler.results()
+        self.assertEqual({"Worker.work", "waiting"}, set(results))
+        self.assertEqual(2, results["Worker.work"]["calls"])
+        self.assertEqual(2, sum(results["Worker.work"]["histogram_us"].values()))
+        self.assertEqual(1, results["waiting"]["calls"])
+        self.assertIn("Worker.work", profiler.summary())
+        profiler.output = os.path.join(self.tmp_dir, "profile.json")
+        profiler.dump()
+        with open(profiler.output, encoding="utf-8") as f:
+            self.assertEqual(results, json.load(f))
+        # Earlier profiles get replaced, anything else (say, a deckfile) is left alone.
+        profiler.dump()
+        profiler.output = os.path.join(self.tmp_dir, "deck")
+        with open(profiler.output, "w", encoding="utf-8") as f:
+            f.write("q1 : a1\n")
+        with mock.patch("sys.stderr"):
+            profiler.dump()
+        with open(profiler.output, encoding="utf-8") as f:
+            self.assertEqual("q1 : a1\n", f.read())
+
+    def test_search(self):
+        deck = Deck()
+        deck.load_from_specs(["It's cold : Es ist kalt", "cold\\nwinter : kalter Winter # 2", "# cold", "hot : heiß"])
+        self.assertEqual(["It's cold", "cold\\nwinter"], [card.front for card in deck.search("COLD")])
+        self.assertEqual(["cold\\nwinter"], [card.front for card in deck.search("winter cold")])
+        self.assertEqual(["hot"], [card.front for card in deck.search("heiß")])
+        self.assertEqual([], deck.search("cold hot"))
+        self.assertEqual([], deck.search(""))
+        card = FlashCard("cold feet", "kalte Füße")
+        deck.insert_card(card, 3)
+        self.assertEqual(card, deck.search("kalte")[0])
+        # Cram search results only.
+        deck.restrict_cram(deck.search("cold"))
+        fronts = {deck.get_next_card_cram_mode(cram=-1).front for _ in range(20)}
+        self.assertEqual({"It's cold", "cold\\nwinter", "cold feet"}, fronts)
+        self.assertEqual({"It's cold"}, {deck.get_next_card_cram_mode(cram=0).front for _ in range(5)})
+        deck.wrong(card)
+        deck.wrong(deck.search("hot")[0])
+        self.assertEqual({"It's cold", "cold feet"}, {deck.get_next_card_cram_mode(cram=0).front for _ in range(10)})
+
+    def test_multi_deck(self):
+        specs = {"one": "a1 : A1 # 0 @ 30\na2 : A2 # 1 @ 0\n", "two": "b1 : B1 # 0 @ 10\nb2 : B2 # 0 @ 40\n",
+                 "three": "c1 : C1 # 5\n"}
+        for name, spec in specs.items():
+            self.write_deckfile(spec, name=name)
+        os.mkdir(os.path.join(self.tmp_dir, "cache"))
+        with mock.patch.dict(os.environ, {Deck.flashme_dir_env_string: self.tmp_dir}):
+            deckfiles = MultiDeck.find_deckfiles()
+        self.assertEqual(["one", "three", "two"], [os.path.basename(deckfile) for deckfile in deckfiles])
+        deck = MultiDeck(deckfiles, time_fun=lambda: 100, cache_dir=os.path.join(self.tmp_dir, "cache"))
+        self.assertEqual([[3, 3], [1, 0], [0, 0], [0, 0], [0, 0], [1, 0]], deck.get_statistics())
+        # Nothing is loaded before a deck's cards are due.
+        self.assertEqual([False, False, False], deck.loaded)
+        # Merged by due time.
+        fronts = [deck.get_next_card().front]
+        self.assertEqual([False, False, True], deck.loaded)
+        for _ in range(3):
+            card = deck.get_next_card()
+            fronts.append(card.front)
+            deck.consume_current_card()
+            deck.right(card)
+        self.assertEqual(["b1", "b1", "b2", "a1"], fronts)
+        self.assertIsNone(deck.get_next_card())
+        self.assertEqual([True, False, True], deck.loaded)
+        self.assertEqual(Deck.default_expiries[1] - 100, deck.next_expiry())
+        self.assertTrue(deck.modified)
+        deck.persist()
+        self.assertFalse(deck.modified)
+        with open(os.path.join(self.tmp_dir, "two"), encoding="utf-8") as f:
+            self.assertEqual("b1 : B1 # 1 @ 100\nb2 : B2 # 1 @ 100\n", f.read())
+
+    def test_multi_deck_rejects_single_deck_options(self):
+        for argv, message in ((["--multi", "--info"], "--info needs a single deckfile"),
+                              (["--multi", "a", "--search", "q", "--compile"], "--search, --compile need a single deckfile"),
+                              (["a", "--multi"], "Please pass deckfiles to --multi")):
+            with mock.patch.object(sys, "argv", ["flashme"] + argv), mock.patch("sys.stderr", new_callable=io.StringIO) as stderr:
+                with self.assertRaises(SystemExit):
+                    Flashme()
+            self.assertIn(message, stderr.getvalue())
+
+    def test_apply_reviews(self):
+        deckfile = self.write_deckfile("q1 : a1\nq2 : a2 # 2 @ 0\nq3 : a3 # 5 @ 0\n")
+        deck = self.load_deck(deckfile, lazy=True, journal=True)
+        reviews = Flashme.read_reviews(["# exported", "q1\ty", "q2\tN\t500", "", "q3\tY", "q9\tn", "q1\tY\r\n"])
+        self.assertEqual((4, ["q9"]), deck.apply_reviews(reviews))
+        self.assertFalse(os.path.exists(deck.journal_path()))
+        self.assertEqual(["q2"], [card.front for card in deck.boxes[0]])
+        self.assertEqual(["q1"], [card.front for card in deck.boxes[2]])
+        self.assertEqual(["q3"], [card.front for card in deck.boxes[5]])
+        deck.save_to_file()
+        with open(deckfile, encoding="utf-8") as f:
+            self.assertEqual("q1 : a1 # 2 @ 1000\nq2 : a2 # 0 @ 500\nq3 : a3 # 5 @ 1000\n", f.read())
+        with self.assertRaises(ValueError):
+            list(Flashme.read_reviews(["q1\tmaybe"]))
+        with self.assertRaises(ValueError):
+            list(Flashme.read_reviews(["q1\ty\tnoon"]))
+
+    def test_compiled_deck(self):
+        deckfile = self.write_deckfile("# Comment\n\nqä : aä # 1 @ 100\nq2 : a2\n")
+        os.chmod(deckfile, 0o644)
+        deck = self.load_deck(deckfile)
+        deck.compile()
+        self.assertEqual(0o644, os.stat(deckfile + ".fmc").st_mode & 0o777)
+        deck = self.load_deck(deckfile)
+        self.assertIsNotNone(deck.compiled)
+        self.assertEqual(["# Comment", ""], deck.deckfile_lines[0:2])
+        self.assertEqual(("qä", "aä", 100), (deck.boxes[1][0].front, deck.boxes[1][0].back, deck.boxes[1][0].timestamp))
+        self.assertEqual([[1, 1], [1, 0], [0, 0], [0, 0], [0, 0], [0, 0]], deck.get_statistics())
+
+        # Saving patches answers into the sidecar, rather than compiling it again.
+        sidecar_inode = os.stat(deckfile + ".fmc").st_ino
+        deck.right(deck.get_next_card(consume=True))
+        deck.save_to_file()
+        self.assertEqual(sidecar_inode, os.stat(deckfile + ".fmc").st_ino)
+        deck = self.load_deck(deckfile)
+        self.assertIsNotNone(deck.compiled)
+        self.assertEqual([("qä", 100), ("q2", 1000)], [(card.front, card.timestamp) for card in deck.boxes[1]])
+
+        # Sidecar is ignored once deckfile has been edited.
+        with open(deckfile, "a", encoding="utf-8") as f:
+            f.write("q3\n")
+        deck = self.load_deck(deckfile)
+        self.assertIsNone(deck.compiled)
+        self.assertEqual(["q3"], [card.front for card in deck.boxes[0]])
+        # ... until compiled again, saving doesn't.
+        deck.right(deck.get_next_card(consume=True))
+        deck.save_to_file()
+        self.assertIsNone(CompiledDeck.open(deckfile, Deck.file_signature(deckfile)))
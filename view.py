@@ -41,6 +41,9 @@ class View:
     def print_deckfile(self, deckfile):
         return deckfile
 
+    def print_deckfiles(self, deckfiles):
+        return "%d deckfiles: %s" % (len(deckfiles), ", ".join(deckfiles))
+
     def print_input(self, card_back):
         out = ""
         if not self.terse:
@@ -67,7 +70,9 @@ class View:
             text += " %d hour(s)" % hours
         return text
 
-    def print_input_cancel_check(self):
+    def print_input_cancel_check(self, journal=False):
+        if journal:
+            return "Cancel? Answers are kept in journal. Y/N "
         return "Cancel without saving? Y/N "
 
     def print_version(self, version):
@@ -79,6 +84,42 @@ class View:
             text += "%4d %s\n" % (count, deckfile)
         return text
 
+    def print_forecast(self, counts, unit):
+        """ counts holds number of cards coming due per unit (day or hour), expired ones count for the first. """
+        text = ""
+        for index, count in enumerate(counts):
+            text += "%s %3d: %4d\n" % (unit, index + 1, count)
+        return text + "Total: %d\n" % sum(counts)
+
+    def print_search_results(self, results):
+        """ results holds (card, box, seconds until card expires or None) per matching card. """
+        text = ""
+        for card, box, expires_in in results:
+            if expires_in is None:
+                due = "never expires"
+            elif expires_in <= 0:
+                due = "expired"
+            else:
+                due = "expires in %.1f day(s)" % (expires_in / (24 * 60 * 60))
+            sides = (card.front, card.back) if not self.reverse else (card.back, card.front)
+            text += "[box %d, %s] %s : %s\n" % (box, due, *sides)
+        return text
+
+    def print_duplicates(self, duplicates):
+        text = ""
+        for cards in duplicates:
+            text += "%s: lines %s" % (cards[0].front, ", ".join(str(card.line + 1) for card in cards))
+            if len({card.back for card in cards}) > 1:
+                text += " (different backs)"
+            text += "\n"
+        return text
+
+    def print_applied_reviews(self, applied, unknown):
+        text = "Applied %d review(s)" % applied
+        if unknown:
+            text += ", %d unknown card(s): %s" % (len(unknown), ", ".join(unknown))
+        return text
+
     @staticmethod
     def die(text):
         print("Fatal:", text, file=sys.stderr)